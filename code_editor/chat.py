@@ -0,0 +1,188 @@
+"""
+Room chat history.
+
+Messages are kept in a ring buffer of the last ``CHAT_HISTORY_SIZE`` per
+room, which new members get on join without touching the database. Writes
+are queued and stored in batches by a background task every
+``CHAT_FLUSH_INTERVAL`` seconds, or as soon as ``CHAT_FLUSH_BATCH_SIZE``
+messages are waiting, so sending a message never waits on an insert.
+Messages still queued when the process dies are lost, and while the
+database is failing at most ``CHAT_MAX_PENDING`` are kept, the oldest
+dropped first.
+
+Older history is read a page at a time, newest first, with the
+``created_at`` of the oldest message a client has as the cursor.
+
+Like documents, a room's buffer assumes the room is served by one process.
+Buffers of the least recently used rooms are dropped past
+``CHAT_BUFFERED_ROOMS`` and reloaded from the database when needed.
+"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def serialize(message):
+    """The client representation of a ChatMessage."""
+    return {
+        'username': message.username,
+        'message': message.message,
+        'timestamp': timezone.localtime(message.created_at).strftime('%I:%M %p'),
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+class ChatHistory:
+    def __init__(self):
+        self._recent = OrderedDict()  # room name -> deque of serialized messages, oldest first
+        self._pending = []  # ChatMessage rows not written yet
+        self._task = None
+        self._flushing = None
+        self._last_created_at = None
+
+    @property
+    def history_size(self):
+        return getattr(settings, 'CHAT_HISTORY_SIZE', 50)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'CHAT_FLUSH_INTERVAL', 2.0)
+
+    @property
+    def flush_batch_size(self):
+        return getattr(settings, 'CHAT_FLUSH_BATCH_SIZE', 200)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, 'CHAT_MAX_PENDING', 10000)
+
+    async def record(self, room_name, username, text):
+        """
+        Add a message to the room's history.
+
+        Returns:
+            The message as sent to clients
+        """
+        from .models import ChatMessage
+
+        # created_at is the pagination cursor, so no two messages may share one
+        created_at = timezone.now()
+        if self._last_created_at is not None and created_at <= self._last_created_at:
+            created_at = self._last_created_at + timedelta(microseconds=1)
+        self._last_created_at = created_at
+
+        row = ChatMessage(room_name=room_name, username=username, message=text, created_at=created_at)
+        message = serialize(row)
+        buffer = await self._buffer(room_name)
+        buffer.append(message)
+
+        self._pending.append(row)
+        if len(self._pending) >= self.flush_batch_size:
+            self._flush_soon()
+        self._ensure_flusher()
+        return message
+
+    async def recent(self, room_name):
+        """The last ``CHAT_HISTORY_SIZE`` messages of a room, oldest first."""
+        return list(await self._buffer(room_name))
+
+    async def history(self, room_name, before, limit=None):
+        """
+        A page of messages older than a cursor.
+
+        Args:
+            room_name: Room to read
+            before: ISO ``created_at`` of the oldest message the client has
+            limit: Page size, CHAT_PAGE_SIZE by default
+
+        Returns:
+            (messages, has_more) - up to ``limit`` messages, oldest first
+
+        Raises:
+            ValueError: ``before`` is not an ISO datetime
+        """
+        before = datetime.fromisoformat(before)
+        if timezone.is_naive(before):
+            before = timezone.make_aware(before, dt_timezone.utc)
+        limit = limit or getattr(settings, 'CHAT_PAGE_SIZE', 50)
+        # Queued messages, and those a background flush is still writing, must be in the table before it is paged
+        flushing = self._flushing
+        if flushing is not None and not flushing.done() and flushing.get_loop() is asyncio.get_running_loop():
+            await asyncio.shield(flushing)
+        await self.flush()
+        rows = await self._read(room_name, before, limit + 1)
+        return [serialize(row) for row in reversed(rows[:limit])], len(rows) > limit
+
+    async def flush(self):
+        """Write all queued messages."""
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        try:
+            await self._write(rows)
+        except Exception as e:
+            logger.error(f"Chat history write error: {str(e)}")
+            # Keep them for the next attempt, but not without limit while the database is down
+            self._pending = rows + self._pending
+            dropped = len(self._pending) - self.max_pending
+            if dropped > 0:
+                logger.error(f"Chat history dropped {dropped} unwritten messages")
+                del self._pending[:dropped]
+
+    async def _buffer(self, room_name):
+        buffer = self._recent.get(room_name)
+        if buffer is None:
+            rows = await self._read(room_name, None, self.history_size)
+            # Messages of an evicted room can still be waiting to be written
+            pending = [row for row in self._pending if row.room_name == room_name]
+            rows = sorted(rows + pending, key=lambda row: row.created_at)
+            buffer = self._recent.setdefault(
+                room_name, deque((serialize(row) for row in rows), maxlen=self.history_size)
+            )
+        self._recent.move_to_end(room_name)
+        while len(self._recent) > getattr(settings, 'CHAT_BUFFERED_ROOMS', 1000):
+            self._recent.popitem(last=False)
+        return buffer
+
+    @database_sync_to_async
+    def _read(self, room_name, before, limit):
+        from .models import ChatMessage
+
+        rows = ChatMessage.objects.filter(room_name=room_name)
+        if before is not None:
+            rows = rows.filter(created_at__lt=before)
+        # Newest first
+        return list(rows.order_by('-created_at')[:limit])
+
+    @database_sync_to_async
+    def _write(self, rows):
+        from .models import ChatMessage
+
+        ChatMessage.objects.bulk_create(rows)
+
+    def _flush_soon(self):
+        loop = asyncio.get_running_loop()
+        if self._flushing is None or self._flushing.done() or self._flushing.get_loop() is not loop:
+            self._flushing = loop.create_task(self.flush())
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            # Through _flushing, so history can wait for the write
+            self._flush_soon()
+            await self._flushing
+
+
+chat_history = ChatHistory()
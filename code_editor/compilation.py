@@ -0,0 +1,233 @@
+"""
+Compile step and on-disk artifact cache for compiled languages.
+
+Artifacts are stored under ``EXECUTION_ARTIFACT_DIR`` in a directory named
+after the SHA-256 of the language, compiler command and source, so running
+the same code again - by anyone in any room - skips compilation. The cache
+is trimmed least-recently-used first once it grows past
+``EXECUTION_ARTIFACT_CACHE_SIZE`` bytes; artifacts in use are never evicted.
+
+Compilers run in their own session under resource limits of their own,
+set with prlimit(1), since they need more memory and write larger files than
+the programs they build. They run no user code, so by default they get no
+process limit: RLIMIT_NPROC counts every process and thread of the user, and
+javac's JVM alone starts dozens of threads. A compiler still running after
+``EXECUTION_COMPILE_TIMEOUT`` seconds is killed together with the processes
+it started.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+from .forkserver import limited_command
+
+
+def _java_main_class(code):
+    # javac requires a public class to live in a file of the same name
+    match = re.search(r'public\s+(?:final\s+)?class\s+(\w+)', code)
+    if match is None:
+        match = re.search(r'class\s+(\w+)', code)
+    return match.group(1) if match else 'Main'
+
+
+COMPILERS = {
+    'cpp': {
+        'source': lambda code: 'main.cpp',
+        'compile': lambda source, out: ['g++', '-O2', '-o', os.path.join(out, 'main'), source],
+        'run': lambda out, code: [os.path.join(out, 'main')],
+    },
+    'java': {
+        'source': lambda code: _java_main_class(code) + '.java',
+        'compile': lambda source, out: ['javac', '-d', out, source],
+        'run': lambda out, code: ['java', '-cp', out, _java_main_class(code)],
+    },
+}
+
+
+def is_compiled(language):
+    return language in COMPILERS
+
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ArtifactCache:
+    def __init__(self, root=None, max_size=None, timeout=None, limits=None):
+        self._root = root
+        self._max_size = max_size
+        self._timeout = timeout
+        self._limits = limits
+        self._entries = None  # key -> (size, last use), loaded lazily
+        self._in_use = {}
+        self._compiling = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def root(self):
+        return self._root or getattr(
+            settings, 'EXECUTION_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'codecolab-artifacts')
+        )
+
+    @property
+    def max_size(self):
+        return self._max_size or getattr(settings, 'EXECUTION_ARTIFACT_CACHE_SIZE', 256 * 1024 * 1024)
+
+    @property
+    def timeout(self):
+        return self._timeout or getattr(settings, 'EXECUTION_COMPILE_TIMEOUT', 30)
+
+    @property
+    def limits(self):
+        """Resource limits per compiler run, keyed like forkserver.RESOURCES."""
+        if self._limits is not None:
+            return self._limits
+        return {
+            'cpu': self.timeout,
+            'memory': getattr(settings, 'EXECUTION_COMPILE_MEMORY_LIMIT', 1024 * 1024 * 1024),
+            'processes': getattr(settings, 'EXECUTION_COMPILE_MAX_PROCESSES', 0),
+            'file_size': getattr(settings, 'EXECUTION_COMPILE_FILE_SIZE_LIMIT', 64 * 1024 * 1024),
+        }
+
+    def _load_entries(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        self._entries = {}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            self._entries[name] = (_directory_size(path), os.path.getmtime(path))
+
+    @staticmethod
+    def cache_key(language, code):
+        compiler = COMPILERS[language]
+        command = ' '.join(compiler['compile']('SOURCE', 'OUT'))
+        return hashlib.sha256(f"{language}\0{command}\0{code}".encode()).hexdigest()
+
+    @asynccontextmanager
+    async def checkout(self, language, code):
+        """
+        Compile ``code`` (or reuse a cached build) and hold it while it runs.
+
+        Yields:
+            Dictionary with the ``command`` to run, or ``error`` holding the
+            compiler output when compilation failed
+        """
+        self._load_entries()
+        key = self.cache_key(language, code)
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            artifact = await self._get_or_compile(key, language, code)
+            yield artifact
+        finally:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+
+    async def _get_or_compile(self, key, language, code):
+        path = os.path.join(self.root, key)
+        if key in self._entries and os.path.isdir(path):
+            self.hits += 1
+            self._touch(key, path)
+            return {'command': COMPILERS[language]['run'](path, code), 'error': None}
+
+        # Identical sources submitted together share one compiler run
+        compiling = self._compiling.get(key)
+        if compiling is None:
+            self.misses += 1
+            compiling = self._compiling[key] = asyncio.ensure_future(self._compile(key, language, code))
+            compiling.add_done_callback(lambda _: self._compiling.pop(key, None))
+        error = await asyncio.shield(compiling)
+        if error is not None:
+            return {'command': None, 'error': error}
+        return {'command': COMPILERS[language]['run'](path, code), 'error': None}
+
+    async def _compile(self, key, language, code):
+        compiler = COMPILERS[language]
+        build_dir = tempfile.mkdtemp(prefix='.build-', dir=self.root)
+        try:
+            out_dir = os.path.join(build_dir, 'out')
+            os.mkdir(out_dir)
+            source = os.path.join(build_dir, compiler['source'](code))
+            with open(source, 'w') as f:
+                f.write(code)
+
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *limited_command(compiler['compile'](source, out_dir), self.limits),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    cwd=build_dir,
+                    start_new_session=True,
+                )
+            except (OSError, subprocess.SubprocessError) as e:
+                return f"Compilation error: {str(e)}"
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                # g++ and javac start processes of their own
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await process.wait()
+                return "Compilation timed out"
+            if process.returncode != 0:
+                return output.decode(errors='replace')
+
+            # Publish atomically so concurrent readers never see a partial build
+            path = os.path.join(self.root, key)
+            try:
+                os.rename(out_dir, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+            self._entries[key] = (_directory_size(path), 0)
+            self._touch(key, path)
+            self._evict()
+            return None
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _touch(self, key, path):
+        # The directory mtime doubles as the last-use time across restarts
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        size, _ = self._entries[key]
+        self._entries[key] = (size, now)
+
+    def _evict(self):
+        total = sum(size for size, _ in self._entries.values())
+        for key, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_size:
+                break
+            if key in self._in_use:
+                continue
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            del self._entries[key]
+            total -= size
+
+
+artifact_cache = ArtifactCache()
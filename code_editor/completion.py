@@ -0,0 +1,323 @@
+"""
+AI code completion for the ``/ai-autocomplete/`` endpoint.
+
+Requests go to an upstream model through a pooled ``httpx.AsyncClient`` with
+strict timeouts, so a slow model never holds a server thread. Only the tail
+of the code is sent: the last ``AI_COMPLETION_CONTEXT_CHARS`` characters,
+with line endings and trailing whitespace normalised. That tail and the
+language also key an LRU cache with a TTL, and concurrent requests for the
+same key share a single upstream call.
+
+The room WebSocket streams completions instead (``Completer.stream``): tokens
+are passed on as the upstream produces them, each within the timeout, and a
+stream that is abandoned closes its upstream request.
+
+The upstream is the class named by ``AI_COMPLETION_UPSTREAM``: Hugging Face
+by default, or ``StubUpstream`` for local development and tests. Any class
+with an async ``complete(prompt)`` method works; an async generator
+``stream(prompt)`` is optional, without one the completion arrives in one piece.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPSTREAM = 'code_editor.completion.HuggingFaceUpstream'
+
+
+class UpstreamError(Exception):
+    """Raised when the upstream model fails or returns something unusable."""
+
+    def __init__(self, message, status_code=None, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+
+class CompletionTimeout(UpstreamError):
+    """Raised when the upstream model does not answer within AI_COMPLETION_TIMEOUT."""
+
+
+def normalize_context(code, size):
+    """
+    The part of ``code`` sent upstream and used as the cache key.
+
+    Args:
+        code: Code preceding the point to complete
+        size: Maximum number of characters kept from the end
+
+    Returns:
+        The last ``size`` characters with ``\\n`` line endings and no trailing whitespace per line
+    """
+    code = code.replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line.rstrip() for line in code.split('\n')]
+    return '\n'.join(lines).rstrip('\n')[-size:]
+
+
+def build_prompt(language, context):
+    return f"Complete the following {language} code:\n{context}"
+
+
+class HuggingFaceUpstream:
+    """Hugging Face inference API, one connection pool per event loop."""
+
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> AsyncClient
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            timeout = getattr(settings, 'AI_COMPLETION_TIMEOUT', 10)
+            connections = getattr(settings, 'AI_COMPLETION_MAX_CONNECTIONS', 20)
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout, connect=min(timeout, 3)),
+                limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+                headers={'Authorization': f"Bearer {getattr(settings, 'HUGGINGFACE_API_KEY', '')}"},
+            )
+        return client
+
+    def payload(self, prompt, stream=False):
+        return {
+            "inputs": prompt,
+            "parameters": {
+                "max_new_tokens": 64,
+                "return_full_text": False
+            },
+            "stream": stream
+        }
+
+    async def complete(self, prompt):
+        url = getattr(settings, 'AI_COMPLETION_URL', None)
+        try:
+            response = await self.client().post(url, json=self.payload(prompt))
+        except httpx.TimeoutException:
+            raise CompletionTimeout("Hugging Face API timed out")
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"Hugging Face API request failed: {str(e)}")
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise UpstreamError("Invalid response from Hugging Face API", response.status_code)
+        if response.status_code != 200:
+            raise UpstreamError("Hugging Face API returned an error", response.status_code, result)
+        if isinstance(result, list) and result:
+            return result[0].get("generated_text", "")
+        raise UpstreamError("Unexpected response format", response.status_code, result)
+
+    async def stream(self, prompt):
+        # Server-sent events, one "data: {...}" line per generated token
+        url = getattr(settings, 'AI_COMPLETION_URL', None)
+        try:
+            async with self.client().stream('POST', url, json=self.payload(prompt, stream=True)) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    try:
+                        details = json.loads(body)
+                    except ValueError:
+                        details = body.decode('utf-8', errors='replace')
+                    raise UpstreamError("Hugging Face API returned an error", response.status_code, details)
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    try:
+                        token = json.loads(line[len('data:'):]).get('token') or {}
+                    except (ValueError, AttributeError):
+                        raise UpstreamError("Invalid response from Hugging Face API", response.status_code)
+                    if token.get('text') and not token.get('special'):
+                        yield token['text']
+        except httpx.TimeoutException:
+            raise CompletionTimeout("Hugging Face API timed out")
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"Hugging Face API request failed: {str(e)}")
+
+
+class StubUpstream:
+    """Answers every prompt with ``suggestion`` after ``delay`` seconds, without network access."""
+
+    suggestion = "pass"
+    delay = 0
+
+    async def complete(self, prompt):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.suggestion
+
+    async def stream(self, prompt):
+        # Word by word, ``delay`` seconds apart
+        for token in re.findall(r'\s*\S+|\s+', self.suggestion):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield token
+
+
+class CompletionCache:
+    """Completions keyed by (language, context), least recently used first, expiring after ``ttl`` seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, suggestion)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            metrics.ai_cache_requests.inc(result='miss')
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.ai_cache_requests.inc(result='hit')
+        return entry[1]
+
+    def set(self, key, suggestion):
+        self._entries[key] = (time.monotonic() + self.ttl, suggestion)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class Completer:
+    def __init__(self, upstream=None, cache_size=None, cache_ttl=None):
+        self._upstream = upstream
+        self._upstream_path = None
+        self.cache = CompletionCache(
+            cache_size or getattr(settings, 'AI_COMPLETION_CACHE_SIZE', 1024),
+            cache_ttl or getattr(settings, 'AI_COMPLETION_CACHE_TTL', 5 * 60),
+        )
+        self._inflight = {}  # key -> task shared by identical requests
+        self.upstream_calls = 0
+
+    @property
+    def upstream(self):
+        path = getattr(settings, 'AI_COMPLETION_UPSTREAM', DEFAULT_UPSTREAM)
+        if self._upstream is None or (self._upstream_path is not None and self._upstream_path != path):
+            self._upstream = import_string(path)()
+            self._upstream_path = path
+        return self._upstream
+
+    async def complete(self, language, code):
+        """
+        Complete ``code``, from the cache or an upstream call shared with identical requests.
+
+        Args:
+            language: Language name used in the prompt
+            code: Code preceding the point to complete
+
+        Returns:
+            The suggested continuation
+
+        Raises:
+            UpstreamError: The model failed, CompletionTimeout if it took too long
+        """
+        context = normalize_context(code, getattr(settings, 'AI_COMPLETION_CONTEXT_CHARS', 2000))
+        key = (language, context)
+        suggestion = self.cache.get(key)
+        if suggestion is not None:
+            return suggestion
+
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch(key, build_prompt(language, context)))
+        # A caller giving up must not cancel the call for the others waiting on it
+        return await asyncio.shield(task)
+
+    async def stream(self, language, code):
+        """
+        Like ``complete``, but yields the suggestion in pieces as the upstream produces them.
+
+        A cached suggestion arrives in one piece. Streams are not shared
+        between callers, so closing one early stops its upstream request.
+
+        Raises:
+            UpstreamError: The model failed, CompletionTimeout if a piece took too long
+        """
+        context = normalize_context(code, getattr(settings, 'AI_COMPLETION_CONTEXT_CHARS', 2000))
+        key = (language, context)
+        suggestion = self.cache.get(key)
+        if suggestion is not None:
+            yield suggestion
+            return
+
+        upstream = self.upstream
+        prompt = build_prompt(language, context)
+        self.upstream_calls += 1
+        started = time.monotonic()
+        if not hasattr(upstream, 'stream'):
+            try:
+                suggestion = await asyncio.wait_for(
+                    upstream.complete(prompt), getattr(settings, 'AI_COMPLETION_TIMEOUT', 10)
+                )
+            except asyncio.TimeoutError:
+                metrics.ai_upstream_errors.inc(mode='stream')
+                raise CompletionTimeout("AI completion timed out")
+            except UpstreamError:
+                metrics.ai_upstream_errors.inc(mode='stream')
+                raise
+            metrics.ai_upstream_seconds.observe(time.monotonic() - started, mode='stream')
+            self.cache.set(key, suggestion)
+            yield suggestion
+            return
+
+        pieces = []
+        tokens = upstream.stream(prompt)
+        try:
+            while True:
+                try:
+                    token = await asyncio.wait_for(anext(tokens), getattr(settings, 'AI_COMPLETION_TIMEOUT', 10))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    metrics.ai_upstream_errors.inc(mode='stream')
+                    raise CompletionTimeout("AI completion timed out")
+                except UpstreamError:
+                    metrics.ai_upstream_errors.inc(mode='stream')
+                    raise
+                pieces.append(token)
+                yield token
+        finally:
+            await tokens.aclose()
+        # Time to the whole suggestion; a stream closed early is not counted
+        metrics.ai_upstream_seconds.observe(time.monotonic() - started, mode='stream')
+        self.cache.set(key, ''.join(pieces))
+
+    async def _fetch(self, key, prompt):
+        self.upstream_calls += 1
+        started = time.monotonic()
+        try:
+            suggestion = await asyncio.wait_for(
+                self.upstream.complete(prompt), getattr(settings, 'AI_COMPLETION_TIMEOUT', 10)
+            )
+        except asyncio.TimeoutError:
+            metrics.ai_upstream_errors.inc(mode='complete')
+            raise CompletionTimeout("AI completion timed out")
+        except UpstreamError:
+            metrics.ai_upstream_errors.inc(mode='complete')
+            raise
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+        metrics.ai_upstream_seconds.observe(time.monotonic() - started, mode='complete')
+        self.cache.set(key, suggestion)
+        return suggestion
+
+
+completer = Completer()
@@ -1,198 +1,452 @@
-import json
-import subprocess
-import tempfile
-import os
+import asyncio
+import time
+import uuid
 from datetime import datetime
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 import logging
 
+from .chat import chat_history
+from .completion import UpstreamError, completer
+from .cursors import cursor_coalescer
+from .documents import DesyncError, document_store
+from .execution import ExecutionRejected, execution_engine
+from .outbound import CODE_UPDATE, DOCUMENT, SNAPSHOT, OutboundQueue
+from .placement import REDIRECT_CLOSE_CODE, room_placement
+from .presence import presence_registry
+from .workers import get_job_queue, new_job
+from . import metrics, ot, wire
+
 logger = logging.getLogger(__name__)
 
+# Message types clients send, as counted in code_editor.metrics
+MESSAGE_TYPES = (
+    'cursor_update', 'code_delta', 'code_update', 'execute_code', 'ai_complete', 'ai_cancel',
+    'chat_message', 'chat_backfill',
+)
+
 class CodeEditorConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = f'code_{self.room_name}'
             self.user = self.scope["user"]
+            self.execution_tasks = set()
+            self.execution_jobs = {}  # job id -> {'job', 'shared', 'worker', 'deadline'} for runs on the worker tier
+            self.completion_task = None
+            subprotocol, self.wire_format = wire.negotiate(self.scope.get('subprotocols', []))
+            # Frames are queued so a slow reader never blocks this consumer
+            self.outbound = OutboundQueue(self.send_frame, self.encode, self.current_snapshot, self.close)
 
             # Join room group
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            await self.accept()
-            
-            # Notify others about the new user
+            room_placement.attach(self.room_name, self.channel_name)
+            await self.accept(subprotocol)
+
+            # Bring the new client up to date before any deltas reach it
+            self.document = await document_store.acquire(self.room_name)
+            await self.send_code_snapshot()
+            if get_job_queue() is None:
+                execution_engine.warm()
+
+            # Recent chat from memory; older pages are requested with chat_backfill
+            messages = await chat_history.recent(self.room_name)
+            await self.send_message({
+                'type': 'chat_history',
+                'messages': messages,
+                'has_more': len(messages) >= chat_history.history_size
+            })
+
+            # Register before the snapshot so the new member is in it
             username = self.user.username if self.user.is_authenticated else 'Anonymous'
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_join',
-                    'username': username
-                }
-            )
+            self.member_id = uuid.uuid4().hex
+            await presence_registry.join(self.room_group_name, self.member_id, username)
+            await self.send_message({
+                'type': 'presence',
+                'members': [
+                    {'member_id': member['member_id'], 'username': member['username']}
+                    for member in await presence_registry.members(self.room_group_name)
+                ]
+            })
+
+            # Notify others about the new user
+            await self.broadcast({
+                'type': 'user_join',
+                'frames': wire.encode_all({
+                    'type': 'system_message',
+                    'message': f"{username} joined the room",
+                    'timestamp': datetime.now().strftime('%I:%M %p'),
+                    'presence': {'event': 'join', 'member_id': self.member_id, 'username': username}
+                })
+            })
         except Exception as e:
             logger.error(f"WebSocket connection error: {str(e)}")
             await self.close()
 
     async def disconnect(self, close_code):
         try:
+            # Stop any programs this socket started
+            for task in list(getattr(self, 'execution_tasks', ())):
+                task.cancel()
+            for job_id, job in getattr(self, 'execution_jobs', {}).items():
+                if job['worker'] is not None:
+                    await self.channel_layer.send(job['worker'], {'type': 'execution.cancel', 'job_id': job_id})
+                else:
+                    # Still waiting for a worker; nobody would read its output
+                    await get_job_queue().remove(job['job'])
+            self.cancel_completion()
+            if hasattr(self, 'outbound'):
+                self.outbound.close()
+            cursor_coalescer.discard(self.room_group_name, self.channel_name)
+            room_placement.detach(self.room_name, self.channel_name)
+            member_id = getattr(self, 'member_id', None)
+            if member_id is not None:
+                await presence_registry.leave(self.room_group_name, member_id)
+
             # Notify others about the user leaving
             username = self.user.username if self.user.is_authenticated else 'Anonymous'
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_leave',
-                    'username': username
-                }
-            )
+            await self.broadcast({
+                'type': 'user_leave',
+                'frames': wire.encode_all({
+                    'type': 'system_message',
+                    'message': f"{username} left the room",
+                    'timestamp': datetime.now().strftime('%I:%M %p'),
+                    'presence': {'event': 'leave', 'member_id': member_id, 'username': username}
+                })
+            })
             
             # Leave room group
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
+
+            if hasattr(self, 'document'):
+                await document_store.release(self.room_name)
         except Exception as e:
             logger.error(f"WebSocket disconnect error: {str(e)}")
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = wire.decode(text_data, bytes_data)
+        except wire.WireError as e:
+            logger.info(f"Ignoring frame in {self.room_group_name}: {str(e)}")
+            return
         message_type = data.get('type')
+        started = time.perf_counter()
+        try:
+            await self.handle_message(message_type, data)
+        finally:
+            # Clients choose the type; unknown ones share a label
+            label = message_type if message_type in MESSAGE_TYPES else 'other'
+            metrics.observe_handler(self.room_name, label, time.perf_counter() - started)
+
+    async def handle_message(self, message_type, data):
         if message_type == 'cursor_update':
+            # Coalesced into the room's next cursor batch instead of sent right away
             username = self.user.username if self.user.is_authenticated else 'Anonymous'
-            await self.channel_layer.group_send(
-                self.room_group_name,{
-                    'type': 'broadcast_cursor_position',
-                    'username': username,
-                    'position': data['position'],
-                    'sender_channel': self.channel_name
-                }
+            cursor_coalescer.update(
+                self.channel_layer, self.room_group_name, self.channel_name, username, data['position']
             )
 
+        elif message_type == 'code_delta':
+            # Rebase the edit onto the room document and broadcast only the operation
+            try:
+                revision, operation = self.document.apply(data.get('revision'), data.get('operation'))
+            except DesyncError as e:
+                logger.info(f"Resyncing client in {self.room_group_name}: {str(e)}")
+                await self.send_code_snapshot()
+                return
+            await self.broadcast_delta(revision, operation, self.channel_name)
         elif message_type == 'code_update':
-            # Broadcast code update to all users in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_code_update',
-                    'code': data['code'],
-                    'sender_channel': self.channel_name  # Add sender channel to prevent echoing
-                }
-            )
+            # Legacy full-buffer update, applied as a single edit at the head revision
+            operation = ot.diff(self.document.text, data['code'])
+            if ot.is_noop(operation):
+                return
+            revision, operation = self.document.apply(self.document.revision, operation)
+            await self.broadcast_delta(revision, operation)
         elif message_type == 'execute_code':
-            # Execute the code and send back results
+            # Run in the background so edits and chat keep flowing meanwhile
             code = data['code']
             language = data.get('language', 'python')
-            
-            try:
-                output = await self.execute_code(code, language)
-                await self.send(text_data=json.dumps({
-                    'type': 'execution_result',
-                    'output': output
-                }))
-            except Exception as e:
-                await self.send(text_data=json.dumps({
-                    'type': 'execution_error',
-                    'error': str(e)
-                }))
+            task = asyncio.ensure_future(self.run_code(code, language, bool(data.get('share'))))
+            self.execution_tasks.add(task)
+            task.add_done_callback(self.execution_tasks.discard)
+        elif message_type == 'ai_complete':
+            # Only the newest request is wanted; the client has moved on from older ones
+            self.cancel_completion()
+            self.completion_task = asyncio.ensure_future(self.stream_completion(
+                data.get('request_id'), data.get('language', 'code'), data.get('prefix', '')
+            ))
+        elif message_type == 'ai_cancel':
+            self.cancel_completion()
         elif message_type == 'chat_message':
-            # Handle chat messages
+            # Handle chat messages; history is written in the background
             username = self.user.username if self.user.is_authenticated else 'Anonymous'
-            timestamp = datetime.now().strftime('%I:%M %p')  # 12-hour format
-            
+            message = await chat_history.record(self.room_name, username, data['message'])
+
             # Broadcast chat message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
+            await self.broadcast({
+                'type': 'chat_message',
+                'frames': wire.encode_all({
                     'type': 'chat_message',
-                    'message': data['message'],
-                    'username': username,
-                    'timestamp': timestamp
-                }
-            )
+                    'message': message['message'],
+                    'username': message['username'],
+                    'timestamp': message['timestamp'],
+                    'created_at': message['created_at']
+                })
+            })
+        elif message_type == 'chat_backfill':
+            # Older history, a page at a time before the oldest message the client has
+            try:
+                messages, has_more = await chat_history.history(self.room_name, data.get('before'))
+            except (TypeError, ValueError) as e:
+                logger.info(f"Ignoring backfill in {self.room_group_name}: {str(e)}")
+                return
+            await self.send_message({
+                'type': 'chat_history',
+                'messages': messages,
+                'has_more': has_more
+            })
+
+    async def broadcast(self, event):
+        # Counts members connected to this process; with room placement that is the whole room
+        metrics.room_fanout.observe(presence_registry.local_count(self.room_group_name), type=event['type'])
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def broadcast_delta(self, revision, operation, sender_channel=None):
+        await self.broadcast({
+            'type': 'broadcast_code_delta',
+            'revision': revision,
+            'sender_channel': sender_channel,
+            'frames': wire.encode_all({
+                'type': 'code_delta',
+                'revision': revision,
+                'operation': operation
+            })
+        })
+
+    def encode(self, message):
+        return wire.encode(message, self.wire_format)
+
+    async def send_message(self, message, kind=None):
+        self.outbound.put(self.encode(message), kind)
 
-    async def broadcast_code_update(self, event):
-        # Only send the update to other users
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'code_update',
-                'code': event['code']
-            }))
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_broadcast(self, event, kind=None):
+        # Encoded once by the sender for the whole room
+        self.outbound.put(event['frames'][self.wire_format], kind)
+
+    async def broadcast_code_delta(self, event):
+        # The sender already has the edit, it only needs the assigned revision
+        if event['sender_channel'] == self.channel_name:
+            await self.send_message({
+                'type': 'code_ack',
+                'revision': event['revision']
+            }, DOCUMENT)
+        else:
+            await self.send_broadcast(event, DOCUMENT)
+
+    def current_snapshot(self):
+        document = getattr(self, 'document', None)
+        if document is None:
+            return None
+        return {'type': 'code_snapshot', **document.snapshot()}
+
+    async def send_code_snapshot(self):
+        # Full document, only sent on join or when a client falls out of sync
+        await self.send_message(self.current_snapshot(), SNAPSHOT)
+
+    async def room_moved(self, event):
+        # The room is now served by another node; the client reconnects there
+        await self.send_message({'type': 'redirect', 'url': event['url'] + self.scope['path']})
+        await self.outbound.drain()
+        await self.close(code=REDIRECT_CLOSE_CODE)
 
     async def chat_message(self, event):
         # Send chat message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username'],
-            'timestamp': event['timestamp']
-        }))
+        await self.send_broadcast(event)
 
     async def code_update(self, event):
         # Send code update to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'code_update',
             'code': event['code']
-        }))
-    async def broadcast_cursor_position(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_update',
-                'username': event['username'],
-                'position': event['position']
-            }))
-
-    @database_sync_to_async
-    def execute_code(self, code, language):
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix=self.get_file_extension(language)) as temp:
-            temp.write(code)
-            temp.close()
+        }, CODE_UPDATE)
+    async def broadcast_cursor_batch(self, event):
+        # One frame per tick with everyone else's latest cursor
+        cursors = [
+            {'username': cursor['username'], 'position': cursor['position']}
+            for cursor in event['cursors']
+            if cursor['sender_channel'] != self.channel_name
+        ]
+        if not cursors:
+            return
+        frame = None
+        if len(cursors) == len(event['cursors']):
+            # Members who did not move share the same frame
+            frame = event['frames'][self.wire_format]
+        # Merged into a batch still waiting to be sent, if any
+        self.outbound.put_cursors(cursors, frame)
+
+    async def run_code(self, code, language, share_with_room=False):
+        # Runs are queued per user within the room
+        queue_key = (self.room_name, self.user.pk if self.user.is_authenticated else self.channel_name)
+
+        async def publish(message):
+            await self.publish_execution(message, share_with_room)
+
+        async def send_running():
+            await publish({
+                'type': 'execution_status',
+                'status': 'running'
+            })
+
+        async def send_output(stream, text):
+            # Stream output as it is produced instead of one blob at exit
+            await publish({
+                'type': 'execution_output',
+                'stream': stream,
+                'data': text
+            })
 
         try:
-            command = self.get_execution_command(language, temp.name)
-            result = subprocess.run(command, capture_output=True, text=True, timeout=10)
-            
-            # Combine stdout and stderr
-            output = result.stdout + result.stderr
-            return output
-        except subprocess.TimeoutExpired:
-            return "Execution timed out"
+            await publish({
+                'type': 'execution_status',
+                'status': 'queued'
+            })
+            # Runs shared with the room join an identical run in progress and reuse cached deterministic
+            # results, as every run does with EXECUTION_SHARE_RUNS, see code_editor.results
+            share = share_with_room or getattr(settings, 'EXECUTION_SHARE_RUNS', False)
+            job_queue = get_job_queue()
+            if job_queue is not None:
+                # Run by the worker tier, which answers with execution.reply messages
+                now = time.time()
+                for job_id, job in list(self.execution_jobs.items()):
+                    # Never answered: no worker was running, or the one running it died
+                    if now > job['deadline']:
+                        del self.execution_jobs[job_id]
+                if len(self.execution_jobs) >= execution_engine.queue_limit:
+                    raise ExecutionRejected("Too many runs queued, wait for the previous ones to finish")
+                job = new_job(self.channel_name, queue_key, code, language, share=share)
+                self.execution_jobs[job['id']] = {
+                    'job': job,
+                    'shared': share_with_room,
+                    'worker': None,
+                    'deadline': job['expires_at'] + execution_engine.timeout * execution_engine.queue_limit
+                }
+                await job_queue.push(job)
+                return
+            result = await execution_engine.run(
+                queue_key, code, language, on_start=send_running, on_output=send_output, share=share
+            )
+            await publish({
+                'type': 'execution_exit',
+                'exit_code': result['exit_code'],
+                'status': result['status'],
+                'usage': result['usage'],
+                'cached': result['cached']
+            })
+        except ExecutionRejected as e:
+            await self.send_message({
+                'type': 'execution_error',
+                'error': str(e)
+            })
         except Exception as e:
-            return f"Execution error: {str(e)}"
-        finally:
-            os.unlink(temp.name)
-
-    def get_file_extension(self, language):
-        extensions = {
-            'python': '.py',
-            'java': '.java',
-            'cpp': '.cpp',
-            'javascript': '.js'
-        }
-        return extensions.get(language, '.txt')
-
-    def get_execution_command(self, language, file_path):
-        commands = {
-            'python': ['python3', file_path],
-            'java': ['javac', file_path],
-            'cpp': ['g++', file_path, '-o', file_path + '_executable', '&&', file_path + '_executable'],
-            'javascript': ['node', file_path]
-        }
-        return commands.get(language, ['python3', file_path])
+            logger.error(f"Code execution error: {str(e)}")
+            await self.send_message({
+                'type': 'execution_error',
+                'error': str(e)
+            })
+
+    async def publish_execution(self, message, shared):
+        if shared:
+            # The whole room sees the run instead of each member running it again
+            username = self.user.username if self.user.is_authenticated else 'Anonymous'
+            await self.broadcast({
+                'type': 'execution_event',
+                'frames': wire.encode_all(dict(message, run_by=username))
+            })
+        else:
+            await self.send_message(message)
+
+    async def execution_accepted(self, event):
+        # A worker took one of our jobs off the queue
+        job = self.execution_jobs.get(event['job_id'])
+        if job is not None:
+            job['worker'] = event['worker']
+
+    async def execution_reply(self, event):
+        # Status, output, exit or error of a job run by an execution worker
+        job = self.execution_jobs.get(event['job_id'])
+        if job is None:
+            return
+        job['worker'] = event['worker']
+        frame = event['frame']
+        if frame['type'] in ('execution_exit', 'execution_error'):
+            del self.execution_jobs[event['job_id']]
+        if frame['type'] == 'execution_error':
+            await self.send_message(frame)
+        else:
+            await self.publish_execution(frame, job['shared'])
+
+    def cancel_completion(self):
+        # Cancelling closes the upstream request, so the model stops generating
+        task = getattr(self, 'completion_task', None)
+        if task is not None and not task.done():
+            task.cancel()
+        self.completion_task = None
+
+    async def stream_completion(self, request_id, language, prefix):
+        # The client sends a bounded window of code before the cursor
+        if not prefix.strip():
+            await self.send_message({
+                'type': 'ai_error',
+                'request_id': request_id,
+                'error': 'Nothing to complete'
+            })
+            return
+        try:
+            async for token in completer.stream(language, prefix):
+                await self.send_message({
+                    'type': 'ai_token',
+                    'request_id': request_id,
+                    'token': token
+                })
+            await self.send_message({
+                'type': 'ai_done',
+                'request_id': request_id
+            })
+        except UpstreamError as e:
+            await self.send_message({
+                'type': 'ai_error',
+                'request_id': request_id,
+                'error': str(e)
+            })
+        except Exception as e:
+            logger.error(f"AI completion error: {str(e)}")
+            await self.send_message({
+                'type': 'ai_error',
+                'request_id': request_id,
+                'error': 'AI completion failed'
+            })
+
+    async def execution_event(self, event):
+        # Status, output and exit of a run a member shared with the room
+        await self.send_broadcast(event)
 
     async def user_join(self, event):
         # Notify when a user joins the room
-        await self.send(text_data=json.dumps({
-            'type': 'system_message',
-            'message': f"{event['username']} joined the room",
-            'timestamp': datetime.now().strftime('%I:%M %p')
-        }))
+        await self.send_broadcast(event)
 
     async def user_leave(self, event):
         # Notify when a user leaves the room
-        await self.send(text_data=json.dumps({
-            'type': 'system_message',
-            'message': f"{event['username']} left the room",
-            'timestamp': datetime.now().strftime('%I:%M %p')
-        }))
\ No newline at end of file
+        await self.send_broadcast(event)
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+Cursor position coalescing for the room consumer.
+
+Clients report their caret on every mouse move and key press. Instead of a
+``group_send`` per report, positions are collected per room and sent as one
+batch per tick, at most ``CURSOR_TICK_RATE`` times a second. Only the latest
+position of each connection survives a tick, so a busy room costs one
+channel layer message per tick no matter how fast the mice move.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from . import wire
+
+logger = logging.getLogger(__name__)
+
+
+class CursorCoalescer:
+    def __init__(self, tick_rate=None):
+        self._tick_rate = tick_rate
+        self._pending = {}  # group -> {channel_name: cursor}
+        self._flushing = {}  # group -> task waiting for the next tick
+
+    @property
+    def interval(self):
+        return 1 / (self._tick_rate or getattr(settings, 'CURSOR_TICK_RATE', 25))
+
+    def update(self, channel_layer, group, channel_name, username, position):
+        """
+        Record a connection's cursor; it is sent with the room's next tick.
+
+        Args:
+            channel_layer: Layer to send the batch through
+            group: Room group name
+            channel_name: Connection the cursor belongs to
+            username: Name shown next to the cursor
+            position: Cursor position as sent by the client
+        """
+        # Later positions from the same connection replace earlier ones
+        self._pending.setdefault(group, {})[channel_name] = {
+            'username': username,
+            'position': position,
+            'sender_channel': channel_name,
+        }
+        task = self._flushing.get(group)
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._flushing[group] = asyncio.ensure_future(self._flush_later(channel_layer, group))
+
+    def discard(self, group, channel_name):
+        """Drop a connection's unsent cursor, e.g. when it disconnects."""
+        pending = self._pending.get(group)
+        if pending is not None:
+            pending.pop(channel_name, None)
+
+    async def _flush_later(self, channel_layer, group):
+        await asyncio.sleep(self.interval)
+        cursors = self._pending.pop(group, None)
+        self._flushing.pop(group, None)
+        if not cursors:
+            return
+        try:
+            cursors = list(cursors.values())
+            await channel_layer.group_send(group, {
+                'type': 'broadcast_cursor_batch',
+                'cursors': cursors,
+                # The batch as members who are not in it receive it
+                'frames': wire.encode_all({
+                    'type': 'cursor_batch',
+                    'cursors': [{'username': cursor['username'], 'position': cursor['position']} for cursor in cursors]
+                }),
+            })
+        except Exception as e:
+            logger.error(f"Cursor batch error for {group}: {str(e)}")
+
+
+cursor_coalescer = CursorCoalescer()
@@ -0,0 +1,261 @@
+"""
+Per-room document state for the collaborative editor.
+
+Each room keeps its current text, a revision counter and a bounded history
+of applied operations. Clients send operations against the revision they
+last saw; the operation is transformed against everything applied since and
+then appended to the history.
+
+The process serving a room holds the authoritative copy in memory. Edits are
+mirrored to Redis and flushed to the ``CodeDocument`` table in the
+background, so keystrokes never wait on a write.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import ot
+
+logger = logging.getLogger(__name__)
+
+# Number of applied operations kept for transforming late edits
+HISTORY_LIMIT = 500
+
+
+class DesyncError(Exception):
+    """Raised when an edit cannot be rebased and the client needs a snapshot."""
+
+
+class RoomDocument:
+    def __init__(self, text='', revision=0, history_limit=HISTORY_LIMIT):
+        self.text = text
+        self.revision = revision
+        self.history = deque(maxlen=history_limit)
+        # Revisions last written to Redis and to the database
+        self.synced_revision = revision
+        self.flushed_revision = revision
+
+    def snapshot(self):
+        return {'code': self.text, 'revision': self.revision}
+
+    def apply(self, base_revision, operation):
+        """
+        Rebase a client operation onto the current revision and apply it.
+
+        Args:
+            base_revision: Revision the client created the operation against
+            operation: List of ot components
+
+        Returns:
+            (revision, operation) - the new revision and the operation as applied
+        """
+        if not isinstance(base_revision, int) or base_revision > self.revision:
+            raise DesyncError(f"Unknown base revision {base_revision!r}")
+
+        # Only the last ``len(history)`` revisions can be rebased
+        missed = self.revision - base_revision
+        if missed > len(self.history):
+            raise DesyncError(f"Revision {base_revision} is too old to rebase")
+
+        try:
+            operation = ot.normalize(operation)
+            for concurrent in list(self.history)[len(self.history) - missed:]:
+                operation, _ = ot.transform(operation, concurrent)
+            text = ot.apply(self.text, operation)
+        except ot.OperationError as e:
+            raise DesyncError(str(e))
+
+        self.text = text
+        self.revision += 1
+        self.history.append(operation)
+        return self.revision, operation
+
+    def replace(self, text):
+        """Apply a full-buffer replacement as an operation at the head revision."""
+        return self.apply(self.revision, ot.diff(self.text, text))
+
+
+class DocumentStore:
+    """
+    Authoritative documents for the rooms served by this process.
+
+    A document stays in memory while its room has members. A background task
+    mirrors changed documents to Redis every ``DOCUMENT_SYNC_INTERVAL`` seconds
+    and writes them to the database every ``DOCUMENT_FLUSH_INTERVAL`` seconds,
+    so a burst of edits costs a single write. When the last member leaves the
+    room is flushed and dropped from memory.
+
+    Only one process should serve a given room at a time; a cold load takes
+    the Redis copy first and falls back to the database.
+    """
+    key_prefix = 'codecolab:document:'
+
+    def __init__(self):
+        self._documents = {}
+        self._members = {}
+        self._loading = {}
+        self._task = None
+        self._redis = None
+        self._last_flush = time.monotonic()
+
+    @property
+    def sync_interval(self):
+        return getattr(settings, 'DOCUMENT_SYNC_INTERVAL', 1.0)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'DOCUMENT_FLUSH_INTERVAL', 10.0)
+
+    def _get_redis(self):
+        url = getattr(settings, 'DOCUMENT_REDIS_URL', None)
+        if not url:
+            return None
+        if self._redis is None:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(url)
+        return self._redis
+
+    async def acquire(self, room_name):
+        """Register a room member and return the room's document."""
+        # Counted before loading, so a member leaving meanwhile does not evict the room
+        self._members[room_name] = self._members.get(room_name, 0) + 1
+        document = self._documents.get(room_name)
+        if document is None:
+            # Several members can join a cold room at once; load it only once
+            loading = self._loading.get(room_name)
+            if loading is None:
+                loading = self._loading[room_name] = asyncio.ensure_future(self._load(room_name))
+            try:
+                # A member giving up must not cancel the load for the others
+                document = await asyncio.shield(loading)
+            except BaseException:
+                # Also on cancellation: the consumer only releases a document it got
+                self._forget_member(room_name)
+                raise
+            finally:
+                self._loading.pop(room_name, None)
+            self._documents.setdefault(room_name, document)
+            document = self._documents[room_name]
+        self._ensure_flusher()
+        return document
+
+    async def release(self, room_name):
+        """Unregister a room member, flushing and evicting the room when it empties."""
+        if self._forget_member(room_name):
+            return
+        document = self._documents.get(room_name)
+        if document is not None:
+            await self._sync({room_name: document})
+            await self._flush({room_name: document})
+            # Someone may have rejoined while the flush was in progress
+            if room_name not in self._members:
+                self._documents.pop(room_name, None)
+
+    def _forget_member(self, room_name):
+        """Drop one member of a room and return how many are left."""
+        count = self._members.get(room_name, 0) - 1
+        if count > 0:
+            self._members[room_name] = count
+            return count
+        self._members.pop(room_name, None)
+        return 0
+
+    def get(self, room_name):
+        return self._documents.get(room_name)
+
+    def member_count(self, room_name):
+        """Members of a room connected to this process."""
+        return self._members.get(room_name, 0)
+
+    async def _load(self, room_name):
+        client = self._get_redis()
+        if client is not None:
+            try:
+                cached = await client.hgetall(self.key_prefix + room_name)
+                if cached:
+                    return RoomDocument(cached[b'text'].decode(), int(cached[b'revision']))
+            except Exception as e:
+                logger.error(f"Document cache read error for {room_name}: {str(e)}")
+        return await self._load_from_db(room_name)
+
+    @database_sync_to_async
+    def _load_from_db(self, room_name):
+        from .models import CodeDocument
+
+        stored = CodeDocument.objects.filter(room_name=room_name).first()
+        if stored is None:
+            return RoomDocument()
+        return RoomDocument(stored.content, stored.revision)
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._documents:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.flush_pending()
+            except Exception as e:
+                logger.error(f"Document flush error: {str(e)}")
+
+    async def flush_pending(self, force=False):
+        """Mirror changed documents to Redis and, once per flush interval, to the database."""
+        documents = dict(self._documents)
+        await self._sync(documents)
+        if force or time.monotonic() - self._last_flush >= self.flush_interval:
+            self._last_flush = time.monotonic()
+            await self._flush(documents)
+
+    async def _sync(self, documents):
+        client = self._get_redis()
+        changed = {
+            name: (document, document.revision, document.text)
+            for name, document in documents.items()
+            if document.synced_revision != document.revision
+        }
+        if client is None or not changed:
+            return
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                for name, (_, revision, text) in changed.items():
+                    key = self.key_prefix + name
+                    pipe.hset(key, mapping={'text': text, 'revision': revision})
+                    pipe.expire(key, 60 * 60 * 24)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Document cache write error: {str(e)}")
+            return
+        for document, revision, _ in changed.values():
+            document.synced_revision = revision
+
+    async def _flush(self, documents):
+        changed = {
+            name: (document, document.revision, document.text)
+            for name, document in documents.items()
+            if document.flushed_revision != document.revision
+        }
+        if not changed:
+            return
+        await self._write_rows([(name, text, revision) for name, (_, revision, text) in changed.items()])
+        for document, revision, _ in changed.values():
+            document.flushed_revision = revision
+
+    @database_sync_to_async
+    def _write_rows(self, rows):
+        from .models import CodeDocument
+
+        CodeDocument.objects.bulk_create(
+            [CodeDocument(room_name=name, content=text, revision=revision) for name, text, revision in rows],
+            update_conflicts=True,
+            unique_fields=['room_name'],
+            update_fields=['content', 'revision', 'updated_at'],
+        )
+
+
+document_store = DocumentStore()
@@ -0,0 +1,435 @@
+"""
+Asynchronous code execution for the room consumer.
+
+Runs are started with ``asyncio.create_subprocess_exec`` so a slow program
+never occupies a thread. A process-wide semaphore bounds how many programs
+run at once and every (room, user) pair gets its own FIFO queue, so one user
+clicking Run repeatedly cannot starve the rest of the room.
+
+Output is read from the program's pipes in chunks and handed to an
+``on_output`` callback as it arrives. The callback is awaited before the
+next read, so a slow consumer stalls the program on a full pipe instead of
+buffering without bound, and output past ``EXECUTION_OUTPUT_LIMIT`` bytes is
+cut off and the program killed.
+
+Python and JavaScript runs go to pre-warmed interpreters from
+code_editor.interpreters when ``EXECUTION_WARM_WORKERS`` is above zero, and
+compiled programs are exec'd from the Python fork server. Every program runs
+in its own session so a kill takes its children too.
+
+Each run is held to CPU-time, memory, process-count and file-size rlimits so
+a runaway program cannot starve the server process next to it. Programs
+started here get them through prlimit(1) rather than a ``preexec_fn``, which
+is unsafe in a process with threads. The result
+carries the run's wall time, CPU time and peak RSS, which are also logged
+for monitoring; CPU time and peak RSS are None for runs started without a
+warm worker.
+
+Runs made with ``share`` join an identical run in progress and reuse cached
+results of deterministic programs, see code_editor.results. With
+``EXECUTION_QUEUE_URL`` set, room runs are made by out-of-process workers
+instead of the server process, see code_editor.workers.
+"""
+import asyncio
+import codecs
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .compilation import artifact_cache, is_compiled
+from .forkserver import limited_command
+from .interpreters import interpreter_pools, program_env
+from .results import SharedRun, replay, result_cache, result_key
+
+logger = logging.getLogger(__name__)
+
+
+# Bytes read from a pipe per output chunk
+CHUNK_SIZE = 4096
+
+TRUNCATION_MARKER = "\n[output truncated]\n"
+
+USAGE_FIELDS = ('wall_ms', 'cpu_ms', 'peak_rss_kb')
+
+
+class ExecutionRejected(Exception):
+    """Raised when a user already has too many runs queued."""
+
+
+class _OutputSink:
+    """Collects output from both pipes and enforces the byte limit."""
+
+    def __init__(self, limit, on_output):
+        self.limit = limit
+        self.on_output = on_output
+        self.size = 0
+        self.parts = []
+        self.truncated = False
+
+    async def write(self, stream, text, size):
+        self.size += size
+        self.parts.append(text)
+        if self.on_output is not None and text:
+            await self.on_output(stream, text)
+
+    def remaining(self):
+        return self.limit - self.size
+
+    async def truncate(self):
+        self.truncated = True
+        await self.write('stderr', TRUNCATION_MARKER, 0)
+
+    @property
+    def output(self):
+        return ''.join(self.parts)
+
+    def result(self, exit_code, status, usage=None):
+        usage = usage or {}
+        return {
+            'output': self.output,
+            'exit_code': exit_code,
+            'status': status,
+            'usage': {field: usage.get(field) for field in USAGE_FIELDS},
+        }
+
+
+def get_file_extension(language):
+    extensions = {
+        'python': '.py',
+        'javascript': '.js'
+    }
+    return extensions.get(language, '.txt')
+
+
+def get_execution_command(language, file_path):
+    # Compiled languages are built by code_editor.compilation instead
+    commands = {
+        'python': ['python3', file_path],
+        'javascript': ['node', file_path]
+    }
+    return commands.get(language, ['python3', file_path])
+
+
+class ExecutionEngine:
+    def __init__(self, concurrency=None, queue_limit=None, timeout=None, output_limit=None,
+                 artifacts=None, pools=None, limits=None, results=None):
+        self.artifacts = artifacts or artifact_cache
+        self.results = results or result_cache
+        self.pools = interpreter_pools if pools is None else pools
+        self._concurrency = concurrency
+        self._queue_limit = queue_limit
+        self._timeout = timeout
+        self._output_limit = output_limit
+        self._limits = limits
+        self._loop = None
+        self._semaphore = None
+        self._queues = {}
+        self._shared = {}  # result key -> results.SharedRun in progress
+
+    # Settings are read lazily, the engine is created at import time
+    @property
+    def concurrency(self):
+        return self._concurrency or getattr(settings, 'EXECUTION_CONCURRENCY', os.cpu_count() or 1)
+
+    @property
+    def queue_limit(self):
+        return self._queue_limit or getattr(settings, 'EXECUTION_QUEUE_LIMIT', 3)
+
+    @property
+    def timeout(self):
+        return self._timeout or getattr(settings, 'EXECUTION_TIMEOUT', 10)
+
+    @property
+    def output_limit(self):
+        return self._output_limit or getattr(settings, 'EXECUTION_OUTPUT_LIMIT', 64 * 1024)
+
+    @property
+    def limits(self):
+        """Resource limits per run, keyed like forkserver.RESOURCES."""
+        if self._limits is not None:
+            return self._limits
+        return {
+            'cpu': getattr(settings, 'EXECUTION_CPU_LIMIT', self.timeout),
+            'memory': getattr(settings, 'EXECUTION_MEMORY_LIMIT', 256 * 1024 * 1024),
+            'processes': getattr(settings, 'EXECUTION_MAX_PROCESSES', 128),
+            'file_size': getattr(settings, 'EXECUTION_FILE_SIZE_LIMIT', 1024 * 1024),
+        }
+
+    def _bind(self):
+        # asyncio primitives belong to one event loop; rebuild them if the loop changed
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._queues = {}
+            self._shared = {}
+
+    def warm(self):
+        """Start the warm interpreter pools if they are not running yet."""
+        for pool in self.pools.values():
+            if pool.size > 0:
+                pool.warm()
+
+    async def run(self, key, code, language, on_start=None, on_output=None, share=False):
+        """
+        Queue a run for ``key`` and execute it once a slot is free.
+
+        Args:
+            key: Queue the run belongs to, e.g. (room_name, user id)
+            code: Source code to execute
+            language: One of the languages in get_execution_command
+            on_start: Optional coroutine function awaited when the program starts
+            on_output: Optional coroutine function awaited with (stream, text)
+                for every chunk of output
+            share: Join an identical run already in progress, and reuse or
+                cache the result of deterministic programs, see code_editor.results
+
+        Returns:
+            Dictionary with the combined ``output``, the ``exit_code``, a
+            ``status`` of 'exited', 'timeout', 'cpu_limit', 'truncated',
+            'compile_error' or 'failed', and the run's ``usage`` as
+            ``wall_ms``, ``cpu_ms`` and ``peak_rss_kb``, and whether the
+            result was ``cached``
+        """
+        self._bind()
+        if not share:
+            queue = self._admit(key)
+            try:
+                return dict(await self._run_queued(queue, code, language, on_start, on_output), cached=False)
+            finally:
+                self._release(key, queue)
+
+        shared_key = result_key(language, code)
+        cached = self.results.get(shared_key)
+        if cached is not None:
+            return await replay(cached, on_start, on_output)
+        shared = self._shared.get(shared_key)
+        if shared is None:
+            # Only the request starting the run takes a place in its user's queue
+            queue = self._admit(key)
+            shared = self._shared[shared_key] = SharedRun()
+            shared.task = asyncio.ensure_future(
+                self._run_queued(queue, code, language, shared.start, shared.output)
+            )
+            shared.task.add_done_callback(
+                lambda task: self._finish_shared(key, queue, shared_key, language, code, shared)
+            )
+        return await shared.follow(on_start, on_output)
+
+    def _admit(self, key):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = {'lock': asyncio.Lock(), 'pending': 0}
+        if queue['pending'] >= self.queue_limit:
+            raise ExecutionRejected("Too many runs queued, wait for the previous ones to finish")
+        queue['pending'] += 1
+        return queue
+
+    def _release(self, key, queue):
+        queue['pending'] -= 1
+        if not queue['pending'] and self._queues.get(key) is queue:
+            del self._queues[key]
+
+    async def _run_queued(self, queue, code, language, on_start, on_output):
+        label = language if language in ('python', 'javascript') or is_compiled(language) else 'other'
+        queued = time.monotonic()
+        async with queue['lock'], self._semaphore:
+            started = time.monotonic()
+            metrics.execution_queue_seconds.observe(started - queued, language=label)
+            try:
+                if on_start is not None:
+                    await on_start()
+                return await self._execute(code, language, on_output)
+            finally:
+                metrics.execution_run_seconds.observe(time.monotonic() - started, language=label)
+
+    def _finish_shared(self, key, queue, shared_key, language, code, shared):
+        # Done callback of a shared run, also when it failed or was cancelled before starting
+        self._release(key, queue)
+        if self._shared.get(shared_key) is shared:
+            del self._shared[shared_key]
+        if not shared.task.cancelled() and shared.task.exception() is None:
+            self.results.store(shared_key, language, code, shared.task.result(), shared.chunks)
+
+    async def _execute(self, code, language, on_output):
+        sink = _OutputSink(self.output_limit, on_output)
+        workdir = tempfile.mkdtemp(prefix='codecolab-')
+        try:
+            result = await self._dispatch(code, language, workdir, sink)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        usage = result['usage']
+        logger.info(
+            f"Run finished: language={language} status={result['status']} exit_code={result['exit_code']} "
+            f"wall_ms={usage['wall_ms']} cpu_ms={usage['cpu_ms']} peak_rss_kb={usage['peak_rss_kb']}"
+        )
+        return result
+
+    async def _dispatch(self, code, language, workdir, sink):
+        pool = self.pools.get(language)
+        if pool is not None and pool.size > 0:
+            return await self._run_warm(pool, code, workdir, sink)
+
+        if not is_compiled(language):
+            file_path = os.path.join(workdir, 'main' + get_file_extension(language))
+            with open(file_path, 'w') as source:
+                source.write(code)
+            return await self._spawn(get_execution_command(language, file_path), workdir, sink)
+
+        # Unchanged sources reuse the cached build and skip the compiler
+        async with self.artifacts.checkout(language, code) as artifact:
+            if artifact['error'] is not None:
+                error = artifact['error'].encode()[:self.output_limit]
+                await sink.write('stderr', error.decode(errors='replace'), len(error))
+                return sink.result(None, 'compile_error')
+            # The fork server execs the binary and reports its resource usage
+            forkserver = self.pools.get('python')
+            if forkserver is not None and forkserver.size > 0:
+                return await self._run_warm(forkserver, code, workdir, sink, argv=artifact['command'])
+            return await self._spawn(artifact['command'], workdir, sink)
+
+    async def _spawn(self, command, workdir, sink):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *limited_command(command, self.limits),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=workdir,
+                env=program_env(),
+                start_new_session=True,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            await sink.write('stderr', f"Execution error: {str(e)}", 0)
+            return sink.result(None, 'failed')
+
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        return await self._supervise(process, sink, kill)
+
+    async def _run_warm(self, pool, code, workdir, sink, argv=None):
+        try:
+            async with pool.checkout() as worker:
+                marker = await worker.submit(code, workdir, self.limits, argv)
+                result = await self._supervise(worker.process, sink, worker.kill, marker)
+                result['usage'].update(worker.read_usage())
+                if result['exit_code'] is None:
+                    worker.reusable = False
+                return result
+        except OSError as e:
+            await sink.write('stderr', f"Execution error: {str(e)}", 0)
+            return sink.result(None, 'failed')
+
+    async def _supervise(self, process, sink, kill, marker=None):
+        """
+        Pump a running program's output into ``sink`` until it finishes.
+
+        With a ``marker`` the process is a reusable worker: the run is over
+        once the marker and the usage report have been read from both pipes.
+        """
+        status = 'exited'
+        started = time.monotonic()
+        try:
+            exit_code, usage = await asyncio.wait_for(
+                self._communicate(process, sink, kill, marker), self.timeout
+            )
+        except asyncio.TimeoutError:
+            kill()
+            await process.wait()
+            status, exit_code, usage = 'timeout', None, {}
+        except asyncio.CancelledError:
+            # The socket went away; do not leave the program running
+            kill()
+            await process.wait()
+            raise
+        usage['wall_ms'] = round((time.monotonic() - started) * 1000)
+        if exit_code == -signal.SIGXCPU:
+            status = 'cpu_limit'
+        if sink.truncated:
+            status, exit_code = 'truncated', None
+        return sink.result(exit_code, status, usage)
+
+    async def _communicate(self, process, sink, kill, marker):
+        """
+        Returns:
+            (exit_code, usage) - usage holds whatever the worker reported
+        """
+        stdout_end, stderr_end = await asyncio.gather(
+            self._pump(process.stdout, 'stdout', sink, kill, marker),
+            self._pump(process.stderr, 'stderr', sink, kill, marker),
+        )
+        if marker is not None:
+            if stdout_end is None or stderr_end is None:
+                return None, {}
+            usage = json.loads(stderr_end)
+            return usage.pop('exit_code'), usage
+        await process.wait()
+        return process.returncode, {}
+
+    async def _pump(self, pipe, stream, sink, kill, marker):
+        """
+        Forward one pipe to the sink.
+
+        Returns:
+            The usage report written after ``marker``, or None at end of file
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = b''
+        while not sink.truncated:
+            data = await pipe.read(CHUNK_SIZE)
+            if not data:
+                await self._forward(stream, pending, decoder, sink, kill, final=True)
+                return None
+            if marker is None:
+                await self._forward(stream, data, decoder, sink, kill)
+                continue
+
+            data = pending + data
+            index = data.find(marker)
+            if index != -1:
+                await self._forward(stream, data[:index], decoder, sink, kill, final=True)
+                trailer = data[index + len(marker):]
+                while b'\n' not in trailer:
+                    more = await pipe.read(CHUNK_SIZE)
+                    if not more:
+                        return None
+                    trailer += more
+                return trailer.split(b'\n', 1)[0].decode()
+
+            # Hold back a tail that could be the start of a split marker
+            hold = _marker_prefix_length(data, marker)
+            pending = data[len(data) - hold:]
+            await self._forward(stream, data[:len(data) - hold], decoder, sink, kill)
+        return None
+
+    @staticmethod
+    async def _forward(stream, data, decoder, sink, kill, final=False):
+        if len(data) > sink.remaining():
+            data = data[:max(sink.remaining(), 0)]
+            await sink.write(stream, decoder.decode(data, final=True), len(data))
+            await sink.truncate()
+            kill()
+            return
+        await sink.write(stream, decoder.decode(data, final=final), len(data))
+
+
+def _marker_prefix_length(data, marker):
+    """Length of the longest suffix of ``data`` that is a prefix of ``marker``."""
+    for length in range(min(len(marker) - 1, len(data)), 0, -1):
+        if data.endswith(marker[:length]):
+            return length
+    return 0
+
+
+execution_engine = ExecutionEngine()
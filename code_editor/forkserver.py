@@ -0,0 +1,299 @@
+"""
+Python fork server used by code_editor.interpreters.
+
+Runs as a standalone script (no Django imports). The interpreter starts once
+and forks a child per job, so a run only pays for ``fork`` instead of a full
+interpreter start-up.
+
+Protocol on stdin, read unbuffered so nothing is buffered in memory a child
+could inspect:
+
+    <4-byte big-endian header length><JSON header><source>
+    <nonce line>
+
+The header holds ``length`` (bytes of source), ``cwd``, the resource
+``limits`` for the run and optionally ``argv``, a compiled program to exec
+instead of running the source. The nonce line is only read after the child
+has exited, then ``\\0<nonce>\\0<JSON usage>\\n`` is written to both stdout and
+stderr so the reader knows all output of the run has arrived. The usage
+holds the ``exit_code``, ``cpu_ms`` and ``peak_rss_kb`` of the run.
+
+Each child runs in its own process group. SIGTERM kills the running child's
+group and then the server itself.
+
+Children never get the server's stdout and stderr: each has pipes of its own,
+which the server forwards while it runs. Once the child has exited its group
+is killed, what is left in the pipes is read and they are closed, so a
+process that escaped the group (with ``setsid``) cannot write into the output
+of the runs the server makes after it.
+"""
+import builtins
+import json
+import os
+import resource
+import select
+import signal
+import struct
+import sys
+import time
+import traceback
+
+# Warm the modules most snippets import
+import collections  # noqa: F401
+import functools  # noqa: F401
+import itertools  # noqa: F401
+import math
+import random  # noqa: F401
+import re  # noqa: F401
+
+
+def read_exact(size):
+    chunks = []
+    while size:
+        chunk = os.read(0, size)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_line():
+    chunks = []
+    while True:
+        char = os.read(0, 1)
+        if not char:
+            raise EOFError
+        if char == b'\n':
+            return b''.join(chunks)
+        chunks.append(char)
+
+
+# Resource limit names used in the job header; memory limits the data segment
+# rather than the address space, which V8 and the JVM reserve generously
+RESOURCES = {
+    'cpu': resource.RLIMIT_CPU,
+    'memory': resource.RLIMIT_DATA,
+    'processes': resource.RLIMIT_NPROC,
+    'file_size': resource.RLIMIT_FSIZE,
+}
+
+
+# prlimit(1) options for the RESOURCES names
+PRLIMIT_OPTIONS = {
+    'cpu': '--cpu',
+    'memory': '--data',
+    'processes': '--nproc',
+    'file_size': '--fsize',
+}
+
+
+def _limit(name, value, hard):
+    # (soft, hard) for a limit of ``value``, never above the current hard limit
+    value = math.ceil(value)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    if name == 'cpu':
+        # SIGXCPU at the soft limit, SIGKILL a second later
+        return value, value + 1 if hard == resource.RLIM_INFINITY else hard
+    return value, value
+
+
+def apply_limits(limits, pid=0):
+    """
+    Lower the resource limits of a process.
+
+    Args:
+        limits: Dictionary of RESOURCES names to limits; 0 or None skips one
+        pid: Process to limit, 0 for the calling process
+    """
+    for name, value in limits.items():
+        if not value:
+            continue
+        _, hard = resource.prlimit(pid, RESOURCES[name])
+        resource.prlimit(pid, RESOURCES[name], _limit(name, value, hard))
+
+
+def limited_command(command, limits):
+    """
+    Wrap a command in prlimit(1) so it starts under resource limits.
+
+    For processes started from the threaded server, where setting limits in
+    a ``preexec_fn`` between fork and exec can deadlock.
+
+    Args:
+        command: argv to run
+        limits: Dictionary of RESOURCES names to limits; 0 or None skips one
+    """
+    options = []
+    for name, value in limits.items():
+        if not value:
+            continue
+        _, hard = resource.getrlimit(RESOURCES[name])
+        options.append('{}={}:{}'.format(PRLIMIT_OPTIONS[name], *_limit(name, value, hard)))
+    return ['prlimit', *options, '--', *command] if options else list(command)
+
+
+# Seconds spent reading what a finished run left in its pipes
+DRAIN_TIMEOUT = 0.1
+
+current_child = None
+
+
+def terminate(signum, frame):
+    if current_child is not None:
+        try:
+            os.killpg(current_child, signal.SIGKILL)
+            os.waitpid(current_child, 0)
+        except OSError:
+            pass
+    os._exit(1)
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def forward(pid, pipes):
+    """
+    Copy a child's output to ours until it exits, then kill its group and drain the pipes.
+
+    Args:
+        pid: The child, also its process group
+        pipes: Dictionary of read ends to the file descriptor they are copied to
+    """
+    pidfd = os.pidfd_open(pid)
+    deadline = None
+    try:
+        while pipes:
+            watched = list(pipes) if deadline else list(pipes) + [pidfd]
+            timeout = max(deadline - time.monotonic(), 0) if deadline else None
+            ready, _, _ = select.select(watched, [], [], timeout)
+            if not ready:
+                break
+            for fd in ready:
+                if fd == pidfd:
+                    # Kill anything the run left behind in its process group
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                    deadline = time.monotonic() + DRAIN_TIMEOUT
+                    continue
+                data = os.read(fd, 65536)
+                if data:
+                    write_all(pipes[fd], data)
+                else:
+                    del pipes[fd]
+    finally:
+        os.close(pidfd)
+
+
+def run_child(header, source, stdout, stderr):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+    # Drop the job pipe and the server's output before user code runs, and give the run its own group
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(stdout[1], 1)
+    os.dup2(stderr[1], 2)
+    for fd in stdout + stderr:
+        os.close(fd)
+    os.setpgid(0, 0)
+    os.chdir(header['cwd'])
+    apply_limits(header.get('limits', {}))
+
+    if header.get('argv'):
+        try:
+            os.execvp(header['argv'][0], header['argv'])
+        except OSError as e:
+            os.write(2, f"Execution error: {str(e)}\n".encode())
+            os._exit(127)
+
+    sys.path[0] = header['cwd']
+    sys.argv = ['main.py']
+    sys.stdout.reconfigure(line_buffering=True, write_through=False)
+
+    status = 0
+    try:
+        code = compile(source, 'main.py', 'exec')
+        exec(code, {'__name__': '__main__', '__file__': 'main.py', '__builtins__': builtins})
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except BaseException as e:
+        # Skip this frame so the traceback starts in the user's code
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status & 0xff)
+
+
+def main():
+    global current_child
+    signal.signal(signal.SIGTERM, terminate)
+    while True:
+        try:
+            (header_length,) = struct.unpack('>I', read_exact(4))
+            header = json.loads(read_exact(header_length))
+            source = read_exact(header['length']).decode('utf-8', errors='replace')
+        except EOFError:
+            return
+
+        # Hold SIGTERM until the child is recorded so it can never be orphaned
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        stdout, stderr = os.pipe(), os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            run_child(header, source, stdout, stderr)
+        os.close(stdout[1])
+        os.close(stderr[1])
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        current_child = pid
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+        try:
+            forward(pid, {stdout[0]: 1, stderr[0]: 2})
+        finally:
+            os.close(stdout[0])
+            os.close(stderr[0])
+        _, wait_status, usage = os.wait4(pid, 0)
+        exit_code = os.waitstatus_to_exitcode(wait_status)
+        # Also when the child closed its pipes before exiting
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        current_child = None
+
+        try:
+            nonce = read_line()
+        except EOFError:
+            return
+        report = json.dumps({
+            'exit_code': exit_code,
+            'cpu_ms': round((usage.ru_utime + usage.ru_stime) * 1000),
+            'peak_rss_kb': usage.ru_maxrss,
+        })
+        trailer = b'\0' + nonce + b'\0' + report.encode() + b'\n'
+        os.write(1, trailer)
+        os.write(2, trailer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Pre-warmed interpreter workers for Python and JavaScript runs.
+
+Starting ``python3`` or ``node`` costs tens of milliseconds, which dominates
+small snippets. Each pool keeps ``EXECUTION_WARM_WORKERS`` interpreters
+started ahead of time:
+
+    - Python uses a fork server (code_editor/forkserver.py) that forks a fresh
+      child per run and is recycled after ``EXECUTION_WORKER_MAX_RUNS`` runs.
+    - Node cannot fork, so its pool keeps idle ``node`` processes waiting for
+      source on stdin; each runs once and a replacement is started behind it.
+
+A worker that timed out, was cancelled or hit the output cap is killed
+rather than reused. Resource limits are applied per run: the fork server
+sets them in each child, and standby Node processes get them with
+``prlimit`` just before the program is handed over.
+"""
+import abc
+import asyncio
+import json
+import os
+import secrets
+import signal
+import struct
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+from .forkserver import apply_limits
+
+
+def program_env():
+    """Environment of user programs, with a fixed hash seed so str hashing and set order repeat between runs."""
+    return dict(os.environ, PYTHONHASHSEED='0')
+
+
+FORKSERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forkserver.py')
+
+# Reads "<working directory>\\n<program>" from stdin, then runs the program
+# as a CommonJS module. On exit the run's CPU time and peak RSS are written to
+# the file descriptor given as the first argument.
+NODE_BOOTSTRAP = """
+const fs = require('fs');
+const usageFd = Number(process.argv[1]);
+process.on('exit', () => {
+    const usage = process.resourceUsage();
+    try {
+        fs.writeSync(usageFd, JSON.stringify({
+            cpu_ms: Math.round((usage.userCPUTime + usage.systemCPUTime) / 1000),
+            peak_rss_kb: usage.maxRSS,
+        }));
+    } catch (e) {}
+});
+const chunks = [];
+process.stdin.on('data', chunk => chunks.push(chunk));
+process.stdin.on('end', () => {
+    const Module = require('module');
+    const path = require('path');
+    const input = Buffer.concat(chunks).toString('utf8');
+    const newline = input.indexOf('\\n');
+    process.chdir(input.slice(0, newline));
+    const filename = path.join(process.cwd(), 'main.js');
+    const main = new Module(filename, null);
+    main.filename = filename;
+    main.paths = Module._nodeModulePaths(process.cwd());
+    process.argv[1] = filename;
+    main._compile(input.slice(newline + 1), filename);
+});
+"""
+
+
+class Worker(abc.ABC):
+    # Single-use workers are replaced as soon as they are taken
+    single_use = False
+
+    def __init__(self, process):
+        self.process = process
+        self.runs = 0
+        self.reusable = True
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    @abc.abstractmethod
+    async def submit(self, code, workdir, limits, argv=None):
+        """
+        Hand a program to the worker.
+
+        Args:
+            code: Source code to run
+            workdir: Working directory for the run
+            limits: Resource limits, see forkserver.RESOURCES
+            argv: Compiled program to run instead of ``code``, for workers
+                that support it
+
+        Returns:
+            The end-of-run marker to read up to on stdout and stderr, or None
+            when the process simply exits once the program finishes
+        """
+
+    def read_usage(self):
+        """CPU time and peak RSS of the last run, for workers that report them separately."""
+        return {}
+
+    def kill(self):
+        self.reusable = False
+        self._kill_group()
+
+    def _kill_group(self):
+        # Workers lead their own session, so this also takes out their children
+        if self.alive:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class ForkServerWorker(Worker):
+    async def submit(self, code, workdir, limits, argv=None):
+        self.runs += 1
+        source = b'' if argv else code.encode()
+        header = json.dumps({'length': len(source), 'cwd': workdir, 'limits': limits, 'argv': argv}).encode()
+        nonce = secrets.token_hex(16).encode()
+        # The nonce goes last; the server only reads it after the child exits
+        self.process.stdin.write(struct.pack('>I', len(header)) + header + source + nonce + b'\n')
+        await self.process.stdin.drain()
+        return b'\0' + nonce + b'\0'
+
+    def kill(self):
+        # SIGTERM lets the server kill the running child's group first; the
+        # child has its own group, so SIGKILL on the server alone would miss it
+        self.reusable = False
+        try:
+            os.kill(self.process.pid, signal.SIGTERM)
+        except OSError:
+            return
+        asyncio.get_running_loop().call_later(1, self._kill_group)
+
+
+class StandbyWorker(Worker):
+    single_use = True
+
+    def __init__(self, process, usage_fd=None):
+        super().__init__(process)
+        self.usage_fd = usage_fd
+
+    async def submit(self, code, workdir, limits, argv=None):
+        if argv:
+            raise ValueError("Standby workers only run source code")
+        self.runs += 1
+        self.reusable = False
+        apply_limits(limits, self.process.pid)
+        self.process.stdin.write(workdir.encode() + b'\n' + code.encode())
+        await self.process.stdin.drain()
+        self.process.stdin.close()
+        return None
+
+    def read_usage(self):
+        # Only called once the process has exited, so the report is complete
+        if self.usage_fd is None:
+            return {}
+        try:
+            usage = json.loads(os.read(self.usage_fd, 4096))
+            return {'cpu_ms': int(usage['cpu_ms']), 'peak_rss_kb': int(usage['peak_rss_kb'])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def kill(self):
+        super().kill()
+        if self.usage_fd is not None:
+            os.close(self.usage_fd)
+            self.usage_fd = None
+
+
+class InterpreterPool(abc.ABC):
+    # Worker subclass wrapping the processes started from command()
+    worker_class = None
+
+    def __init__(self, size=None, max_runs=None):
+        self._size = size
+        self._max_runs = max_runs
+        self._idle = []
+        self._loop = None
+        self._starting = set()
+        self._busy = 0
+
+    @property
+    def size(self):
+        return self._size if self._size is not None else getattr(settings, 'EXECUTION_WARM_WORKERS', 2)
+
+    @property
+    def max_runs(self):
+        return self._max_runs or getattr(settings, 'EXECUTION_WORKER_MAX_RUNS', 50)
+
+    @abc.abstractmethod
+    def command(self):
+        """The argv of an interpreter process."""
+
+    async def _start_worker(self):
+        process = await asyncio.create_subprocess_exec(
+            *self.command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            env=program_env(),
+        )
+        return self.worker_class(process)
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Workers from a previous event loop cannot be driven from this one
+            for worker in self._idle:
+                worker.kill()
+            self._idle = []
+            self._starting = set()
+            self._busy = 0
+            self._loop = loop
+
+    def _refill(self):
+        missing = self.size - len(self._idle) - len(self._starting) - self._busy
+        for _ in range(max(missing, 0)):
+            task = asyncio.ensure_future(self._add_idle(self._loop))
+            self._starting.add(task)
+            task.add_done_callback(self._starting.discard)
+
+    async def _add_idle(self, loop):
+        try:
+            worker = await self._start_worker()
+        except OSError:
+            return
+        if loop is self._loop and len(self._idle) < self.size:
+            self._idle.append(worker)
+        else:
+            worker.kill()
+
+    def warm(self):
+        """Start idle workers up to the pool size in the background."""
+        self._bind()
+        self._refill()
+
+    @asynccontextmanager
+    async def checkout(self):
+        """Take an idle worker (or start one) and return or retire it afterwards."""
+        self._bind()
+        worker = None
+        while self._idle and worker is None:
+            candidate = self._idle.pop()
+            if candidate.alive:
+                worker = candidate
+            else:
+                candidate.kill()
+        if worker is None:
+            worker = await self._start_worker()
+        counted = not worker.single_use
+        if counted:
+            self._busy += 1
+        self._refill()
+        try:
+            yield worker
+        except BaseException:
+            worker.kill()
+            raise
+        finally:
+            if counted:
+                self._busy -= 1
+            if (worker.reusable and worker.alive and worker.runs < self.max_runs
+                    and len(self._idle) < self.size):
+                self._idle.append(worker)
+            else:
+                worker.kill()
+                self._refill()
+                await worker.process.wait()
+
+    async def close(self):
+        """Stop all idle workers, waiting for any that are still starting."""
+        if self._starting:
+            await asyncio.gather(*self._starting, return_exceptions=True)
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.kill()
+        await asyncio.gather(*[worker.process.wait() for worker in idle])
+
+
+class PythonPool(InterpreterPool):
+    worker_class = ForkServerWorker
+
+    def command(self):
+        return ['python3', FORKSERVER_SCRIPT]
+
+
+class NodePool(InterpreterPool):
+    worker_class = StandbyWorker
+
+    def command(self):
+        return ['node', '-e', NODE_BOOTSTRAP]
+
+    async def _start_worker(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.command(), str(write_fd),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+                pass_fds=(write_fd,),
+                env=program_env(),
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        return self.worker_class(process, read_fd)
+
+
+interpreter_pools = {
+    'python': PythonPool(),
+    'javascript': NodePool(),
+}
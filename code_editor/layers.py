@@ -0,0 +1,302 @@
+"""
+Channel layer that keeps same-process traffic in memory.
+
+``HybridChannelLayer`` wraps another layer, normally
+``channels_redis.core.RedisChannelLayer``, called the remote layer. Channels
+created by this process live in an in-memory layer, so a ``group_send`` to
+members connected to the same process never touches Redis. Only processes
+that have members in the group are sent the message, once each, however many
+of their connections are members:
+
+* Each process ("node") has a node channel, ``hybrid.<node id>``, on the
+  remote layer and a task receiving from it. Node channels are members of
+  one remote group, ``hybrid-nodes``, used to tell the others about changes.
+* Joining a group adds the channel to the local group and, for the first
+  local member, announces to the other nodes that this node is in it; the
+  last local member leaving announces that it is gone.
+* Each node keeps the groups of the others in memory, so ``group_send``
+  delivers to the local members and sends the message to the node channel of
+  every other node in the group, which hands it to its own local members. A
+  group no other node is in costs no remote operation at all.
+* Every ``heartbeat`` seconds a node announces all of its groups, replacing
+  what the others knew of it. A new node asks for these when it starts, and
+  knows the groups of the others once they answer. The groups of a node not
+  heard from for three heartbeats are forgotten.
+* ``send`` to a channel of another node goes through that node's channel.
+  Adding one to a group, or removing it, is done by its own node; a channel
+  of no hybrid layer is announced as a member by the node that added it.
+
+Announcements travel like any message, so a member that just joined on
+another node can miss the broadcasts sent before the announcement arrives.
+Only the public channel layer API of the remote layer is used.
+
+Every process sharing the remote layer must use this layer, since channel
+names tell which node a channel belongs to. Configure it with the remote
+layer's settings, e.g.::
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "code_editor.layers.HybridChannelLayer",
+            "CONFIG": {
+                "remote": {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": ["redis://localhost:6379"]},
+                },
+            },
+        },
+    }
+"""
+import asyncio
+import logging
+import re
+import time
+import uuid
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+NODE_PREFIX = 'hybrid.'
+NODE_ID = re.compile(r'[0-9a-f]{12}')
+# Remote group of every node channel, for membership announcements
+NODES_GROUP = 'hybrid-nodes'
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote=None, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 heartbeat=10, **kwargs):
+        """
+        Args:
+            remote: Remote layer, or its settings as {'BACKEND': ..., 'CONFIG': {...}}
+            expiry: Seconds an undelivered local message is kept
+            group_expiry: Seconds a local group membership lasts
+            capacity: Messages a local channel holds before sends to it fail
+            channel_capacity: Capacity per channel name pattern
+            heartbeat: Seconds between announcements of this node's groups
+        """
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        if remote is None:
+            remote = {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+        if isinstance(remote, dict):
+            remote = import_string(remote['BACKEND'])(**remote.get('CONFIG', {}))
+        self.remote = remote
+        self.local = InMemoryChannelLayer(
+            expiry=expiry, group_expiry=group_expiry, capacity=capacity, channel_capacity=channel_capacity,
+        )
+        self.heartbeat = heartbeat
+        self.node_id = uuid.uuid4().hex[:12]
+        self.node_channel = NODE_PREFIX + self.node_id
+        self._members = {}  # group -> {channel on another node or of no hybrid layer: announcing node}
+        self._heard = {}  # node channel -> when it last announced its groups
+        self._foreign = {}  # group -> channels of no hybrid layer this node added
+        self._receiver = None
+        self._heartbeat = None
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific'):
+        self._ensure_receiver()
+        return f"{prefix}.{self.node_id}!{uuid.uuid4().hex}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        node = self._node_of(channel)
+        if node is None:
+            await self.remote.send(channel, message)
+        elif node == self.node_id:
+            await self.local.send(channel, message)
+        else:
+            await self.remote.send(NODE_PREFIX + node, {'type': 'hybrid.send', 'channel': channel, 'message': message})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if self._node_of(channel) != self.node_id:
+            return await self.remote.receive(channel)
+        self._ensure_receiver()
+        return await self.local.receive(channel)
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self._ensure_receiver()
+        node = self._node_of(channel)
+        if node is None:
+            self._foreign.setdefault(group, set()).add(channel)
+            await self._announce({'type': 'hybrid.join', 'group': group, 'channel': channel})
+        elif node != self.node_id:
+            # Its own node adds it, and announces the group if it is new there
+            await self.remote.send(NODE_PREFIX + node, {'type': 'hybrid.group_add', 'group': group, 'channel': channel})
+        else:
+            joined = bool(self.local.groups.get(group))
+            await self.local.group_add(group, channel)
+            if not joined:
+                await self._announce({'type': 'hybrid.join', 'group': group, 'channel': self.node_channel})
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        node = self._node_of(channel)
+        if node is None:
+            self._foreign.get(group, set()).discard(channel)
+            if not self._foreign.get(group):
+                self._foreign.pop(group, None)
+            await self._announce({'type': 'hybrid.leave', 'group': group, 'channel': channel})
+        elif node != self.node_id:
+            await self.remote.send(
+                NODE_PREFIX + node, {'type': 'hybrid.group_discard', 'group': group, 'channel': channel}
+            )
+        else:
+            await self.local.group_discard(group, channel)
+            if not self.local.groups.get(group):
+                await self._announce({'type': 'hybrid.leave', 'group': group, 'channel': self.node_channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        self._ensure_receiver()
+        await self.local.group_send(group, message)
+        channels = set(self._foreign.get(group, ()))
+        cutoff = time.time() - 3 * self.heartbeat
+        for channel, node in self._members.get(group, {}).items():
+            if self._heard.get(node, 0) >= cutoff:
+                channels.add(channel)
+
+        for channel in channels:
+            try:
+                if channel.startswith(NODE_PREFIX):
+                    await self.remote.send(channel, {'type': 'hybrid.group', 'group': group, 'message': message})
+                else:
+                    await self.remote.send(channel, message)
+            except ChannelFull:
+                # Like a full member channel in any layer's group_send: dropped
+                logger.error(f"Channel layer group send to {channel} dropped, channel full")
+
+    async def flush(self):
+        for task in (self._receiver, self._heartbeat):
+            if task is not None:
+                task.cancel()
+        self._receiver = self._heartbeat = None
+        self._members = {}
+        self._heard = {}
+        self._foreign = {}
+        await self.local.flush()
+        await self.remote.flush()
+
+    async def close(self):
+        if hasattr(self.remote, 'close'):
+            await self.remote.close()
+
+    # Remote delivery
+
+    def _node_of(self, channel):
+        # specific.<node id>!<id> for channels of a hybrid layer, None for any other channel
+        if '!' not in channel:
+            return None
+        node = channel.split('!', 1)[0].rsplit('.', 1)[-1]
+        return node if NODE_ID.fullmatch(node) else None
+
+    def _ensure_receiver(self):
+        loop = asyncio.get_running_loop()
+        if self._receiver is None or self._receiver.done() or self._receiver.get_loop() is not loop:
+            self._receiver = loop.create_task(self._receive_remote())
+            self._heartbeat = loop.create_task(self._send_heartbeats())
+
+    def _groups(self):
+        # Members this node announces: itself for its local groups, and the channels of no hybrid layer it added
+        groups = {group: [self.node_channel] for group, channels in self.local.groups.items() if channels}
+        for group, channels in self._foreign.items():
+            groups.setdefault(group, []).extend(channels)
+        return groups
+
+    async def _announce(self, message):
+        try:
+            await self.remote.group_send(NODES_GROUP, dict(message, node=self.node_channel))
+        except Exception as e:
+            logger.error(f"Channel layer announce error: {str(e)}")
+
+    async def _send_heartbeats(self):
+        hello = True
+        while True:
+            try:
+                # Re-adding also keeps the membership from expiring
+                await self.remote.group_add(NODES_GROUP, self.node_channel)
+            except Exception as e:
+                logger.error(f"Channel layer heartbeat error: {str(e)}")
+            await self._announce({'type': 'hybrid.state', 'groups': self._groups(), 'hello': hello})
+            hello = False
+            self._forget_silent_nodes()
+            await asyncio.sleep(self.heartbeat)
+
+    async def _receive_remote(self):
+        while True:
+            try:
+                message = await self.remote.receive(self.node_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Channel layer receive error: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Channel layer delivery error: {str(e)}")
+
+    async def _deliver(self, message):
+        if message['type'] == 'hybrid.send':
+            try:
+                await self.local.send(message['channel'], message['message'])
+            except ChannelFull:
+                logger.error(f"Channel layer send to {message['channel']} dropped, channel full")
+        elif message['type'] == 'hybrid.group':
+            # Dropped if our last member just left; the sender learns it from our announcement
+            await self.local.group_send(message['group'], message['message'])
+        elif message['type'] == 'hybrid.group_add':
+            await self.group_add(message['group'], message['channel'])
+        elif message['type'] == 'hybrid.group_discard':
+            await self.group_discard(message['group'], message['channel'])
+        elif message['node'] != self.node_channel:
+            self._update_members(message)
+            if message.get('hello'):
+                # A new node; tell it about our groups
+                await self.remote.send(message['node'], {
+                    'type': 'hybrid.state', 'node': self.node_channel, 'groups': self._groups(), 'hello': False
+                })
+
+    def _update_members(self, message):
+        node = message['node']
+        self._heard[node] = time.time()
+        if message['type'] == 'hybrid.join':
+            self._members.setdefault(message['group'], {})[message['channel']] = node
+        elif message['type'] == 'hybrid.leave':
+            self._forget(message['group'], message['channel'])
+        elif message['type'] == 'hybrid.state':
+            self._forget_nodes({node})
+            for group, channels in message['groups'].items():
+                for channel in channels:
+                    self._members.setdefault(group, {})[channel] = node
+
+    def _forget_silent_nodes(self):
+        cutoff = time.time() - 3 * self.heartbeat
+        silent = {node for node, heard in self._heard.items() if heard < cutoff}
+        if silent:
+            self._forget_nodes(silent)
+            for node in silent:
+                del self._heard[node]
+
+    def _forget_nodes(self, nodes):
+        for group, members in list(self._members.items()):
+            for channel in [channel for channel, owner in members.items() if owner in nodes]:
+                self._forget(group, channel)
+
+    def _forget(self, group, channel):
+        members = self._members.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self._members[group]
@@ -0,0 +1,227 @@
+"""
+Load-testing harness for the room WebSocket protocol.
+
+Simulates ``rooms`` x ``users`` clients connected to ``CodeEditorConsumer``
+through Channels' ``WebsocketCommunicator``, in one process and without a
+network, so it runs anywhere the test suite does. Each client sends a mix
+of code deltas, cursor moves and chat messages; every payload carries an id
+so receivers can time its fan-out. The report holds the messages sent and
+delivered per second, p50/p99 fan-out latency per message type and the
+memory allocated per connection while connecting.
+
+It runs as part of the test suite (``LoadTestTests``) against the channel
+layer configured there, normally the in-memory one. Scale it with
+environment variables, e.g.::
+
+    LOADTEST_ROOMS=20 LOADTEST_USERS=25 LOADTEST_MESSAGES=50 \\
+        python manage.py test code_editor.tests.LoadTestTests
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+import numpy as np
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.urls import re_path
+
+from .consumers import CodeEditorConsumer
+
+# Share of each message type in the traffic
+DEFAULT_MIX = {'code_delta': 0.5, 'cursor_update': 0.4, 'chat_message': 0.1}
+
+application = URLRouter([
+    re_path(r'ws/code/(?P<room_name>\w+)/$', CodeEditorConsumer.as_asgi()),
+])
+
+
+class LoadClient:
+    """One simulated member: sends traffic and times what it receives."""
+
+    def __init__(self, room, sent_at):
+        self.room = room
+        self.communicator = WebsocketCommunicator(application, f'/ws/code/{room}/')
+        self.communicator.scope['user'] = AnonymousUser()
+        self._sent_at = sent_at  # payload id -> (type, time sent), shared by all clients
+        # Confirmed document state, enough to build valid deltas
+        self.revision = 0
+        self.length = 0
+        self._unacked = []  # insert lengths of our deltas awaiting code_ack
+        self.latencies = {}  # message type -> [seconds]
+        self.received = 0
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f"Connection to {self.room} was refused")
+        snapshot = await self._next_frame(5)
+        while snapshot['type'] != 'code_snapshot':
+            snapshot = await self._next_frame(5)
+        self.revision = snapshot['revision']
+        self.length = len(snapshot['code'])
+
+    async def send(self, message_type, payload_id):
+        self._sent_at[payload_id] = (message_type, time.perf_counter())
+        if message_type == 'code_delta':
+            operation = [payload_id, self.length] if self.length else [payload_id]
+            self._unacked.append(len(payload_id))
+            message = {'type': 'code_delta', 'revision': self.revision, 'operation': operation}
+        elif message_type == 'cursor_update':
+            message = {'type': 'cursor_update', 'position': {'id': payload_id}}
+        else:
+            message = {'type': 'chat_message', 'message': payload_id}
+        await self.communicator.send_to(text_data=json.dumps(message))
+
+    async def receive_until_idle(self, idle):
+        """Process frames until none arrives for ``idle`` seconds."""
+        while True:
+            try:
+                frame = await self._next_frame(idle)
+            except asyncio.TimeoutError:
+                return
+            self._handle(frame, time.perf_counter())
+
+    async def _next_frame(self, timeout):
+        # Not receive_output(): its timeout cancels the application
+        output = await asyncio.wait_for(self.communicator.output_queue.get(), timeout)
+        if output['type'] != 'websocket.send':
+            raise RuntimeError(f"Connection to {self.room} closed: {output}")
+        return json.loads(output['text'])
+
+    def _handle(self, frame, now):
+        self.received += 1
+        if frame['type'] == 'code_ack':
+            self.revision = frame['revision']
+            self.length += self._unacked.pop(0)
+        elif frame['type'] == 'code_delta':
+            self.revision = frame['revision']
+            for component in frame['operation']:
+                if isinstance(component, str):
+                    self.length += len(component)
+                    self._timed(component, now)
+                elif component < 0:
+                    self.length += component
+        elif frame['type'] == 'cursor_batch':
+            for cursor in frame['cursors']:
+                self._timed(cursor['position']['id'], now)
+        elif frame['type'] == 'chat_message':
+            self._timed(frame['message'], now)
+        elif frame['type'] == 'code_snapshot':
+            # Resynced after falling too far behind
+            self.revision = frame['revision']
+            self.length = len(frame['code'])
+            self._unacked.clear()
+
+    def _timed(self, payload_id, now):
+        sent = self._sent_at.get(payload_id)
+        if sent is not None:
+            self.latencies.setdefault(sent[0], []).append(now - sent[1])
+
+
+async def run_load(rooms=5, users=10, messages=20, interval=0.01, mix=None, seed=0, idle=0.5):
+    """
+    Connect ``rooms`` x ``users`` clients and have each send ``messages`` messages.
+
+    Args:
+        rooms: Number of rooms
+        users: Members per room
+        messages: Messages sent by each member
+        interval: Seconds between two messages of a member
+        mix: Dictionary of message type to share of the traffic, DEFAULT_MIX by default
+        seed: Seed for the message type choices
+        idle: Seconds without frames after which a member is done receiving
+
+    Returns:
+        Report dictionary, see ``format_report``
+    """
+    mix = mix or DEFAULT_MIX
+    generator = random.Random(seed)
+    ids = (f"{index:08x}" for index in itertools.count())
+    sent_at = {}
+    clients = [LoadClient(f'load{room}', sent_at) for room in range(rooms) for _ in range(users)]
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        for client in clients:
+            await client.connect()
+        connected = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # Join notifications and chat history from connecting
+    await asyncio.gather(*[client.receive_until_idle(0.1) for client in clients])
+    for client in clients:
+        client.latencies.clear()
+        client.received = 0
+
+    plans = [
+        generator.choices(list(mix), weights=list(mix.values()), k=messages)
+        for _ in clients
+    ]
+
+    async def send_all(client, plan):
+        for message_type in plan:
+            await client.send(message_type, next(ids))
+            await asyncio.sleep(interval)
+
+    started = time.perf_counter()
+    receivers = [asyncio.ensure_future(client.receive_until_idle(idle)) for client in clients]
+    await asyncio.gather(*[send_all(client, plan) for client, plan in zip(clients, plans)])
+    sending = time.perf_counter() - started
+    await asyncio.gather(*receivers)
+    # Receivers only stop after ``idle`` seconds of silence
+    elapsed = max(time.perf_counter() - started - idle, sending)
+
+    for client in clients:
+        await client.communicator.disconnect()
+
+    latencies = {}
+    for client in clients:
+        for message_type, values in client.latencies.items():
+            latencies.setdefault(message_type, []).extend(values)
+    every = [value for values in latencies.values() for value in values]
+    sent = len(clients) * messages
+    received = sum(client.received for client in clients)
+    return {
+        'rooms': rooms,
+        'users': users,
+        'connections': len(clients),
+        'sent': sent,
+        'received': received,
+        'elapsed': elapsed,
+        'sent_per_second': sent / elapsed,
+        'received_per_second': received / elapsed,
+        'latency_ms': {
+            message_type: _percentiles(values)
+            for message_type, values in sorted(latencies.items()) + [('all', every)]
+        },
+        'memory_per_connection_kb': (connected - baseline) / len(clients) / 1024,
+    }
+
+
+def _percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p99': None}
+    p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+    return {'count': len(values), 'p50': float(p50), 'p99': float(p99)}
+
+
+def format_report(report):
+    lines = [
+        f"{report['rooms']} rooms x {report['users']} users: "
+        f"{report['sent']} sent ({report['sent_per_second']:.0f}/s), "
+        f"{report['received']} frames received ({report['received_per_second']:.0f}/s) "
+        f"in {report['elapsed']:.2f}s",
+        f"memory per connection: {report['memory_per_connection_kb']:.1f} KiB",
+    ]
+    for message_type, latency in report['latency_ms'].items():
+        if latency['count']:
+            lines.append(
+                f"{message_type:<14} fan-out p50 {latency['p50']:.2f}ms  p99 {latency['p99']:.2f}ms  "
+                f"({latency['count']} deliveries)"
+            )
+    return '\n'.join(lines)
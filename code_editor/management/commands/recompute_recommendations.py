@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from code_editor.recommendations import MAX_CLUSTERS, recompute_recommendations
+
+
+class Command(BaseCommand):
+    help = "Recompute the recommended rooms of every user and report the time spent per stage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clusters', type=int, default=MAX_CLUSTERS,
+            help=f"Maximum number of interest clusters (default {MAX_CLUSTERS})",
+        )
+
+    def handle(self, *args, **options):
+        summary = recompute_recommendations(num_clusters=options['clusters'])
+        for stage, seconds in summary['timings'].items():
+            self.stdout.write(f"{stage:<8} {seconds * 1000:10.1f} ms")
+        total = sum(summary['timings'].values())
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {summary['rows']} recommendations for {summary['profiles']} profiles in {total:.2f}s"
+        ))
@@ -0,0 +1,43 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from code_editor.workers import MEMORY_URL, run_worker
+
+
+class Command(BaseCommand):
+    help = "Run programs submitted to the execution queue, in one or more worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help="Worker processes to start (default 1)",
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help="Programs each process runs at once (default EXECUTION_CONCURRENCY)",
+        )
+
+    def handle(self, *args, **options):
+        url = getattr(settings, 'EXECUTION_QUEUE_URL', '')
+        if not url or url == MEMORY_URL:
+            raise CommandError("Set EXECUTION_QUEUE_URL to the Redis URL shared with the web processes")
+
+        processes = max(options['processes'], 1)
+        self.stdout.write(f"Running {processes} execution worker process(es) on {url}")
+        if processes == 1:
+            run_worker(options['concurrency'])
+            return
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(options['concurrency'],), daemon=True)
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
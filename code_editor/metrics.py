@@ -0,0 +1,209 @@
+"""
+Process metrics in the Prometheus text format.
+
+Counters, gauges and histograms live in memory in each server process and
+are served by the ``/metrics/`` view for a Prometheus scraper, or anyone
+with curl; nothing is pushed anywhere. Values are per process, so scrape
+every daphne instance.
+
+What is recorded:
+
+* room WebSocket messages received and their handler latency, per type,
+  and the open connections;
+* the members of this process each room broadcast is delivered to;
+* execution queue wait and run time, per language;
+* AI completion upstream latency and errors, and cache hits and misses;
+* the outbound queues of code_editor.outbound.
+
+Handlers slower than ``SLOW_HANDLER_THRESHOLD`` seconds are also logged
+with their room and message type; 0 (the default) disables the log.
+"""
+import logging
+import math
+import threading
+
+from django.conf import settings
+
+from . import outbound
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for every series."""
+        with self._lock:
+            return [('', key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class CallbackMetric(Metric):
+    """A value read when the metrics are scraped, e.g. from a counter kept elsewhere."""
+
+    def __init__(self, name, documentation, function, kind='gauge', registry=registry):
+        super().__init__(name, documentation, registry=registry)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        return [('', (), (), self.function())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=registry):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def count(self, **labels):
+        series = self._values.get(self._key(labels))
+        return series['count'] if series else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_sum', key, (), series['sum']))
+                samples.append(('_count', key, (), series['count']))
+        return samples
+
+
+def _outbound(field):
+    return lambda: outbound.outbound_metrics.snapshot()[field]
+
+
+ws_messages = Counter('codecolab_ws_messages_total', 'Room WebSocket messages received, by type.', ['type'])
+ws_handler_seconds = Histogram(
+    'codecolab_ws_handler_seconds', 'Time spent handling a room WebSocket message, by type.', ['type']
+)
+ws_connections = CallbackMetric(
+    'codecolab_ws_connections', 'Open room WebSocket connections.', _outbound('connections')
+)
+room_fanout = Histogram(
+    'codecolab_room_fanout_members', 'Members of this process a room broadcast is delivered to, by event type.',
+    ['type'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+execution_queue_seconds = Histogram(
+    'codecolab_execution_queue_seconds', 'Time a run waited for its turn, by language.', ['language']
+)
+execution_run_seconds = Histogram(
+    'codecolab_execution_run_seconds', 'Time a run took once started, by language.', ['language']
+)
+ai_upstream_seconds = Histogram(
+    'codecolab_ai_upstream_seconds', 'AI completion upstream request time, by mode.', ['mode']
+)
+ai_upstream_errors = Counter(
+    'codecolab_ai_upstream_errors_total', 'AI completion upstream failures and timeouts, by mode.', ['mode']
+)
+ai_cache_requests = Counter(
+    'codecolab_ai_cache_requests_total', 'AI completion cache lookups, by result (hit or miss).', ['result']
+)
+outbound_queued_frames = CallbackMetric(
+    'codecolab_outbound_queued_frames', 'Frames waiting in outbound queues.', _outbound('queued_frames')
+)
+outbound_max_depth = CallbackMetric(
+    'codecolab_outbound_max_depth', 'Frames waiting in the longest outbound queue.', _outbound('max_depth')
+)
+outbound_superseded = CallbackMetric(
+    'codecolab_outbound_superseded_total', 'Queued frames dropped as superseded by a newer one.',
+    _outbound('superseded'), kind='counter',
+)
+outbound_resyncs = CallbackMetric(
+    'codecolab_outbound_resyncs_total', 'Lagging connections sent a snapshot instead of their queue.',
+    _outbound('resyncs'), kind='counter',
+)
+outbound_disconnects = CallbackMetric(
+    'codecolab_outbound_disconnects_total', 'Connections closed for falling too far behind.',
+    _outbound('disconnects'), kind='counter',
+)
+
+
+def observe_handler(room_name, message_type, seconds):
+    """Record a handled WebSocket message, and log it when it was slow."""
+    ws_messages.inc(type=message_type)
+    ws_handler_seconds.observe(seconds, type=message_type)
+    threshold = getattr(settings, 'SLOW_HANDLER_THRESHOLD', 0)
+    if threshold and seconds >= threshold:
+        logger.warning(f"Slow handler: {message_type} in room {room_name} took {seconds * 1000:.0f}ms")
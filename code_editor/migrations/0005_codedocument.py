@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('code_editor', '0004_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=100, unique=True)),
+                ('content', models.TextField(blank=True)),
+                ('revision', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
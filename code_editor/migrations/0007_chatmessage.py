@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('code_editor', '0006_recommendedroom'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=100)),
+                ('username', models.CharField(max_length=150)),
+                ('message', models.TextField()),
+                ('created_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_name', '-created_at'], name='code_editor_room_na_7e1413_idx')],
+            },
+        ),
+    ]
@@ -33,3 +33,42 @@ class CodeRoom(models.Model):
     
     def __str__(self):
         return self.name
+
+
+class CodeDocument(models.Model):
+    # Last flushed state of a room's editor, see code_editor/documents.py
+    room_name = models.CharField(max_length=100, unique=True)
+    content = models.TextField(blank=True)
+    revision = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.room_name
+
+
+class RecommendedRoom(models.Model):
+    # Precomputed home page recommendations, see code_editor/recommendations.py
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recommended_rooms')
+    room = models.ForeignKey(CodeRoom, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['rank']
+        indexes = [models.Index(fields=['user', 'rank'])]
+
+    def __str__(self):
+        return f"{self.user} #{self.rank}: {self.room}"
+
+
+class ChatMessage(models.Model):
+    # Room chat, written in batches by code_editor/chat.py
+    room_name = models.CharField(max_length=100)
+    username = models.CharField(max_length=150)
+    message = models.TextField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['room_name', '-created_at'])]
+
+    def __str__(self):
+        return f"{self.room_name} {self.username}: {self.message[:50]}"
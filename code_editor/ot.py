@@ -0,0 +1,244 @@
+"""
+Operational transform for plain-text documents.
+
+An operation is a list of components walked left to right over the document:
+
+    - a positive int retains that many characters,
+    - a negative int deletes that many characters,
+    - a string inserts that text.
+
+This is the same JSON shape used by ot.js, so the browser client and the
+consumer can exchange operations as-is.
+
+Lengths and offsets count UTF-16 code units, as JavaScript strings do, so a
+character outside the Basic Multilingual Plane (most emoji) counts as two and
+an operation may split it between its surrogates. Pure ASCII text, where units
+and characters are the same, skips the conversion.
+"""
+
+
+class OperationError(ValueError):
+    """Raised when an operation is malformed or does not fit the document."""
+
+
+def _encode(text):
+    return text.encode('utf-16-le', 'surrogatepass')
+
+
+def _decode(data):
+    # Surrogates that end up next to each other become one character again
+    return data.decode('utf-16-le', 'surrogatepass')
+
+
+def length(text):
+    """Length of ``text`` in UTF-16 code units."""
+    if text.isascii():
+        return len(text)
+    return len(_encode(text)) // 2
+
+
+def _units(text):
+    # Something indexable by UTF-16 code unit
+    if text.isascii():
+        return text
+    return memoryview(_encode(text)).cast('H')
+
+
+def _is_retain(component):
+    return isinstance(component, int) and component > 0
+
+
+def _is_delete(component):
+    return isinstance(component, int) and component < 0
+
+
+def _is_insert(component):
+    return isinstance(component, str)
+
+
+def _append(operation, component):
+    """Append a component, merging it with the previous one when possible."""
+    if component == 0 or component == '':
+        return
+    if operation:
+        last = operation[-1]
+        if _is_retain(last) and _is_retain(component):
+            operation[-1] = last + component
+            return
+        if _is_delete(last) and _is_delete(component):
+            operation[-1] = last + component
+            return
+        if _is_insert(last) and _is_insert(component):
+            operation[-1] = last + component
+            return
+        # Keep inserts before deletes so equivalent operations compare equal
+        if _is_delete(last) and _is_insert(component):
+            if len(operation) > 1 and _is_insert(operation[-2]):
+                operation[-2] += component
+            else:
+                operation.insert(len(operation) - 1, component)
+            return
+    operation.append(component)
+
+
+def normalize(operation):
+    """
+    Validate an operation received from a client and return it in canonical form.
+
+    Args:
+        operation: List of retain/insert/delete components
+
+    Returns:
+        A new, merged list of components
+    """
+    if not isinstance(operation, list):
+        raise OperationError("Operation must be a list")
+    normalized = []
+    for component in operation:
+        if isinstance(component, bool) or not isinstance(component, (int, str)):
+            raise OperationError(f"Invalid operation component: {component!r}")
+        _append(normalized, component)
+    return normalized
+
+
+def base_length(operation):
+    """Length of the document the operation applies to."""
+    return sum(abs(c) if isinstance(c, int) else 0 for c in operation)
+
+
+def target_length(operation):
+    """Length of the document after the operation is applied."""
+    size = 0
+    for component in operation:
+        if _is_retain(component):
+            size += component
+        elif _is_insert(component):
+            size += length(component)
+    return size
+
+
+def is_noop(operation):
+    return all(_is_retain(c) for c in operation)
+
+
+def apply(text, operation):
+    """
+    Apply an operation to a document.
+
+    Args:
+        text: The document the operation was created against
+        operation: List of retain/insert/delete components
+
+    Returns:
+        The resulting document
+    """
+    if base_length(operation) != length(text):
+        raise OperationError(
+            f"Operation base length {base_length(operation)} does not match document length {length(text)}"
+        )
+    if text.isascii() and all(not _is_insert(c) or c.isascii() for c in operation):
+        return ''.join(_splice(text, operation))
+    return _decode(b''.join(_splice(_encode(text), operation, width=2, encode=_encode)))
+
+
+def _splice(text, operation, width=1, encode=None):
+    # Parts of the result; ``width`` is the size of a code unit in ``text``
+    index = 0
+    for component in operation:
+        if _is_retain(component):
+            yield text[index * width:(index + component) * width]
+            index += component
+        elif _is_insert(component):
+            yield encode(component) if encode else component
+        else:
+            index -= component
+
+
+def transform(a, b):
+    """
+    Transform two concurrent operations against each other.
+
+    Both operations must apply to the same document. The results satisfy
+    apply(apply(doc, a), b_prime) == apply(apply(doc, b), a_prime). When both
+    insert at the same position, the insert from ``a`` ends up first.
+
+    Args:
+        a: Operation that wins insert ties
+        b: Concurrent operation
+
+    Returns:
+        (a_prime, b_prime)
+    """
+    if base_length(a) != base_length(b):
+        raise OperationError("Concurrent operations must have the same base length")
+
+    a_prime, b_prime = [], []
+    a_iter, b_iter = iter(a), iter(b)
+    op1, op2 = next(a_iter, None), next(b_iter, None)
+
+    while op1 is not None or op2 is not None:
+        if _is_insert(op1):
+            _append(a_prime, op1)
+            _append(b_prime, length(op1))
+            op1 = next(a_iter, None)
+            continue
+        if _is_insert(op2):
+            _append(a_prime, length(op2))
+            _append(b_prime, op2)
+            op2 = next(b_iter, None)
+            continue
+        if op1 is None or op2 is None:
+            raise OperationError("Operations have mismatched lengths")
+
+        if _is_retain(op1) and _is_retain(op2):
+            step = min(op1, op2)
+            _append(a_prime, step)
+            _append(b_prime, step)
+        elif _is_delete(op1) and _is_delete(op2):
+            # Both sides deleted the same characters; nothing left to do
+            step = min(-op1, -op2)
+        elif _is_delete(op1):
+            step = min(-op1, op2)
+            _append(a_prime, -step)
+        else:
+            step = min(op1, -op2)
+            _append(b_prime, -step)
+
+        op1 = _advance(op1, step, a_iter)
+        op2 = _advance(op2, step, b_iter)
+
+    return a_prime, b_prime
+
+
+def _advance(component, step, components):
+    """Consume ``step`` characters of a retain/delete component."""
+    if _is_retain(component):
+        remaining = component - step
+    else:
+        remaining = component + step
+    return remaining if remaining else next(components, None)
+
+
+def diff(old, new):
+    """
+    Build a single-splice operation turning ``old`` into ``new``.
+
+    Used to turn a legacy full-buffer ``code_update`` into an operation.
+    """
+    old_units, new_units = _units(old), _units(new)
+    prefix = 0
+    limit = min(len(old_units), len(new_units))
+    while prefix < limit and old_units[prefix] == new_units[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and old_units[len(old_units) - 1 - suffix] == new_units[len(new_units) - 1 - suffix]):
+        suffix += 1
+
+    inserted = new_units[prefix:len(new_units) - suffix]
+    operation = []
+    _append(operation, prefix)
+    _append(operation, inserted if isinstance(inserted, str) else _decode(inserted.tobytes()))
+    _append(operation, -(len(old_units) - prefix - suffix))
+    _append(operation, suffix)
+    return operation
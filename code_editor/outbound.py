@@ -0,0 +1,179 @@
+"""
+Per-connection outbound queue for the room consumer.
+
+Handlers put frames on the connection's queue and return, and a writer task
+sends them in order. A client that reads slowly therefore never holds up its
+consumer, whose channel layer channel keeps draining instead of filling up
+and dropping messages for the whole room.
+
+The queue holds at most ``OUTBOUND_QUEUE_LIMIT`` frames. Frames made
+redundant by a newer one are dropped as it arrives:
+
+* a cursor batch is merged into the queued one, the latest position of each
+  user winning;
+* a document snapshot replaces queued deltas, acks and snapshots;
+* a legacy full-code update replaces the queued one.
+
+Chat, presence, execution output and everything else is always delivered.
+A connection that still reaches the limit is resynced: its queued document
+frames and cursors are replaced by one snapshot. If that does not bring it
+back under the limit it is closed with ``SLOW_CLIENT_CLOSE_CODE``.
+"""
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code for clients that fell too far behind
+SLOW_CLIENT_CLOSE_CODE = 4408
+
+# Frame kinds
+DOCUMENT = 'document'  # code_delta and code_ack
+SNAPSHOT = 'snapshot'
+CODE_UPDATE = 'code_update'
+CURSORS = 'cursors'
+
+# Kind -> queued kinds a new frame of that kind makes redundant
+SUPERSEDES = {
+    SNAPSHOT: {DOCUMENT, SNAPSHOT},
+    CODE_UPDATE: {CODE_UPDATE},
+}
+
+
+class OutboundQueue:
+    def __init__(self, send_frame, encode, snapshot, close, limit=None):
+        """
+        Args:
+            send_frame: Coroutine function writing a frame to the socket
+            encode: Function encoding a message into a frame for this connection
+            snapshot: Function returning the current document snapshot message, None before there is one
+            close: Coroutine function closing the connection with a close code
+            limit: Maximum number of queued frames, OUTBOUND_QUEUE_LIMIT by default
+        """
+        self._send_frame = send_frame
+        self._encode = encode
+        self._snapshot = snapshot
+        self._close = close
+        self.limit = limit or getattr(settings, 'OUTBOUND_QUEUE_LIMIT', 256)
+        self._entries = deque()  # [kind, frame, cursors by username]
+        self._cursors = None  # the queued cursor batch entry
+        self._writer = None
+        self.closed = False
+        outbound_metrics.queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self._entries)
+
+    def put(self, frame, kind=None):
+        """Queue a frame, dropping the queued frames it supersedes."""
+        if self.closed:
+            return
+        superseded = SUPERSEDES.get(kind)
+        if superseded:
+            self._drop(superseded)
+        self._entries.append([kind, frame, None])
+        self._check_limit()
+        self._ensure_writer()
+
+    def put_cursors(self, cursors, frame=None):
+        """
+        Queue a cursor batch, merged into the one already queued if any.
+
+        Args:
+            cursors: List of {'username', 'position'}
+            frame: The batch already encoded, used when nothing is merged into it
+        """
+        if self.closed:
+            return
+        by_user = {cursor['username']: cursor for cursor in cursors}
+        if self._cursors is not None:
+            self._cursors[1] = None
+            self._cursors[2].update(by_user)
+            outbound_metrics.superseded += 1
+        else:
+            self._cursors = [CURSORS, frame, by_user]
+            self._entries.append(self._cursors)
+            self._check_limit()
+        self._ensure_writer()
+
+    async def drain(self):
+        """Wait until every queued frame is written."""
+        while self._writer is not None and not self._writer.done():
+            await asyncio.wait({self._writer})
+
+    def close(self):
+        """Drop queued frames and stop writing, e.g. when the socket closed."""
+        self.closed = True
+        self._entries.clear()
+        self._cursors = None
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
+
+    def _drop(self, kinds):
+        kept = deque(entry for entry in self._entries if entry[0] not in kinds)
+        outbound_metrics.superseded += len(self._entries) - len(kept)
+        self._entries = kept
+        if CURSORS in kinds:
+            self._cursors = None
+
+    def _check_limit(self):
+        if len(self._entries) <= self.limit:
+            return
+        self._drop({DOCUMENT, SNAPSHOT, CURSORS})
+        snapshot = self._snapshot()
+        if snapshot is not None:
+            self._entries.append([SNAPSHOT, self._encode(snapshot), None])
+        outbound_metrics.resyncs += 1
+        if len(self._entries) > self.limit:
+            logger.info(f"Disconnecting a client {len(self._entries)} frames behind")
+            outbound_metrics.disconnects += 1
+            self.close()
+            asyncio.ensure_future(self._close(SLOW_CLIENT_CLOSE_CODE))
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._entries:
+            entry = self._entries.popleft()
+            _, frame, cursors = entry
+            if entry is self._cursors:
+                self._cursors = None
+            if frame is None:
+                frame = self._encode({'type': 'cursor_batch', 'cursors': list(cursors.values())})
+            try:
+                await self._send_frame(frame)
+            except Exception as e:
+                logger.error(f"WebSocket send error: {str(e)}")
+                self.close()
+                return
+
+
+class OutboundMetrics:
+    """Depth of the live outbound queues and counts of the frames they dropped."""
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.superseded = 0
+        self.resyncs = 0
+        self.disconnects = 0
+
+    def snapshot(self):
+        depths = [queue.depth for queue in self.queues if not queue.closed]
+        return {
+            'connections': len(depths),
+            'queued_frames': sum(depths),
+            'max_depth': max(depths, default=0),
+            'superseded': self.superseded,
+            'resyncs': self.resyncs,
+            'disconnects': self.disconnects,
+        }
+
+
+outbound_metrics = OutboundMetrics()
@@ -0,0 +1,255 @@
+"""
+Room-to-node placement.
+
+Each room is served by one server process ("node"), picked by consistent
+hashing of the room name over the live nodes, so a room's document,
+presence and cursors stay in one process's memory and its broadcasts stay
+off Redis. A WebSocket that reaches the wrong node is sent a ``redirect``
+frame with the owner's URL and closed with ``REDIRECT_CLOSE_CODE``; the
+client reconnects there.
+
+Nodes identify themselves with ``ROOM_NODE_ID`` and advertise the public
+WebSocket base URL ``ROOM_NODE_URL``. They register in Redis, at
+``ROOM_NODES_REDIS_URL``, with a heartbeat every
+``ROOM_NODE_HEARTBEAT_INTERVAL`` seconds, starting with their first
+connection, and drop out ``ROOM_NODE_TTL`` seconds after their last one;
+``ROOM_NODES`` lists a fixed set of nodes instead. When the set changes,
+only the rooms next to the changed node on the ring move: documents are
+flushed, then members of rooms this node no longer owns are redirected to
+the new owner. Edits still in flight when a room moves are lost, as with
+any reconnect.
+
+Without ``ROOM_NODE_URL``, or with a single node, every room is served
+where its members connect.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import wire
+from .documents import document_store
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code telling the client to reconnect to the URL it was sent
+REDIRECT_CLOSE_CODE = 4302
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, ``replicas`` points per node."""
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []  # sorted hashes
+        self._owners = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return set(self._owners.values())
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def node_for(self, key):
+        """The node owning ``key``: the first point clockwise from its hash, None on an empty ring."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class RoomPlacement:
+    key = 'codecolab:nodes'
+
+    def __init__(self):
+        self._nodes = None  # node id -> WebSocket base URL
+        self._ring = HashRing()
+        self._rooms = {}  # room name -> channel names of its members on this node
+        self._task = None
+        self._redis = None
+
+    @property
+    def node_id(self):
+        return getattr(settings, 'ROOM_NODE_ID', None) or 'local'
+
+    @property
+    def node_url(self):
+        return getattr(settings, 'ROOM_NODE_URL', None)
+
+    @property
+    def heartbeat_interval(self):
+        return getattr(settings, 'ROOM_NODE_HEARTBEAT_INTERVAL', 5.0)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'ROOM_NODE_TTL', 15.0)
+
+    def _get_redis(self):
+        url = getattr(settings, 'ROOM_NODES_REDIS_URL', None)
+        if not url:
+            return None
+        if self._redis is None:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(url)
+        return self._redis
+
+    @property
+    def nodes(self):
+        """Known nodes as {node id: WebSocket base URL}."""
+        if self._nodes is None:
+            nodes = dict(getattr(settings, 'ROOM_NODES', None) or {})
+            if self.node_url:
+                nodes[self.node_id] = self.node_url
+            self._set_nodes(nodes)
+        return self._nodes
+
+    def owner(self, room_name):
+        """
+        The node serving a room.
+
+        Returns:
+            (node id, WebSocket base URL), or None when rooms are not placed
+        """
+        nodes = self.nodes
+        if not self.node_url or len(nodes) < 2:
+            return None
+        node = self._ring.node_for(room_name)
+        return node, nodes[node]
+
+    def is_local(self, room_name):
+        owner = self.owner(room_name)
+        return owner is None or owner[0] == self.node_id
+
+    def attach(self, room_name, channel_name):
+        """Record a member connected to this node, to be redirected if its room moves."""
+        self._rooms.setdefault(room_name, set()).add(channel_name)
+
+    def detach(self, room_name, channel_name):
+        channels = self._rooms.get(room_name)
+        if channels is not None:
+            channels.discard(channel_name)
+            if not channels:
+                del self._rooms[room_name]
+
+    async def update(self, nodes):
+        """
+        Replace the set of live nodes and move the rooms this node no longer owns.
+
+        Args:
+            nodes: Dictionary of node id to WebSocket base URL
+
+        Returns:
+            Names of the rooms whose members were redirected
+        """
+        if nodes == self.nodes:
+            return []
+        self._set_nodes(nodes)
+        moved = [room_name for room_name in self._rooms if not self.is_local(room_name)]
+        if not moved:
+            return []
+
+        # The new owner loads the documents from Redis or the database
+        await document_store.flush_pending(force=True)
+        channel_layer = get_channel_layer()
+        for room_name in moved:
+            _, url = self.owner(room_name)
+            logger.info(f"Room {room_name} moved to {url}")
+            for channel_name in list(self._rooms.get(room_name, ())):
+                await channel_layer.send(channel_name, {'type': 'room_moved', 'url': url})
+        return moved
+
+    def _set_nodes(self, nodes):
+        if self._nodes is not None:
+            for node in set(self._nodes) - set(nodes):
+                self._ring.remove(node)
+        for node in set(nodes) - set(self._nodes or ()):
+            self._ring.add(node)
+        self._nodes = dict(nodes)
+
+    def start(self):
+        """Start registering this node, when nodes are discovered through Redis."""
+        if not self.node_url or self._get_redis() is None:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Room placement heartbeat error: {str(e)}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def heartbeat(self):
+        """Register this node, read the live ones and rebalance if they changed."""
+        client = self._get_redis()
+        urls_key = f"{self.key}:urls"
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(self.key, {self.node_id: time.time() + self.ttl})
+            pipe.hset(urls_key, self.node_id, self.node_url)
+            pipe.zremrangebyscore(self.key, '-inf', time.time())
+            pipe.zrange(self.key, 0, -1)
+            pipe.hgetall(urls_key)
+            _, _, _, live, urls = await pipe.execute()
+        nodes = {node.decode(): urls[node].decode() for node in live if node in urls}
+        nodes[self.node_id] = self.node_url
+        stale = set(urls) - set(live)
+        if stale:
+            await client.hdel(urls_key, *stale)
+        await self.update(nodes)
+
+
+room_placement = RoomPlacement()
+
+
+class RoomAffinityMiddleware:
+    """
+    Sends WebSocket connections for a room served by another node to that node.
+
+    Wraps a consumer routed with a ``room_name`` URL argument.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        room_placement.start()
+        owner = room_placement.owner(scope['url_route']['kwargs']['room_name'])
+        if owner is None or owner[0] == room_placement.node_id:
+            return await self.inner(scope, receive, send)
+
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        subprotocol, wire_format = wire.negotiate(scope.get('subprotocols', []))
+        await send({'type': 'websocket.accept', 'subprotocol': subprotocol})
+        frame = wire.encode({'type': 'redirect', 'url': owner[1] + scope['path']}, wire_format)
+        if isinstance(frame, bytes):
+            await send({'type': 'websocket.send', 'bytes': frame})
+        else:
+            await send({'type': 'websocket.send', 'text': frame})
+        await send({'type': 'websocket.close', 'code': REDIRECT_CLOSE_CODE})
@@ -0,0 +1,204 @@
+"""
+Who is connected to each room.
+
+Every connection registers under its room group with a heartbeat expiry. A
+background task refreshes the connections of this process every
+``PRESENCE_HEARTBEAT_INTERVAL`` seconds, so members of a process that died
+without running ``disconnect`` drop out after ``PRESENCE_TTL`` seconds.
+
+Members are kept in Redis, at ``PRESENCE_REDIS_URL``, as a sorted set per
+room scored by expiry time. Counting a room means trimming expired members
+and reading the set size, never a scan. Without Redis, or while it is
+unreachable, the registry answers from the members of this process.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    key_prefix = 'codecolab:presence:'
+
+    def __init__(self):
+        self._members = {}  # group -> {member_id: (expires at, info)} for this process
+        self._task = None
+        self._redis = None
+
+    @property
+    def heartbeat_interval(self):
+        return getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 15.0)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'PRESENCE_TTL', 45.0)
+
+    def _get_redis(self):
+        url = getattr(settings, 'PRESENCE_REDIS_URL', None)
+        if not url:
+            return None
+        if self._redis is None:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(url)
+        return self._redis
+
+    async def join(self, group, member_id, username):
+        """
+        Register a connection as present in a room.
+
+        Args:
+            group: Room group name
+            member_id: Id of the connection, unique across processes
+            username: Name shown to other members
+        """
+        info = {'member_id': member_id, 'username': username, 'joined_at': time.time()}
+        self._members.setdefault(group, {})[member_id] = (time.time() + self.ttl, info)
+        await self._refresh({group: {member_id: info}})
+        self._ensure_heartbeat()
+
+    async def leave(self, group, member_id):
+        members = self._members.get(group, {})
+        members.pop(member_id, None)
+        if not members:
+            self._members.pop(group, None)
+        client = self._get_redis()
+        if client is None:
+            return
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.zrem(self.key_prefix + group, member_id)
+                pipe.hdel(self._info_key(group), member_id)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Presence leave error for {group}: {str(e)}")
+
+    async def members(self, group):
+        """
+        Members present in a room.
+
+        Returns:
+            List of {'member_id', 'username', 'joined_at'} dictionaries, earliest join first
+        """
+        client = self._get_redis()
+        if client is not None:
+            try:
+                key = self.key_prefix + group
+                async with client.pipeline(transaction=False) as pipe:
+                    pipe.zremrangebyscore(key, '-inf', time.time())
+                    pipe.zrange(key, 0, -1)
+                    pipe.hgetall(self._info_key(group))
+                    _, present, infos = await pipe.execute()
+                members = [json.loads(infos[member_id]) for member_id in present if member_id in infos]
+                stale = set(infos) - set(present)
+                if stale:
+                    await client.hdel(self._info_key(group), *stale)
+                return sorted(members, key=lambda info: info['joined_at'])
+            except Exception as e:
+                logger.error(f"Presence read error for {group}: {str(e)}")
+        members = [info for _, info in self._present(group).values()]
+        return sorted(members, key=lambda info: info['joined_at'])
+
+    async def count(self, group):
+        """Number of members present in a room."""
+        client = self._get_redis()
+        if client is not None:
+            try:
+                key = self.key_prefix + group
+                async with client.pipeline(transaction=False) as pipe:
+                    pipe.zremrangebyscore(key, '-inf', time.time())
+                    pipe.zcard(key)
+                    _, count = await pipe.execute()
+                return count
+            except Exception as e:
+                logger.error(f"Presence read error for {group}: {str(e)}")
+        return len(self._present(group))
+
+    def local_count(self, group):
+        """Number of members of a room connected to this process, without a Redis round trip."""
+        return len(self._present(group))
+
+    async def rooms(self):
+        """Member count of every room with members, as {group: count}."""
+        client = self._get_redis()
+        if client is not None:
+            try:
+                groups = [group.decode() for group in await client.smembers(self._rooms_key())]
+                counts = {}
+                for group in groups:
+                    counts[group] = await self.count(group)
+                # Rooms whose members all expired no longer need tracking
+                empty = [group for group, count in counts.items() if not count]
+                if empty:
+                    await client.srem(self._rooms_key(), *empty)
+                return {group: count for group, count in counts.items() if count}
+            except Exception as e:
+                logger.error(f"Presence read error: {str(e)}")
+        counts = {group: len(self._present(group)) for group in list(self._members)}
+        return {group: count for group, count in counts.items() if count}
+
+    def _present(self, group):
+        now = time.time()
+        members = self._members.get(group, {})
+        for member_id in [member_id for member_id, (expires, _) in members.items() if expires < now]:
+            del members[member_id]
+        return members
+
+    def _info_key(self, group):
+        return f"{self.key_prefix}{group}:info"
+
+    def _rooms_key(self):
+        return f"{self.key_prefix}rooms"
+
+    def _ensure_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._members:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Presence heartbeat error: {str(e)}")
+
+    async def heartbeat(self):
+        """Extend the expiry of every member connected to this process."""
+        expires = time.time() + self.ttl
+        members = {}
+        for group, present in self._members.items():
+            for member_id, (_, info) in present.items():
+                present[member_id] = (expires, info)
+            members[group] = {member_id: info for member_id, (_, info) in present.items()}
+        await self._refresh(members)
+
+    async def _refresh(self, members):
+        # One pipeline for all the given members, grouped by room
+        client = self._get_redis()
+        if client is None or not members:
+            return
+        expires = time.time() + self.ttl
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                for group, infos in members.items():
+                    if not infos:
+                        continue
+                    key = self.key_prefix + group
+                    pipe.zadd(key, {member_id: expires for member_id in infos})
+                    pipe.hset(self._info_key(group), mapping={
+                        member_id: json.dumps(info) for member_id, info in infos.items()
+                    })
+                    # Keys of rooms nobody refreshes any more clean themselves up
+                    pipe.expire(key, int(self.ttl) + 1)
+                    pipe.expire(self._info_key(group), int(self.ttl) + 1)
+                    pipe.sadd(self._rooms_key(), group)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Presence write error: {str(e)}")
+
+
+presence_registry = PresenceRegistry()
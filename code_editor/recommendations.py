@@ -0,0 +1,296 @@
+"""
+Precomputed room recommendations for the home page.
+
+``recompute_recommendations`` clusters the interests of every profile in bulk
+(TF-IDF and k-means from code_editor.utils) and stores up to ``ROOM_LIMIT``
+rooms per user in the RecommendedRoom table: the newest rooms created by
+other users in the same cluster. It runs from the ``recompute_recommendations``
+management command, or every ``RECOMMENDATION_REFRESH_INTERVAL`` seconds in
+the server process through ``recommendation_scheduler``. The home page reads
+the stored rows with one indexed query.
+
+Users without stored rows (new users, and users whose neighbours just
+changed their interests) get rooms from the nearest profiles in the
+in-process similarity index (code_editor.similarity) instead, which are
+stored the same way until the next bulk run replaces them. The index is
+loaded from the database once and then kept up to date as interests change;
+once it is older than ``SIMILARITY_INDEX_MAX_AGE`` seconds it is reloaded on
+a background thread to pick up changes made by other processes, and requests
+keep using the loaded index until the reload is done.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from .models import CodeRoom, Profile, RecommendedRoom
+from .similarity import interest_tokens, profile_index
+from .utils import MINI_BATCH_SIZE, MINI_BATCH_THRESHOLD, create_tfidf_matrix, kmeans_clustering
+
+logger = logging.getLogger(__name__)
+
+SIMILAR_USER_LIMIT = 20
+ROOM_LIMIT = 5
+MAX_CLUSTERS = 5
+WRITE_BATCH_SIZE = 10000
+
+
+_reload_lock = threading.Lock()
+_reload_thread = None
+
+
+def load_profile_index():
+    """Load every profile with interests into the similarity index."""
+    profile_index.load(Profile.objects.exclude(interests="").values_list('user_id', 'interests').iterator())
+
+
+def reload_profile_index_soon():
+    """
+    Reload the similarity index on a background thread.
+
+    Returns:
+        The reload thread, None when a reload is already running
+    """
+    global _reload_thread
+    with _reload_lock:
+        if _reload_thread is not None and _reload_thread.is_alive():
+            return None
+        _reload_thread = threading.Thread(target=_reload_profile_index, name='profile-index-reload', daemon=True)
+        _reload_thread.start()
+        return _reload_thread
+
+
+def _reload_profile_index():
+    try:
+        load_profile_index()
+    except Exception as e:
+        logger.error(f"Profile index reload error: {str(e)}")
+    finally:
+        connection.close()
+
+
+def get_profile_index():
+    """
+    The similarity index, loaded from the database on first use. A stale
+    index is reloaded in the background and served as it is meanwhile.
+    """
+    if profile_index.loaded_at is None:
+        thread = _reload_thread
+        if thread is not None and thread.is_alive():
+            # Started at server startup, see collaborative_code_editor/asgi.py
+            thread.join()
+        else:
+            load_profile_index()
+    elif time.monotonic() - profile_index.loaded_at > getattr(settings, 'SIMILARITY_INDEX_MAX_AGE', 10 * 60):
+        reload_profile_index_soon()
+    return profile_index
+
+
+def compute_similar_users(profile):
+    """Ids of the users whose interests are most similar to ``profile``'s, most similar first."""
+    index = get_profile_index()
+    if profile.user_id in index:
+        similar = index.similar(profile.user_id, SIMILAR_USER_LIMIT)
+    else:
+        similar = index.similar_to(profile.interests, SIMILAR_USER_LIMIT)
+    return [user_id for user_id, _ in similar]
+
+
+def get_recommended_rooms(profile):
+    """Rooms created by users with interests similar to ``profile``'s."""
+    rows = RecommendedRoom.objects.filter(user_id=profile.user_id).select_related('room__creator')
+    rooms = [row.room for row in rows[:ROOM_LIMIT]]
+    if not rooms:
+        rooms = _rooms_created_by(compute_similar_users(profile))
+        if rooms:
+            _store(profile.user_id, rooms)
+    return rooms
+
+
+def change_interests(profile, interests):
+    """
+    Save new interests for ``profile``, re-index it, recompute its
+    recommendations and drop those of the users most affected by the change.
+    """
+    index = get_profile_index()
+    previous = [user_id for user_id, _ in index.similar(profile.user_id, SIMILAR_USER_LIMIT)]
+    profile.interests = interests
+    profile.save()
+    index.update(profile.user_id, interests)
+    similar = compute_similar_users(profile)
+    _store(profile.user_id, _rooms_created_by(similar))
+
+    # Their rows are rebuilt from the index on their next visit
+    affected = (set(previous) | set(similar)) - {profile.user_id}
+    if affected:
+        RecommendedRoom.objects.filter(user_id__in=affected).delete()
+
+
+def _rooms_created_by(user_ids):
+    # Rooms of the most similar users first, newest first for each user
+    if not user_ids:
+        return []
+    rank = {user_id: position for position, user_id in enumerate(user_ids)}
+    rooms = CodeRoom.objects.filter(creator_id__in=user_ids).select_related('creator').order_by('-created_at', '-pk')
+    return sorted(rooms, key=lambda room: rank[room.creator_id])[:ROOM_LIMIT]
+
+
+def _store(user_id, rooms):
+    with transaction.atomic():
+        RecommendedRoom.objects.filter(user_id=user_id).delete()
+        RecommendedRoom.objects.bulk_create(
+            RecommendedRoom(user_id=user_id, room=room, rank=rank) for rank, room in enumerate(rooms)
+        )
+
+
+def _insert_rows(rows):
+    # Plain executemany: building a model instance per row costs more than the insert itself
+    quote = connection.ops.quote_name
+    sql = (
+        f"INSERT INTO {quote(RecommendedRoom._meta.db_table)} "
+        f"({quote('user_id')}, {quote('room_id')}, {quote('rank')}) VALUES (%s, %s, %s)"
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), WRITE_BATCH_SIZE):
+            cursor.executemany(sql, rows[start:start + WRITE_BATCH_SIZE])
+
+
+@contextmanager
+def _stage(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def recompute_recommendations(num_clusters=MAX_CLUSTERS):
+    """
+    Recompute and store the recommended rooms of every user.
+
+    Args:
+        num_clusters: Maximum number of interest clusters to form
+
+    Returns:
+        Dictionary with the number of ``profiles`` clustered, the number of
+        ``rows`` stored and the seconds spent in each stage as ``timings``
+    """
+    timings = {}
+    with _stage(timings, 'load'):
+        profiles = list(Profile.objects.exclude(interests="").values_list('user_id', 'interests'))
+        rooms = list(
+            CodeRoom.objects.filter(creator__isnull=False).order_by('-created_at', '-pk').values_list('pk', 'creator_id')
+        )
+
+    with _stage(timings, 'tfidf'):
+        _, tfidf_matrix = create_tfidf_matrix([' '.join(interest_tokens(interests)) for _, interests in profiles])
+
+    with _stage(timings, 'cluster'):
+        clusters = []
+        if profiles:
+            batch_size = MINI_BATCH_SIZE if len(profiles) > MINI_BATCH_THRESHOLD else None
+            clusters, _ = kmeans_clustering(tfidf_matrix, min(len(profiles), num_clusters), batch_size=batch_size)
+        clusters = [int(cluster) for cluster in clusters]
+
+    with _stage(timings, 'assign'):
+        cluster_of = {user_id: cluster for (user_id, _), cluster in zip(profiles, clusters)}
+        cluster_rooms = defaultdict(list)  # cluster -> [(room id, creator id)], newest first
+        for room_id, creator_id in rooms:
+            cluster = cluster_of.get(creator_id)
+            if cluster is not None:
+                cluster_rooms[cluster].append((room_id, creator_id))
+
+        rows = []
+        for user_id, cluster in cluster_of.items():
+            rank = 0
+            for room_id, creator_id in cluster_rooms[cluster]:
+                if rank == ROOM_LIMIT:
+                    break
+                if creator_id != user_id:
+                    rows.append((user_id, room_id, rank))
+                    rank += 1
+
+    with _stage(timings, 'write'):
+        with transaction.atomic():
+            RecommendedRoom.objects.all().delete()
+            _insert_rows(rows)
+
+    return {'profiles': len(profiles), 'rows': len(rows), 'timings': timings}
+
+
+class RecommendationScheduler:
+    """Runs ``recompute_recommendations`` periodically on a daemon thread."""
+
+    LOCK_KEY = 'recommendations:refresh-lock'
+
+    def __init__(self, interval=None):
+        self._interval = interval
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def interval(self):
+        if self._interval is not None:
+            return self._interval
+        return getattr(settings, 'RECOMMENDATION_REFRESH_INTERVAL', 0)
+
+    def start(self):
+        """
+        Start refreshing every ``interval`` seconds.
+
+        Returns:
+            False when the interval is 0 or the scheduler is already running
+        """
+        if not self.interval or (self._thread is not None and self._thread.is_alive()):
+            return False
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='recommendation-scheduler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            finally:
+                # The thread's connection would otherwise stay open between runs
+                connection.close()
+
+    def run_once(self):
+        """
+        Recompute all recommendations unless another process did so this interval.
+
+        Returns:
+            The summary from ``recompute_recommendations``, None when skipped or failed
+        """
+        # Every server process runs a scheduler; the first to take the lock does the work
+        try:
+            if not cache.add(self.LOCK_KEY, True, max(self.interval * 0.9, 1)):
+                return None
+        except Exception as e:
+            logger.error(f"Recommendation refresh lock error: {str(e)}")
+            return None
+
+        try:
+            summary = recompute_recommendations()
+        except Exception as e:
+            logger.error(f"Recommendation refresh error: {str(e)}")
+            return None
+
+        stages = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in summary['timings'].items())
+        logger.info(f"Recomputed {summary['rows']} recommendations for {summary['profiles']} profiles: {stages}")
+        return summary
+
+
+recommendation_scheduler = RecommendationScheduler()
@@ -0,0 +1,168 @@
+"""
+Shared and cached program runs.
+
+Identical runs - the same language and source - are coalesced: while one is
+in progress, another request for it joins the run instead of starting its
+own, replaying the output produced so far and then following it live. The
+run is stopped once everyone following it has gone.
+
+Runs of programs that look deterministic are also kept, least recently used
+first, in a cache of ``EXECUTION_RESULT_CACHE_SIZE`` results for
+``EXECUTION_RESULT_CACHE_TTL`` seconds, keyed by the SHA-256 of the language
+and source. Running the same buffer again, from any room, then replays the
+output without starting a program. A program is taken as deterministic when
+its source uses none of the clocks, random number generators, input, files,
+environment, threads, the OS or dynamic code listed in ``NONDETERMINISTIC``
+for its language; only runs that exited on their own, or failed to compile,
+are cached. Python programs run with a fixed ``PYTHONHASHSEED``, so printing
+a set of strings gives the same order every run. The list is a safeguard
+against accidental variation, not a sandbox: a program written to evade it
+only affects people running that exact source.
+
+The check cannot see output that depends on memory addresses, such as the
+default repr of an object or a printed pointer, so only runs shared with the
+room are shared and cached, and every run only with ``EXECUTION_SHARE_RUNS``.
+Programs take no input, so the key has no stdin component.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Source patterns that make a program's output vary between runs
+NONDETERMINISTIC = {
+    'python': re.compile(
+        r'\b(random|secrets|time|datetime|uuid|input|open|threading|multiprocessing|asyncio|socket|'
+        r'subprocess|urllib|requests|environ|getenv|getpid|urandom|hash|id|os|sys|platform|glob|pathlib|'
+        r'shutil|tempfile|importlib|ctypes|gc|resource|signal|locale|exec|eval|compile|globals|locals|'
+        r'vars|getattr|breakpoint)\b|__import__'
+    ),
+    'javascript': re.compile(
+        r'\b(Math\.random|Date|performance|hrtime|crypto|setTimeout|setInterval|fetch|require|import|'
+        r'process\.(env|pid|stdin|argv))\b'
+    ),
+    'cpp': re.compile(
+        r'\b(rand|srand|random_device|mt19937|time|clock|chrono|thread|async|getpid|getenv|cin|scanf|'
+        r'getchar|fopen|ifstream|fstream)\b'
+    ),
+    'java': re.compile(
+        r'\b(Random|ThreadLocalRandom|SecureRandom|Math\.random|currentTimeMillis|nanoTime|Instant|'
+        r'LocalDate|LocalDateTime|LocalTime|UUID|Scanner|System\.in|BufferedReader|File|Files|Thread|'
+        r'getenv|hashCode|identityHashCode)\b'
+    ),
+}
+
+# Statuses whose output depends only on the source
+CACHEABLE_STATUSES = ('exited', 'compile_error')
+
+
+def is_deterministic(language, code):
+    pattern = NONDETERMINISTIC.get(language)
+    return pattern is not None and pattern.search(code) is None
+
+
+def result_key(language, code):
+    return hashlib.sha256(f"{language}\0{code}".encode()).hexdigest()
+
+
+class SharedRun:
+    """One run of a program, followed by every request for it made while it is in progress."""
+
+    def __init__(self):
+        self.started = False
+        self.chunks = []  # (stream, text) produced so far
+        self.followers = []  # (on_start, on_output)
+        self.task = None
+
+    async def start(self):
+        self.started = True
+        for on_start, _ in list(self.followers):
+            if on_start is not None:
+                await on_start()
+
+    async def output(self, stream, text):
+        self.chunks.append((stream, text))
+        for _, on_output in list(self.followers):
+            if on_output is not None:
+                await on_output(stream, text)
+
+    async def follow(self, on_start=None, on_output=None):
+        """Replay the run so far, follow it to the end and return its result."""
+        follower = (on_start, on_output)
+        if self.started and on_start is not None:
+            await on_start()
+        # Chunks produced while replaying are picked up by the loop, so none is missed or reordered
+        replayed = 0
+        while replayed < len(self.chunks):
+            if on_output is not None:
+                await on_output(*self.chunks[replayed])
+            replayed += 1
+        self.followers.append(follower)
+        try:
+            # One follower giving up must not stop the run for the others
+            return dict(await asyncio.shield(self.task), cached=False)
+        finally:
+            self.followers.remove(follower)
+            if not self.followers and not self.task.done():
+                self.task.cancel()
+
+
+class ResultCache:
+    """Results of deterministic runs by ``result_key``, least recently used first, expiring after ``ttl`` seconds."""
+
+    def __init__(self, size=None, ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, result, chunks)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return self._size or getattr(settings, 'EXECUTION_RESULT_CACHE_SIZE', 256)
+
+    @property
+    def ttl(self):
+        return self._ttl or getattr(settings, 'EXECUTION_RESULT_CACHE_TTL', 10 * 60)
+
+    def get(self, key):
+        """The cached (result, chunks) for ``key``, or None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def set(self, key, result, chunks):
+        self._entries[key] = (time.monotonic() + self.ttl, result, list(chunks))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def store(self, key, language, code, result, chunks):
+        """Cache a finished run if its output depends only on its source."""
+        if result['status'] in CACHEABLE_STATUSES and is_deterministic(language, code):
+            self.set(key, result, chunks)
+
+
+async def replay(cached, on_start=None, on_output=None):
+    """Hand a cached run's output to the callbacks as if it were running, and return its result."""
+    result, chunks = cached
+    if on_start is not None:
+        await on_start()
+    if on_output is not None:
+        for stream, text in chunks:
+            await on_output(stream, text)
+    return dict(result, cached=True)
+
+
+result_cache = ResultCache()
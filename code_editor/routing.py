@@ -1,7 +1,8 @@
 from django.urls import re_path
 from . import consumers
+from .placement import RoomAffinityMiddleware
 
-# routing for the websocket
+# routing for the websocket; rooms served by another node are redirected there
 websocket_urlpatterns = [
-    re_path(r'ws/code/(?P<room_name>\w+)/$', consumers.CodeEditorConsumer.as_asgi()),
+    re_path(r'ws/code/(?P<room_name>\w+)/$', RoomAffinityMiddleware(consumers.CodeEditorConsumer.as_asgi())),
 ]
\ No newline at end of file
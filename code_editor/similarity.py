@@ -0,0 +1,210 @@
+"""
+Inverted index over profile interests for "who is like me" lookups.
+
+Each profile is a TF-IDF vector over its interest tokens. The index keeps a
+posting list per token, so scoring a query only adds up the postings of its
+own tokens and ranks profiles by cosine similarity, instead of clustering
+every profile for one user's question.
+
+Profiles are added, changed and removed one at a time. IDF weights follow
+the current document frequencies; the per-profile norms they imply are
+recomputed in one vectorised pass on the first query after a change.
+Scoring is done with NumPy, which keeps a typical query at 100k profiles
+under a millisecond. A full reload builds the new contents aside and swaps
+them in, so queries keep being answered from the old ones meanwhile.
+"""
+import math
+import re
+import threading
+import time
+
+import numpy as np
+
+# Interests are saved comma-separated ("Python,Machine Learning")
+TOKEN_PATTERN = re.compile(r'[^\s,]+')
+
+
+def interest_tokens(interests):
+    return TOKEN_PATTERN.findall(interests.lower())
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+        # time.monotonic() of the last full load, None until loaded
+        self.loaded_at = None
+        self._changes = None  # (user_id, interests) made while a load is running, replayed after it
+
+    # Attributes set by _reset(), swapped in as a whole by load()
+    _STATE = ('_rows', '_user_ids', '_terms', '_vocabulary', '_postings', '_arrays', '_norms')
+
+    def _reset(self):
+        self._rows = {}  # user id -> row
+        self._user_ids = []  # row -> user id, None once the profile left the index
+        self._terms = []  # row -> {column: term frequency}
+        self._vocabulary = {}  # token -> column
+        self._postings = []  # column -> {row: term frequency}
+        self._arrays = {}  # column -> (rows, term frequencies) as arrays, built lazily
+        self._norms = None  # 1 / norm per row, 0 for empty rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    def load(self, profiles):
+        """
+        Replace the index contents.
+
+        Args:
+            profiles: Iterable of (user_id, interests) pairs
+        """
+        with self._lock:
+            self._changes = []
+        loaded = SimilarityIndex()
+        try:
+            for user_id, interests in profiles:
+                loaded._update(user_id, interests)
+        except BaseException:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            for name in self._STATE:
+                setattr(self, name, getattr(loaded, name))
+            # Changes made while loading may be missing from what was read
+            for user_id, interests in self._changes:
+                self._update(user_id, interests)
+            self._changes = None
+            self.loaded_at = time.monotonic()
+
+    def update(self, user_id, interests):
+        """Insert a profile, or re-index it after its interests changed."""
+        with self._lock:
+            self._update(user_id, interests)
+            if self._changes is not None:
+                self._changes.append((user_id, interests))
+
+    def remove(self, user_id):
+        self.update(user_id, '')
+
+    def _update(self, user_id, interests):
+        tokens = interest_tokens(interests)
+        row = self._rows.get(user_id)
+        if row is not None:
+            for column in self._terms[row]:
+                del self._postings[column][row]
+                self._arrays.pop(column, None)
+            self._terms[row] = {}
+        self._norms = None
+
+        if not tokens:
+            if row is not None:
+                del self._rows[user_id]
+                self._user_ids[row] = None
+            return
+        if row is None:
+            row = self._rows[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._terms.append({})
+
+        terms = {}
+        for token in tokens:
+            column = self._vocabulary.get(token)
+            if column is None:
+                column = self._vocabulary[token] = len(self._postings)
+                self._postings.append({})
+            terms[column] = terms.get(column, 0) + 1
+        for column, count in terms.items():
+            terms[column] = count / len(tokens)
+            self._postings[column][row] = terms[column]
+            self._arrays.pop(column, None)
+        self._terms[row] = terms
+
+    def similar(self, user_id, k=10):
+        """
+        Find the profiles most similar to an indexed user.
+
+        Args:
+            user_id: User whose profile is the query
+            k: Maximum number of results
+
+        Returns:
+            List of (user_id, cosine similarity) pairs, most similar first,
+            leaving out the user and profiles sharing no interest with it
+        """
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                return []
+            return self._query(self._terms[row], k, exclude=row)
+
+    def similar_to(self, interests, k=10):
+        """Like ``similar`` for interests that are not in the index."""
+        tokens = interest_tokens(interests)
+        if not tokens:
+            return []
+        with self._lock:
+            terms = {}
+            for token in tokens:
+                column = self._vocabulary.get(token)
+                if column is not None:
+                    terms[column] = terms.get(column, 0) + 1 / len(tokens)
+            return self._query(terms, k)
+
+    def _query(self, terms, k, exclude=None):
+        if not terms:
+            return []
+        idf = self._idf()
+        inverse_norms = self._inverse_norms(idf)
+
+        scores = np.zeros(len(self._user_ids))
+        query_norm = 0.0
+        for column, frequency in terms.items():
+            weight = frequency * idf[column]
+            query_norm += weight ** 2
+            rows, frequencies = self._array(column)
+            scores[rows] += weight * idf[column] * frequencies
+        if exclude is not None:
+            scores[exclude] = 0
+
+        # Select among the matching rows only; partitioning the mostly-zero
+        # full array degrades badly on all the ties
+        candidates = np.flatnonzero(scores > 0)
+        similarities = scores[candidates] * inverse_norms[candidates] / math.sqrt(query_norm)
+        if len(candidates) > k:
+            top = np.argpartition(similarities, len(candidates) - k)[len(candidates) - k:]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return [(self._user_ids[candidates[i]], float(similarities[i])) for i in top]
+
+    def _idf(self):
+        document_frequency = np.fromiter((len(postings) for postings in self._postings), dtype=np.float64)
+        return np.log((len(self._rows) + 1) / (document_frequency + 1)) + 1
+
+    def _array(self, column):
+        array = self._arrays.get(column)
+        if array is None:
+            postings = self._postings[column]
+            array = self._arrays[column] = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float64, count=len(postings)),
+            )
+        return array
+
+    def _inverse_norms(self, idf):
+        # IDF shifts with every change, so all norms are refreshed together
+        if self._norms is None:
+            squares = np.zeros(len(self._user_ids))
+            for column in range(len(self._postings)):
+                rows, frequencies = self._array(column)
+                squares[rows] += (frequencies * idf[column]) ** 2
+            norms = np.sqrt(squares)
+            self._norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        return self._norms
+
+
+profile_index = SimilarityIndex()
@@ -1,3 +1,2289 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import Http404
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import re_path
+
+from . import metrics, ot, recommendations, wire
+from .chat import ChatHistory
+from .compilation import ArtifactCache
+from .completion import (
+    CompletionCache, CompletionTimeout, Completer, HuggingFaceUpstream, StubUpstream, UpstreamError, build_prompt,
+    normalize_context,
+)
+from .consumers import CodeEditorConsumer
+from .cursors import CursorCoalescer
+from .documents import DesyncError, DocumentStore, RoomDocument
+from .execution import TRUNCATION_MARKER, ExecutionEngine, ExecutionRejected
+from .forkserver import limited_command
+from .interpreters import InterpreterPool, NodePool, PythonPool, Worker
+from .layers import HybridChannelLayer
+from .loadtest import format_report, run_load
+from .models import ChatMessage, CodeDocument, CodeRoom, RecommendedRoom
+from .outbound import DOCUMENT, SLOW_CLIENT_CLOSE_CODE, SNAPSHOT, OutboundMetrics, OutboundQueue
+from .placement import REDIRECT_CLOSE_CODE, HashRing, RoomAffinityMiddleware, RoomPlacement
+from .presence import PresenceRegistry, presence_registry
+from .results import ResultCache, is_deterministic
+from .similarity import SimilarityIndex
+from .utils import create_tfidf_matrix, kmeans_clustering
+from .workers import ExecutionWorker, LocalJobQueue, get_job_queue, new_job
+from .views import INTERESTS_CHOICES, HuggingFaceAutocompleteView, metrics as metrics_view, room_presence
+
+
+SLEEP_PROGRAM = "import time\ntime.sleep(0.5)\nprint('done')\n"
+
+
+class ExecutionEngineTests(SimpleTestCase):
+    # These start a fresh interpreter per run; warm pools are tested separately
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_concurrent_runs_do_not_serialise(self):
+        engine = ExecutionEngine(concurrency=4, pools={})
+
+        async def benchmark():
+            start = time.perf_counter()
+            outputs = await asyncio.gather(*[
+                engine.run(('room', user), SLEEP_PROGRAM, 'python') for user in range(4)
+            ])
+            return outputs, time.perf_counter() - start
+
+        outputs, elapsed = self.run_async(benchmark())
+        sys.stderr.write(f"\n4 concurrent 0.5s runs finished in {elapsed:.2f}s\n")
+        self.assertEqual([result['output'] for result in outputs], ['done\n'] * 4)
+        # Serial execution would take at least 2 seconds
+        self.assertLess(elapsed, 1.5)
+
+    def test_limits_apply_without_a_warm_worker(self):
+        engine = ExecutionEngine(pools={}, limits={'memory': 64 * 1024 * 1024, 'file_size': 1024})
+        program = (
+            "import resource\n"
+            "print(resource.getrlimit(resource.RLIMIT_FSIZE))\n"
+            "data = bytearray(256 * 1024 * 1024)\n"
+        )
+        result = self.run_async(engine.run('key', program, 'python'))
+        self.assertTrue(result['output'].startswith('(1024, 1024)\n'))
+        self.assertIn("MemoryError", result['output'])
+        self.assertEqual(
+            limited_command(['python3', 'main.py'], {'file_size': 1024, 'cpu': 0}),
+            ['prlimit', '--fsize=1024:1024', '--', 'python3', 'main.py']
+        )
+
+    def test_runs_from_one_user_are_queued(self):
+        engine = ExecutionEngine(concurrency=4, pools={})
+
+        async def benchmark():
+            start = time.perf_counter()
+            await asyncio.gather(*[
+                engine.run(('room', 'same-user'), SLEEP_PROGRAM, 'python') for _ in range(2)
+            ])
+            return time.perf_counter() - start
+
+        self.assertGreaterEqual(self.run_async(benchmark()), 1.0)
+
+    def test_queue_limit(self):
+        engine = ExecutionEngine(queue_limit=1, pools={})
+
+        async def submit_two():
+            first = asyncio.ensure_future(engine.run('key', SLEEP_PROGRAM, 'python'))
+            await asyncio.sleep(0)
+            with self.assertRaises(ExecutionRejected):
+                await engine.run('key', SLEEP_PROGRAM, 'python')
+            await first
+
+        self.run_async(submit_two())
+
+    def test_timeout(self):
+        engine = ExecutionEngine(timeout=0.2, pools={})
+        result = self.run_async(engine.run('key', SLEEP_PROGRAM, 'python'))
+        self.assertEqual(result['status'], 'timeout')
+
+    def test_output_is_streamed_before_exit(self):
+        engine = ExecutionEngine(pools={})
+        program = "import sys, time\nprint('first', flush=True)\ntime.sleep(0.5)\nprint('second')\n"
+
+        async def first_chunk_latency():
+            start = time.perf_counter()
+            chunks = []
+
+            async def on_output(stream, text):
+                chunks.append((stream, text, time.perf_counter() - start))
+
+            result = await engine.run('key', program, 'python', on_output=on_output)
+            return chunks, result
+
+        chunks, result = self.run_async(first_chunk_latency())
+        self.assertEqual(chunks[0][0], 'stdout')
+        self.assertTrue(chunks[0][1].startswith('first'))
+        self.assertLess(chunks[0][2], 0.5)
+        self.assertEqual(result['output'], 'first\nsecond\n')
+        self.assertEqual(result['exit_code'], 0)
+
+    def test_output_limit(self):
+        engine = ExecutionEngine(output_limit=1000, pools={})
+        result = self.run_async(engine.run('key', "while True: print('x' * 100)", 'python'))
+        self.assertEqual(result['status'], 'truncated')
+        self.assertTrue(result['output'].endswith(TRUNCATION_MARKER))
+        self.assertEqual(len(result['output']), 1000 + len(TRUNCATION_MARKER))
+
+    def test_cancel_stops_the_program(self):
+        engine = ExecutionEngine(pools={})
+
+        async def cancel_run():
+            task = asyncio.ensure_future(engine.run('key', SLEEP_PROGRAM, 'python'))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return time.perf_counter()
+
+        start = time.perf_counter()
+        self.assertLess(self.run_async(cancel_run()) - start, 0.5)
+
+
+class SharedRunTests(TransactionTestCase):
+    def make_engine(self, **kwargs):
+        return ExecutionEngine(pools={}, results=ResultCache(size=2, ttl=60), **kwargs)
+
+    def test_identical_runs_share_one_program(self):
+        engine = self.make_engine(concurrency=1)
+
+        async def run_twice():
+            chunks = []
+
+            async def on_output(stream, text):
+                chunks.append(text)
+
+            with mock.patch.object(engine, '_execute', wraps=engine._execute) as execute:
+                first = asyncio.ensure_future(engine.run(('room', 'alice'), SLEEP_PROGRAM, 'python', share=True))
+                await asyncio.sleep(0.2)
+                second = await engine.run(('room', 'bob'), SLEEP_PROGRAM, 'python', on_output=on_output, share=True)
+                return await first, second, chunks, execute.call_count
+
+        first, second, chunks, programs = asyncio.run(run_twice())
+        self.assertEqual(first['output'], 'done\n')
+        self.assertEqual(second['output'], 'done\n')
+        self.assertEqual(chunks, ['done\n'])
+        self.assertEqual(programs, 1)
+
+    def test_deterministic_results_are_cached(self):
+        engine = self.make_engine()
+        program = "print(sum(range(10)))\n"
+
+        async def run_twice():
+            first = await engine.run('key', program, 'python', share=True)
+            started = []
+            chunks = []
+
+            async def on_start():
+                started.append(True)
+
+            async def on_output(stream, text):
+                chunks.append((stream, text))
+
+            with mock.patch.object(engine, '_execute', wraps=engine._execute) as execute:
+                second = await engine.run('key', program, 'python', on_start, on_output, share=True)
+            return first, second, started, chunks, execute.call_count
+
+        first, second, started, chunks, programs = asyncio.run(run_twice())
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['output'], '45\n')
+        self.assertEqual(started, [True])
+        self.assertEqual(''.join(text for _, text in chunks), '45\n')
+        self.assertEqual(programs, 0)
+
+    def test_nondeterministic_results_are_not_cached(self):
+        engine = self.make_engine()
+        program = "import time\nprint(time.time())\n"
+
+        async def run_twice():
+            return [await engine.run('key', program, 'python', share=True) for _ in range(2)]
+
+        first, second = asyncio.run(run_twice())
+        self.assertFalse(second['cached'])
+        self.assertNotEqual(first['output'], second['output'])
+
+    def test_cancelling_the_last_follower_stops_the_program(self):
+        engine = self.make_engine()
+
+        async def cancel_run():
+            task = asyncio.ensure_future(engine.run('key', SLEEP_PROGRAM, 'python', share=True))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+            return engine._shared, engine._queues
+
+        shared, queues = asyncio.run(cancel_run())
+        self.assertEqual((shared, queues), ({}, {}))
+
+    def test_result_cache_evicts_least_recently_used(self):
+        cache = ResultCache(size=2, ttl=60)
+        for key in 'abc':
+            cache.set(key, {'output': key}, [])
+            cache.get('a')
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_is_deterministic(self):
+        self.assertTrue(is_deterministic('python', "print(sum(range(10)))"))
+        self.assertFalse(is_deterministic('python', "import random\nprint(random.random())"))
+        self.assertFalse(is_deterministic('javascript', "console.log(Date.now())"))
+        self.assertFalse(is_deterministic('cpp', "int main() { return rand(); }"))
+        self.assertFalse(is_deterministic('ruby', "puts 1"))
+        for program in [
+            'import os\nos.system("date")', 'import os\nprint(os.listdir("."))', 'import platform\nprint(platform.node())',
+            'import glob\nprint(glob.glob("*"))', 'from pathlib import Path\nprint(list(Path(".").iterdir()))',
+            'import shutil\nprint(shutil.disk_usage("/"))', 'import importlib\nimportlib.import_module("time")',
+            'exec("import time; print(time.time())")', 'print(eval("__import__(\'time\').time()"))',
+        ]:
+            self.assertFalse(is_deterministic('python', program), program)
+
+    def test_python_set_order_repeats_between_runs(self):
+        # Programs run with a fixed PYTHONHASHSEED, so sets of strings print the same way every time
+        engine = ExecutionEngine(pools={})
+        program = "print({'apple', 'banana', 'cherry', 'damson', 'elder', 'fig', 'grape'})\n"
+        self.assertTrue(is_deterministic('python', program))
+
+        async def run_three_times():
+            return {(await engine.run('key', program, 'python'))['output'] for _ in range(3)}
+
+        self.assertEqual(len(asyncio.run(run_three_times())), 1)
+
+    @override_settings(
+        CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        DOCUMENT_REDIS_URL=None, PRESENCE_REDIS_URL=None, EXECUTION_WARM_WORKERS=0,
+    )
+    def test_run_shared_with_the_room(self):
+        async def receive_type(communicator, message_type):
+            while True:
+                message = await communicator.receive_json_from(5)
+                if message['type'] == message_type:
+                    return message
+
+        async def scenario():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(room_application, '/ws/code/sharedrun/')
+                communicator.scope['user'] = AnonymousUser()
+                await communicator.connect()
+                communicators.append(communicator)
+            await communicators[0].send_json_to({
+                'type': 'execute_code', 'code': "print('shared')", 'language': 'python', 'share': True
+            })
+            frames = [
+                (await receive_type(communicator, 'execution_output'), await receive_type(communicator, 'execution_exit'))
+                for communicator in communicators
+            ]
+            # Only runs shared with the room reuse the cached result
+            cached = []
+            for share in (False, True):
+                await communicators[1].send_json_to({
+                    'type': 'execute_code', 'code': "print('shared')", 'language': 'python', 'share': share
+                })
+                cached.append((await receive_type(communicators[1], 'execution_exit'))['cached'])
+            for communicator in communicators:
+                await communicator.disconnect()
+            return frames, cached
+
+        with mock.patch('code_editor.consumers.execution_engine', self.make_engine()):
+            frames, cached = asyncio.run(scenario())
+        for output, exit in frames:
+            self.assertTrue(output['data'].startswith('shared'))
+            self.assertEqual(output['run_by'], 'Anonymous')
+            self.assertEqual(exit['exit_code'], 0)
+        self.assertEqual(cached, [False, True])
+
+
+class ExecutionWorkerTests(TransactionTestCase):
+    def start_worker(self, layer, queue):
+        worker = ExecutionWorker(queue, ExecutionEngine(pools={}, results=ResultCache()), layer, concurrency=2)
+        return worker, asyncio.ensure_future(worker.run())
+
+    async def receive_frames(self, layer, channel, until=('execution_exit', 'execution_error')):
+        frames = []
+        while not frames or frames[-1]['type'] not in until:
+            reply = await asyncio.wait_for(layer.receive(channel), 5)
+            if reply['type'] == 'execution.reply':
+                frames.append(reply['frame'])
+        return reply, frames
+
+    def test_job_replies_reach_the_requesting_channel(self):
+        async def scenario():
+            layer = InMemoryChannelLayer()
+            queue = LocalJobQueue()
+            _, task = self.start_worker(layer, queue)
+            reply_channel = await layer.new_channel()
+            job = new_job(reply_channel, ('room', 'alice'), "print('from a worker')", 'python')
+            await queue.push(job)
+            reply, frames = await self.receive_frames(layer, reply_channel)
+            task.cancel()
+            return job, reply, frames
+
+        job, reply, frames = asyncio.run(scenario())
+        self.assertEqual(reply['job_id'], job['id'])
+        self.assertEqual(frames[0], {'type': 'execution_status', 'status': 'running'})
+        output = ''.join(frame['data'] for frame in frames if frame['type'] == 'execution_output')
+        self.assertEqual(output, 'from a worker\n')
+        self.assertEqual(frames[-1]['exit_code'], 0)
+
+    def test_expired_jobs_are_not_run(self):
+        async def scenario():
+            layer = InMemoryChannelLayer()
+            queue = LocalJobQueue()
+            _, task = self.start_worker(layer, queue)
+            reply_channel = await layer.new_channel()
+            job = new_job(reply_channel, ('room', 'alice'), "print('late')", 'python')
+            job['expires_at'] = time.time() - 1
+            await queue.push(job)
+            _, frames = await self.receive_frames(layer, reply_channel)
+            task.cancel()
+            return frames
+
+        frames = asyncio.run(scenario())
+        self.assertEqual([frame['type'] for frame in frames], ['execution_error'])
+
+    def test_cancel_stops_the_job(self):
+        async def scenario():
+            layer = InMemoryChannelLayer()
+            queue = LocalJobQueue()
+            worker, task = self.start_worker(layer, queue)
+            reply_channel = await layer.new_channel()
+            job = new_job(reply_channel, ('room', 'alice'), SLEEP_PROGRAM, 'python')
+            await queue.push(job)
+            reply, _ = await self.receive_frames(layer, reply_channel, until=('execution_status',))
+            started = time.perf_counter()
+            await layer.send(reply['worker'], {'type': 'execution.cancel', 'job_id': job['id']})
+            while worker._jobs or worker.engine._shared:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            return time.perf_counter() - started
+
+        self.assertLess(asyncio.run(scenario()), 0.3)
+
+    @override_settings(
+        CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        DOCUMENT_REDIS_URL=None, PRESENCE_REDIS_URL=None, EXECUTION_WARM_WORKERS=0,
+        EXECUTION_QUEUE_URL='memory://',
+    )
+    def test_consumer_runs_code_on_the_worker_tier(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(room_application, '/ws/code/workerroom/')
+            communicator.scope['user'] = AnonymousUser()
+            await communicator.connect()
+            # The memory:// queue runs its jobs with a worker of its own
+            await communicator.send_json_to({'type': 'execute_code', 'code': "print(6 * 7)", 'language': 'python'})
+            frames = []
+            while not frames or frames[-1]['type'] != 'execution_exit':
+                frame = await communicator.receive_json_from(5)
+                if frame['type'].startswith('execution_'):
+                    frames.append(frame)
+            await communicator.disconnect()
+            return frames
+
+        with mock.patch('code_editor.consumers.execution_engine', mock.Mock(queue_limit=3, timeout=10)):
+            frames = asyncio.run(scenario())
+        self.assertEqual([frame['status'] for frame in frames[:2]], ['queued', 'running'])
+        output = ''.join(frame['data'] for frame in frames if frame['type'] == 'execution_output')
+        self.assertEqual(output, '42\n')
+        self.assertEqual(frames[-1]['exit_code'], 0)
+
+    @override_settings(
+        CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        DOCUMENT_REDIS_URL=None, PRESENCE_REDIS_URL=None, EXECUTION_WARM_WORKERS=0,
+        EXECUTION_QUEUE_URL='memory://',
+    )
+    def test_queued_jobs_are_dropped_when_the_client_leaves(self):
+        # No worker running, so the job stays queued
+        queue = LocalJobQueue()
+
+        async def scenario():
+            communicator = WebsocketCommunicator(room_application, '/ws/code/workerroom/')
+            communicator.scope['user'] = AnonymousUser()
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'execute_code', 'code': "print(1)", 'language': 'python'})
+            while (await communicator.receive_json_from(1)).get('status') != 'queued':
+                pass
+            await asyncio.sleep(0.05)
+            queued = await queue.depth()
+            await communicator.disconnect()
+            return queued, await queue.depth()
+
+        with mock.patch('code_editor.consumers.execution_engine', mock.Mock(queue_limit=3, timeout=10)), \
+                mock.patch('code_editor.consumers.get_job_queue', return_value=queue):
+            self.assertEqual(asyncio.run(scenario()), (1, 0))
+
+
+CPP_PROGRAM = "#include <iostream>\nint main() { std::cout << \"hello\" << std::endl; return 0; }\n"
+
+
+@unittest.skipUnless(shutil.which('g++'), "g++ is not installed")
+class ArtifactCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.cache = ArtifactCache(root=self.root)
+        self.engine = ExecutionEngine(artifacts=self.cache, pools={})
+
+    def test_compiles_and_runs(self):
+        result = asyncio.run(self.engine.run('key', CPP_PROGRAM, 'cpp'))
+        self.assertEqual(result['output'], 'hello\n')
+        self.assertEqual(result['exit_code'], 0)
+
+    def test_unchanged_source_skips_compilation(self):
+        async def run_twice():
+            await self.engine.run('key', CPP_PROGRAM, 'cpp')
+            start = time.perf_counter()
+            result = await self.engine.run('other-user', CPP_PROGRAM, 'cpp')
+            return result, time.perf_counter() - start
+
+        result, elapsed = asyncio.run(run_twice())
+        sys.stderr.write(f"\ncached C++ run finished in {elapsed * 1000:.1f}ms\n")
+        self.assertEqual(result['output'], 'hello\n')
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+
+    def test_concurrent_identical_builds_compile_once(self):
+        async def run_together():
+            return await asyncio.gather(*[
+                self.engine.run(user, CPP_PROGRAM, 'cpp') for user in range(3)
+            ])
+
+        results = asyncio.run(run_together())
+        self.assertEqual([result['output'] for result in results], ['hello\n'] * 3)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_compile_error(self):
+        result = asyncio.run(self.engine.run('key', 'int main( {', 'cpp'))
+        self.assertEqual(result['status'], 'compile_error')
+        self.assertIn('error', result['output'])
+
+    def test_compiler_runs_under_limits(self):
+        # Too small a file size limit for the binary g++ writes
+        cache = ArtifactCache(root=self.root, limits={'file_size': 1024})
+        result = asyncio.run(ExecutionEngine(artifacts=cache, pools={}).run('key', CPP_PROGRAM, 'cpp'))
+        self.assertEqual(result['status'], 'compile_error')
+        self.assertEqual(cache._entries, {})
+
+    def test_compile_timeout(self):
+        cache = ArtifactCache(root=self.root, timeout=0.01)
+        result = asyncio.run(ExecutionEngine(artifacts=cache, pools={}).run('key', CPP_PROGRAM, 'cpp'))
+        self.assertEqual(result['status'], 'compile_error')
+        self.assertIn('Compilation timed out', result['output'])
+
+    def test_evicts_least_recently_used(self):
+        cache = ArtifactCache(root=self.root, max_size=1)
+        engine = ExecutionEngine(artifacts=cache, pools={})
+        asyncio.run(engine.run('key', CPP_PROGRAM, 'cpp'))
+        asyncio.run(engine.run('key', CPP_PROGRAM.replace('hello', 'again'), 'cpp'))
+        # Only the build that was in use when the cache overflowed survives
+        self.assertEqual(len(cache._entries), 1)
+
+
+class InterpreterPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = PythonPool(size=1)
+        self.engine = ExecutionEngine(pools={'python': self.pool})
+
+    def run_with_pool(self, coroutine, pool=None):
+        async def run_and_close():
+            try:
+                return await coroutine
+            finally:
+                await (pool or self.pool).close()
+
+        return asyncio.run(run_and_close())
+
+    def test_bases_must_be_subclassed(self):
+        with self.assertRaises(TypeError):
+            InterpreterPool()
+        with self.assertRaises(TypeError):
+            Worker(None)
+
+    def test_fork_server_is_reused_without_leaking_state(self):
+        async def run_twice():
+            first = await self.engine.run('key', "x = 1\nprint('first')", 'python')
+            worker = self.pool._idle[0]
+            second = await self.engine.run('key', "print('x' in globals())", 'python')
+            return first, second, worker is self.pool._idle[0]
+
+        first, second, reused = self.run_with_pool(run_twice())
+        self.assertEqual(first['output'], 'first\n')
+        self.assertEqual(second['output'], 'False\n')
+        self.assertEqual(second['exit_code'], 0)
+        self.assertTrue(reused)
+
+    def test_escaped_process_cannot_write_into_later_runs(self):
+        escape = (
+            "import os, time\n"
+            "if os.fork() == 0:\n"
+            "    os.setsid()\n"
+            "    time.sleep(0.3)\n"
+            "    print('leaked', flush=True)\n"
+            "    os._exit(0)\n"
+            "print('first')\n"
+        )
+
+        async def run_twice():
+            first = await self.engine.run('key', escape, 'python')
+            worker = self.pool._idle[0]
+            second = await self.engine.run('other-user', "import time\ntime.sleep(0.6)\nprint('second')", 'python')
+            return first, second, worker is self.pool._idle[0]
+
+        first, second, reused = self.run_with_pool(run_twice())
+        self.assertEqual(first['output'], 'first\n')
+        self.assertEqual(second['output'], 'second\n')
+        self.assertTrue(reused)
+
+    def test_exit_code_and_traceback(self):
+        result = self.run_with_pool(self.engine.run('key', "raise ValueError('boom')", 'python'))
+        self.assertEqual(result['exit_code'], 1)
+        self.assertIn("ValueError: boom", result['output'])
+        self.assertNotIn("forkserver", result['output'])
+
+    def test_timeout_kills_the_forked_child(self):
+        engine = ExecutionEngine(timeout=0.5, pools={'python': self.pool})
+        program = "import os, time\nprint(os.getpid(), flush=True)\ntime.sleep(30)\n"
+        result = self.run_with_pool(engine.run('key', program, 'python'))
+        self.assertEqual(result['status'], 'timeout')
+        time.sleep(0.2)
+        with self.assertRaises(ProcessLookupError):
+            os.kill(int(result['output']), 0)
+
+    @unittest.skipUnless(shutil.which('node'), "node is not installed")
+    def test_node_standby_worker(self):
+        pool = NodePool(size=1)
+        engine = ExecutionEngine(pools={'javascript': pool})
+        program = "console.log(require('path').basename(__filename))"
+        result = self.run_with_pool(engine.run('key', program, 'javascript'), pool)
+        self.assertEqual(result['output'], 'main.js\n')
+        self.assertIsNotNone(result['usage']['cpu_ms'])
+
+    def test_usage_is_reported(self):
+        program = "sum(range(10 ** 6))"
+        result = self.run_with_pool(self.engine.run('key', program, 'python'))
+        usage = result['usage']
+        self.assertEqual(result['exit_code'], 0)
+        self.assertGreater(usage['cpu_ms'], 0)
+        self.assertGreater(usage['peak_rss_kb'], 0)
+        self.assertGreaterEqual(usage['wall_ms'], usage['cpu_ms'] - 5)
+
+    def test_memory_limit(self):
+        engine = ExecutionEngine(pools={'python': self.pool}, limits={'memory': 64 * 1024 * 1024})
+        program = "data = bytearray(256 * 1024 * 1024)\nprint('allocated')"
+        result = self.run_with_pool(engine.run('key', program, 'python'))
+        self.assertEqual(result['exit_code'], 1)
+        self.assertIn("MemoryError", result['output'])
+
+    def test_cpu_limit(self):
+        engine = ExecutionEngine(timeout=5, pools={'python': self.pool}, limits={'cpu': 1})
+        result = self.run_with_pool(engine.run('key', "while True:\n    pass\n", 'python'))
+        self.assertEqual(result['status'], 'cpu_limit')
+        self.assertGreaterEqual(result['usage']['cpu_ms'], 900)
+
+    @unittest.skipUnless(shutil.which('g++'), "g++ is not installed")
+    def test_compiled_program_runs_from_the_fork_server(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        engine = ExecutionEngine(artifacts=ArtifactCache(root=root), pools={'python': self.pool})
+        result = self.run_with_pool(engine.run('key', CPP_PROGRAM, 'cpp'))
+        self.assertEqual(result['output'], 'hello\n')
+        self.assertEqual(result['exit_code'], 0)
+        self.assertIsNotNone(result['usage']['peak_rss_kb'])
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class CursorCoalescerTests(SimpleTestCase):
+    def test_positions_are_batched_per_tick(self):
+        coalescer = CursorCoalescer(tick_rate=20)
+        layer = RecordingLayer()
+
+        async def move_cursors():
+            for index in range(100):
+                coalescer.update(layer, 'room', 'alice-channel', 'alice', {'index': index})
+                coalescer.update(layer, 'room', 'bob-channel', 'bob', {'index': -index})
+            await asyncio.sleep(0.1)
+
+        asyncio.run(move_cursors())
+        self.assertEqual(len(layer.sent), 1)
+        group, message = layer.sent[0]
+        self.assertEqual(group, 'room')
+        self.assertEqual(
+            [(cursor['username'], cursor['position']) for cursor in message['cursors']],
+            [('alice', {'index': 99}), ('bob', {'index': -99})],
+        )
+
+    def test_discarded_cursor_is_not_sent(self):
+        coalescer = CursorCoalescer(tick_rate=20)
+        layer = RecordingLayer()
+
+        async def leave():
+            coalescer.update(layer, 'room', 'alice-channel', 'alice', {'index': 1})
+            coalescer.discard('room', 'alice-channel')
+            await asyncio.sleep(0.1)
+
+        asyncio.run(leave())
+        self.assertEqual(layer.sent, [])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('code_editor.outbound.outbound_metrics', OutboundMetrics())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_queue(self, limit=10):
+        # The client reads nothing until ``reading`` is set
+        self.sent = []
+        self.closed_with = []
+        self.reading = asyncio.Event()
+
+        async def send_frame(frame):
+            await self.reading.wait()
+            self.sent.append(frame)
+
+        async def close(code):
+            self.closed_with.append(code)
+
+        return OutboundQueue(send_frame, json.dumps, lambda: {'type': 'code_snapshot', 'code': 'latest'}, close, limit)
+
+    async def read_all(self, queue):
+        self.reading.set()
+        await queue.drain()
+        return [json.loads(frame) for frame in self.sent]
+
+    def test_cursor_batches_merge_by_user(self):
+        async def scenario():
+            queue = self.make_queue()
+            queue.put(json.dumps({'type': 'chat_message', 'message': 'hi'}))
+            for index in range(5):
+                queue.put_cursors([{'username': 'alice', 'position': index}])
+            queue.put_cursors([{'username': 'bob', 'position': 0}])
+            return queue.depth, await self.read_all(queue)
+
+        depth, frames = asyncio.run(scenario())
+        self.assertEqual(depth, 2)
+        self.assertEqual(frames[1], {'type': 'cursor_batch', 'cursors': [
+            {'username': 'alice', 'position': 4}, {'username': 'bob', 'position': 0},
+        ]})
+
+    def test_snapshot_supersedes_queued_deltas_but_not_chat(self):
+        async def scenario():
+            queue = self.make_queue()
+            queue.put(json.dumps({'type': 'code_delta', 'revision': 1}), DOCUMENT)
+            queue.put(json.dumps({'type': 'chat_message', 'message': 'hi'}))
+            queue.put(json.dumps({'type': 'code_delta', 'revision': 2}), DOCUMENT)
+            queue.put(json.dumps({'type': 'code_snapshot', 'code': 'new'}), SNAPSHOT)
+            return await self.read_all(queue)
+
+        frames = asyncio.run(scenario())
+        self.assertEqual([frame['type'] for frame in frames], ['chat_message', 'code_snapshot'])
+        self.assertEqual(self.metrics.superseded, 2)
+
+    def test_lagging_client_is_resynced(self):
+        async def scenario():
+            queue = self.make_queue(limit=5)
+            queue.put(json.dumps({'type': 'chat_message', 'message': 'kept'}))
+            for revision in range(20):
+                queue.put(json.dumps({'type': 'code_delta', 'revision': revision}), DOCUMENT)
+            return await self.read_all(queue)
+
+        frames = asyncio.run(scenario())
+        self.assertEqual(frames[0], {'type': 'chat_message', 'message': 'kept'})
+        self.assertLessEqual(len(frames), 6)
+        # Deltas arriving after the resync build on the snapshot
+        types = [frame['type'] for frame in frames]
+        after = frames[types.index('code_snapshot') + 1:]
+        self.assertEqual([frame['revision'] for frame in after], list(range(20 - len(after), 20)))
+        self.assertGreater(self.metrics.resyncs, 0)
+        self.assertEqual(self.closed_with, [])
+
+    def test_client_behind_on_undroppable_frames_is_disconnected(self):
+        async def scenario():
+            queue = self.make_queue(limit=3)
+            for index in range(5):
+                queue.put(json.dumps({'type': 'chat_message', 'message': str(index)}))
+            depth = self.metrics.snapshot()
+            await asyncio.sleep(0)
+            return queue.closed, depth
+
+        closed, depth = asyncio.run(scenario())
+        self.assertTrue(closed)
+        self.assertEqual(self.closed_with, [SLOW_CLIENT_CLOSE_CODE])
+        self.assertEqual((depth['connections'], depth['disconnects']), (0, 1))
+
+    def test_metrics_report_queue_depth(self):
+        async def scenario():
+            queues = [self.make_queue() for _ in range(2)]
+            for index in range(3):
+                queues[0].put(json.dumps({'type': 'chat_message', 'message': str(index)}))
+            queues[1].put(json.dumps({'type': 'chat_message', 'message': 'hi'}))
+            snapshot = self.metrics.snapshot()
+            for queue in queues:
+                queue.close()
+            return snapshot
+
+        snapshot = asyncio.run(scenario())
+        self.assertEqual(
+            (snapshot['connections'], snapshot['queued_frames'], snapshot['max_depth']), (2, 4, 3)
+        )
+
+
+room_application = URLRouter([
+    re_path(r'ws/code/(?P<room_name>\w+)/$', CodeEditorConsumer.as_asgi()),
+])
+
+
+def random_operation(generator, text):
+    """A random operation over ``text`` mixing retains, inserts and deletes."""
+    operation = []
+    index = 0
+    while index < len(text):
+        step = generator.randint(1, len(text) - index)
+        choice = generator.random()
+        if choice < 0.3:
+            operation.append(''.join(generator.choice('abc\n') for _ in range(generator.randint(1, 3))))
+        elif choice < 0.6:
+            operation.append(-step)
+            index += step
+        else:
+            operation.append(step)
+            index += step
+    if generator.random() < 0.5:
+        operation.append(generator.choice(['x', 'yz']))
+    return ot.normalize(operation)
+
+
+class OperationalTransformTests(SimpleTestCase):
+    def test_transform_converges(self):
+        generator = random.Random(0)
+        for _ in range(500):
+            text = ''.join(generator.choice('abcdef') for _ in range(generator.randint(0, 12)))
+            a, b = random_operation(generator, text), random_operation(generator, text)
+            a_prime, b_prime = ot.transform(a, b)
+            self.assertEqual(
+                ot.apply(ot.apply(text, a), b_prime), ot.apply(ot.apply(text, b), a_prime), (text, a, b)
+            )
+
+    def test_insert_tie_goes_to_the_first_operation(self):
+        a_prime, b_prime = ot.transform([2, 'A', 1], [2, 'B', 1])
+        self.assertEqual(ot.apply(ot.apply('xyz', [2, 'A', 1]), b_prime), 'xyABz')
+        self.assertEqual(ot.apply(ot.apply('xyz', [2, 'B', 1]), a_prime), 'xyABz')
+
+    def test_diff(self):
+        for old, new in [('', ''), ('', 'abc'), ('abc', ''), ('hello world', 'hello there world'),
+                         ('aaaa', 'aa'), ('abcdef', 'abXYef'), ('same', 'same')]:
+            operation = ot.diff(old, new)
+            self.assertEqual(ot.apply(old, operation), new)
+            self.assertEqual(ot.base_length(operation), len(old))
+        self.assertEqual(ot.diff('abcdef', 'abXYef'), [2, 'XY', -2, 2])
+
+    def test_lengths_count_utf16_code_units(self):
+        # As the browser counts them: the emoji is two units, a surrogate pair
+        text = 'a\U0001F600b'
+        self.assertEqual(ot.length(text), 4)
+        self.assertEqual(ot.apply(text, [3, '\U0001F389', 1]), 'a\U0001F600\U0001F389b')
+        self.assertEqual(ot.apply(text, [1, -2, 1]), 'ab')
+        # Edits may split a pair; the halves join again in the result
+        self.assertEqual(ot.apply(text, [2, '\ude03', -1, 1]), 'a\U0001F603b')
+        self.assertEqual(ot.diff(text, 'a\U0001F603b'), [2, '\ude03', -1, 1])
+        a_prime, b_prime = ot.transform([4, '\u00e9'], [1, -2, 1])
+        self.assertEqual(ot.apply(ot.apply(text, [4, '\u00e9']), b_prime), 'ab\u00e9')
+        self.assertEqual(ot.apply(ot.apply(text, [1, -2, 1]), a_prime), 'ab\u00e9')
+        with self.assertRaises(ot.OperationError):
+            ot.apply(text, [3])
+
+    def test_normalize_rejects_invalid_operations(self):
+        for operation in ['abc', {'retain': 1}, None, [True], [1.5], [1, None]]:
+            with self.assertRaises(ot.OperationError):
+                ot.normalize(operation)
+        self.assertEqual(ot.normalize([1, 2, 'a', 'b', -1, -1, 0, '']), [3, 'ab', -2])
+
+
+class RoomDocumentTests(SimpleTestCase):
+    def test_stale_operation_is_rebased(self):
+        document = RoomDocument('hello')
+        document.apply(0, [5, ' world'])
+        revision, operation = document.apply(0, ['> ', 5])
+        self.assertEqual(revision, 2)
+        self.assertEqual(operation, ['> ', 11])
+        self.assertEqual(document.text, '> hello world')
+
+    def test_unknown_revisions_desync(self):
+        document = RoomDocument('abc', history_limit=2)
+        for _ in range(3):
+            document.apply(document.revision, [len(document.text), 'x'])
+        with self.assertRaises(DesyncError):
+            document.apply(document.revision + 1, [len(document.text)])
+        with self.assertRaises(DesyncError):
+            document.apply(0, [3, 'y'])
+        with self.assertRaises(DesyncError):
+            document.apply(document.revision, [len(document.text) + 1])
+        with self.assertRaises(DesyncError):
+            document.apply('1', [len(document.text)])
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class CodeDeltaConsumerTests(TransactionTestCase):
+    def test_delta_ack_and_resync(self):
+        async def receive_type(communicator, message_type):
+            while True:
+                message = await communicator.receive_json_from(1)
+                if message['type'] == message_type:
+                    return message
+
+        async def scenario():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(room_application, '/ws/code/deltaroom/')
+                communicator.scope['user'] = AnonymousUser()
+                await communicator.connect()
+                await receive_type(communicator, 'code_snapshot')
+                communicators.append(communicator)
+            sender, peer = communicators
+            await sender.send_json_to({'type': 'code_delta', 'revision': 0, 'operation': ['print(1)']})
+            ack = await receive_type(sender, 'code_ack')
+            delta = await receive_type(peer, 'code_delta')
+            # A revision the room has not reached yet
+            await peer.send_json_to({'type': 'code_delta', 'revision': 5, 'operation': [8, '!']})
+            snapshot = await receive_type(peer, 'code_snapshot')
+            for communicator in communicators:
+                await communicator.disconnect()
+            return ack, delta, snapshot
+
+        ack, delta, snapshot = asyncio.run(scenario())
+        self.assertEqual(ack, {'type': 'code_ack', 'revision': 1})
+        self.assertEqual(delta, {'type': 'code_delta', 'revision': 1, 'operation': ['print(1)']})
+        self.assertEqual((snapshot['code'], snapshot['revision']), ('print(1)', 1))
+
+    def test_astral_characters_keep_clients_in_sync(self):
+        async def receive_type(communicator, message_type):
+            while True:
+                message = await communicator.receive_json_from(1)
+                if message['type'] == message_type:
+                    return message
+
+        async def scenario():
+            communicator = WebsocketCommunicator(room_application, '/ws/code/emojiroom/')
+            communicator.scope['user'] = AnonymousUser()
+            await communicator.connect()
+            await receive_type(communicator, 'code_snapshot')
+            # Offsets as the browser computes them, in UTF-16 code units
+            await communicator.send_json_to({'type': 'code_delta', 'revision': 0, 'operation': ['# \U0001F600\n']})
+            first = await receive_type(communicator, 'code_ack')
+            await communicator.send_json_to({'type': 'code_delta', 'revision': 1, 'operation': [5, 'print(1)']})
+            second = await communicator.receive_json_from(1)
+            await communicator.disconnect()
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        self.assertEqual(first, {'type': 'code_ack', 'revision': 1})
+        self.assertEqual(second, {'type': 'code_ack', 'revision': 2})
+
+
+class FakeRedisHashes:
+    """The hash commands DocumentStore uses, kept in a dictionary."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    async def hgetall(self, key):
+        return {field.encode(): str(value).encode() for field, value in self.hashes.get(key, {}).items()}
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def hset(self, key, mapping):
+        self.commands.append((key, mapping))
+
+    def expire(self, key, seconds):
+        pass
+
+    async def execute(self):
+        for key, mapping in self.commands:
+            self.client.hashes.setdefault(key, {}).update(mapping)
+
+
+@override_settings(DOCUMENT_REDIS_URL=None, DOCUMENT_SYNC_INTERVAL=0.01, DOCUMENT_FLUSH_INTERVAL=0.05)
+class DocumentStoreTests(TransactionTestCase):
+    def count_writes(self, store):
+        writes = []
+        write_rows = store._write_rows
+
+        async def counted(rows):
+            writes.append(rows)
+            await write_rows(rows)
+
+        store._write_rows = counted
+        return writes
+
+    def test_edits_are_flushed_in_batches(self):
+        store = DocumentStore()
+        writes = self.count_writes(store)
+
+        async def scenario():
+            document = await store.acquire('batched')
+            for _ in range(20):
+                document.apply(document.revision, [len(document.text), 'x'])
+            await asyncio.sleep(0.2)
+            flushed = len(writes)
+            await store.release('batched')
+            return flushed
+
+        self.assertEqual(asyncio.run(scenario()), 1)
+        self.assertEqual(len(writes), 1)
+        stored = CodeDocument.objects.get(room_name='batched')
+        self.assertEqual((stored.content, stored.revision), ('x' * 20, 20))
+
+    @override_settings(DOCUMENT_FLUSH_INTERVAL=3600)
+    def test_last_member_leaving_flushes_and_evicts(self):
+        store = DocumentStore()
+        writes = self.count_writes(store)
+
+        async def scenario():
+            first = await store.acquire('leaving')
+            second = await store.acquire('leaving')
+            first.apply(0, ['hi'])
+            await store.release('leaving')
+            written_while_occupied = len(writes)
+            await store.release('leaving')
+            return first is second, written_while_occupied
+
+        same, written_while_occupied = asyncio.run(scenario())
+        self.assertTrue(same)
+        self.assertEqual((written_while_occupied, len(writes)), (0, 1))
+        self.assertIsNone(store.get('leaving'))
+        self.assertEqual(store.member_count('leaving'), 0)
+        self.assertEqual(CodeDocument.objects.get(room_name='leaving').content, 'hi')
+
+    def test_failed_load_does_not_count_the_member(self):
+        store = DocumentStore()
+
+        async def failing_load(room_name):
+            raise RuntimeError("database unavailable")
+
+        store._load = failing_load
+
+        async def scenario():
+            with self.assertRaises(RuntimeError):
+                await store.acquire('broken')
+
+        asyncio.run(scenario())
+        self.assertEqual(store.member_count('broken'), 0)
+
+    def test_redis_mirror(self):
+        client = FakeRedisHashes()
+
+        async def scenario():
+            store = DocumentStore()
+            store._redis = client
+            document = await store.acquire('mirrored')
+            document.apply(0, ['from redis'])
+            await store.flush_pending()
+            # A cold load on another process prefers the Redis copy over the database
+            other = DocumentStore()
+            other._redis = client
+            loaded = await other.acquire('mirrored')
+            await other.release('mirrored')
+            await store.release('mirrored')
+            return loaded
+
+        with override_settings(DOCUMENT_REDIS_URL='redis://mirror', DOCUMENT_FLUSH_INTERVAL=3600):
+            loaded = asyncio.run(scenario())
+        self.assertEqual(client.hashes[DocumentStore.key_prefix + 'mirrored'], {'text': 'from redis', 'revision': 1})
+        self.assertEqual((loaded.text, loaded.revision), ('from redis', 1))
+
+    @override_settings(
+        CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        PRESENCE_REDIS_URL=None, EXECUTION_WARM_WORKERS=0,
+    )
+    def test_snapshot_on_join(self):
+        async def scenario():
+            editor = WebsocketCommunicator(room_application, '/ws/code/joinroom/')
+            editor.scope['user'] = AnonymousUser()
+            await editor.connect()
+            while (await editor.receive_json_from(1))['type'] != 'code_snapshot':
+                pass
+            await editor.send_json_to({'type': 'code_delta', 'revision': 0, 'operation': ['x = 1']})
+            while (await editor.receive_json_from(1))['type'] != 'code_ack':
+                pass
+
+            joiner = WebsocketCommunicator(room_application, '/ws/code/joinroom/')
+            joiner.scope['user'] = AnonymousUser()
+            await joiner.connect()
+            snapshot = await joiner.receive_json_from(1)
+            await joiner.disconnect()
+            await editor.disconnect()
+            return snapshot
+
+        self.assertEqual(asyncio.run(scenario()), {'type': 'code_snapshot', 'code': 'x = 1', 'revision': 1})
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class WireFormatTests(TransactionTestCase):
+    async def connect(self, subprotocols=None, room='wire'):
+        communicator = WebsocketCommunicator(room_application, f'/ws/code/{room}/', subprotocols=subprotocols)
+        communicator.scope['user'] = AnonymousUser()
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def receive(self, communicator):
+        output = await communicator.receive_output(1)
+        if output.get('bytes') is not None:
+            return wire.decode(bytes_data=output['bytes']), len(output['bytes'])
+        return wire.decode(text_data=output['text']), len(output['text'].encode())
+
+    async def drain(self, communicator):
+        while not await communicator.receive_nothing(0.02):
+            await communicator.receive_output()
+
+    def test_msgpack_is_negotiated(self):
+        async def exchange():
+            client, subprotocol = await self.connect(['codecolab.msgpack', 'codecolab.json'])
+            legacy, _ = await self.connect()
+            snapshot, _ = await self.receive(client)
+            await self.drain(client)
+            await self.drain(legacy)
+
+            await client.send_to(bytes_data=wire.encode(
+                {'type': 'code_delta', 'revision': snapshot['revision'], 'operation': ['hi']}, wire.MSGPACK
+            ))
+            ack, _ = await self.receive(client)
+            delta = await legacy.receive_json_from(1)
+            await client.disconnect()
+            await legacy.disconnect()
+            return subprotocol, ack, delta
+
+        subprotocol, ack, delta = asyncio.run(exchange())
+        self.assertEqual(subprotocol, 'codecolab.msgpack')
+        self.assertEqual(ack['type'], 'code_ack')
+        self.assertEqual(delta['type'], 'code_delta')
+        self.assertEqual(delta['operation'], ['hi'])
+
+    def test_broadcast_is_encoded_once(self):
+        members, messages = 50, 20
+        encode = wire.encode
+
+        async def benchmark(room, subprotocols, code):
+            clients = [(await self.connect(subprotocols, room))[0] for _ in range(members)]
+            for client in clients:
+                await self.drain(client)
+            sender = clients[0]
+            encoding = {'calls': 0, 'seconds': 0}
+
+            def timed_encode(message, wire_format):
+                started = time.process_time()
+                try:
+                    return encode(message, wire_format)
+                finally:
+                    encoding['calls'] += 1
+                    encoding['seconds'] += time.process_time() - started
+
+            size = 0
+            with mock.patch('code_editor.wire.encode', timed_encode):
+                started = time.process_time()
+                for index in range(messages):
+                    await sender.send_to(text_data=encode(
+                        {'type': 'chat_message', 'message': f"{index}: {code}"}, wire.JSON
+                    ))
+                    for client in clients:
+                        _, size = await self.receive(client)
+                elapsed = time.process_time() - started
+            for client in clients:
+                await client.disconnect()
+            return elapsed, size, encoding
+
+        async def send_per_recipient(consumer, event, kind=None):
+            await consumer.send_message(event['frames'], kind)
+
+        # Before: the message travels as it is and every recipient encodes it
+        per_recipient = [
+            mock.patch('code_editor.consumers.wire.encode_all', lambda message: message),
+            mock.patch.object(CodeEditorConsumer, 'send_broadcast', send_per_recipient),
+        ]
+        runs = [
+            ('before, json per recipient', None, per_recipient, members * messages),
+            ('after, json', None, [], 2 * messages),
+            ('after, msgpack', ['codecolab.msgpack'], [], 2 * messages),
+        ]
+        # A few lines of code, then a pasted file where encoding is most of the cost
+        for lines in (20, 400):
+            code = "def solve(values):\n    return sorted(set(values))\n" * lines
+            encode_seconds = []
+            for index, (label, subprotocols, patches, expected_encodes) in enumerate(runs):
+                with contextlib.ExitStack() as stack:
+                    for patch in patches:
+                        stack.enter_context(patch)
+                    elapsed, size, encoding = asyncio.run(benchmark(f'wire{lines}x{index}', subprotocols, code))
+                sys.stderr.write(
+                    f"\n{members} members, {label}: "
+                    f"{elapsed / messages * 1000:.2f}ms CPU and {size} bytes per broadcast, "
+                    f"{encoding['calls']} encodes taking {encoding['seconds'] * 1000:.2f}ms for {messages} messages\n"
+                )
+                self.assertEqual(encoding['calls'], expected_encodes)
+                encode_seconds.append(encoding['seconds'])
+            self.assertLess(encode_seconds[1], encode_seconds[0])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        recommendations.profile_index.loaded_at = None
+        self.users = {}
+        for name, interests in [
+            ('alice', 'python django'), ('bob', 'python django'), ('carol', 'rust go'), ('dave', 'rust go'),
+        ]:
+            user = self.users[name] = User.objects.create(username=name)
+            user.profile.interests = interests
+            user.profile.save()
+            CodeRoom.objects.create(name=f'{name}-room', creator=user)
+
+    def profile(self, name):
+        return User.objects.get(username=name).profile
+
+    def recommended(self, name):
+        return sorted(room.name for room in recommendations.get_recommended_rooms(self.profile(name)))
+
+    def test_recommendations_are_stored(self):
+        with mock.patch.object(
+            recommendations, 'compute_similar_users', wraps=recommendations.compute_similar_users
+        ) as find:
+            first = self.recommended('alice')
+            second = self.recommended('alice')
+        self.assertEqual(find.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertIn('bob-room', first)
+
+    def test_changing_interests_invalidates_affected_users(self):
+        self.recommended('alice')
+        self.recommended('carol')
+        recommendations.change_interests(self.profile('bob'), 'rust go')
+
+        # bob left alice's neighbours; carol was stored without bob but is now his neighbour
+        self.assertFalse(RecommendedRoom.objects.filter(user__username__in=['alice', 'carol']).exists())
+        self.assertNotIn('bob-room', self.recommended('alice'))
+        self.assertIn('bob-room', self.recommended('carol'))
+
+    def test_bulk_recompute_stores_rooms_of_cluster_members(self):
+        CodeRoom.objects.create(name='bob-newer-room', creator=self.users['bob'])
+        summary = recommendations.recompute_recommendations(num_clusters=2)
+
+        self.assertEqual(summary['profiles'], 4)
+        self.assertEqual(list(summary['timings']), ['load', 'tfidf', 'cluster', 'assign', 'write'])
+        profile = self.profile('alice')
+        with self.assertNumQueries(1):
+            rooms = recommendations.get_recommended_rooms(profile)
+            # Newest first, creators come with the same query
+            self.assertEqual([(room.name, room.creator.username) for room in rooms], [
+                ('bob-newer-room', 'bob'), ('bob-room', 'bob'),
+            ])
+        self.assertEqual(self.recommended('dave'), ['carol-room'])
+
+    def test_bulk_recompute_replaces_stored_rows(self):
+        self.recommended('alice')
+        CodeRoom.objects.get(name='bob-room').delete()
+        summary = recommendations.recompute_recommendations(num_clusters=2)
+        self.assertEqual(summary['rows'], RecommendedRoom.objects.count())
+        self.assertEqual(self.recommended('alice'), [])
+
+    def test_command_reports_stage_timings(self):
+        out = io.StringIO()
+        call_command('recompute_recommendations', clusters=2, stdout=out)
+        for stage in ('load', 'tfidf', 'cluster', 'assign', 'write'):
+            self.assertIn(stage, out.getvalue())
+        self.assertIn('Stored 4 recommendations for 4 profiles', out.getvalue())
+
+    def test_scheduler_runs_once_per_interval_across_processes(self):
+        first = recommendations.RecommendationScheduler(interval=60)
+        second = recommendations.RecommendationScheduler(interval=60)
+        self.assertEqual(first.run_once()['rows'], 4)
+        self.assertIsNone(second.run_once())
+        self.assertFalse(recommendations.RecommendationScheduler(interval=0).start())
+
+    def test_stale_index_is_served_while_it_reloads_in_the_background(self):
+        index = recommendations.get_profile_index()
+        index.loaded_at -= 10 * 60 + 1
+        release = threading.Event()
+        loaded_on = []
+
+        def load():
+            loaded_on.append(threading.current_thread())
+            release.wait(5)
+
+        with mock.patch.object(recommendations, 'load_profile_index', side_effect=load):
+            self.assertEqual(self.recommended('alice'), ['bob-room'])
+            self.assertIs(recommendations.get_profile_index(), index)
+            release.set()
+            recommendations._reload_thread.join()
+        # One reload for both stale reads, off the request path
+        self.assertEqual(len(loaded_on), 1)
+        self.assertIsNot(loaded_on[0], threading.current_thread())
+
+
+INTEREST_WORDS = [
+    'python', 'django', 'react', 'rust', 'go', 'java', 'kotlin', 'docker', 'kubernetes', 'aws',
+    'machine', 'learning', 'data', 'science', 'web', 'development', 'blockchain', 'devops', 'redis', 'git',
+]
+
+
+def random_interests(count, seed=0):
+    generator = random.Random(seed)
+    return [' '.join(generator.choices(INTEREST_WORDS, k=generator.randint(0, 8))) for _ in range(count)]
+
+
+def dense_tfidf(documents):
+    # The original list-based implementation, kept as the reference for the sparse one
+    vocabulary = {}
+    for doc in documents:
+        for word in doc.lower().split():
+            vocabulary.setdefault(word, len(vocabulary))
+    matrix = []
+    for doc in documents:
+        words = doc.lower().split()
+        vector = [0] * len(vocabulary)
+        for word in set(words):
+            df = sum(1 for d in documents if word in d.lower().split())
+            idf = math.log((len(documents) + 1) / (df + 1)) + 1
+            vector[vocabulary[word]] = words.count(word) / max(len(words), 1) * idf
+        magnitude = math.sqrt(sum(x ** 2 for x in vector))
+        matrix.append([x / magnitude for x in vector] if magnitude > 0 else vector)
+    return vocabulary, matrix
+
+
+class TfidfTests(SimpleTestCase):
+    def test_matches_dense_reference(self):
+        documents = random_interests(200) + ['', 'Python PYTHON python', '   ']
+        vocabulary, matrix = create_tfidf_matrix(documents)
+        expected_vocabulary, expected = dense_tfidf(documents)
+        self.assertEqual(vocabulary, expected_vocabulary)
+        for row, expected_row in zip(matrix.toarray().tolist(), expected):
+            for value, expected_value in zip(row, expected_row):
+                self.assertAlmostEqual(value, expected_value)
+
+    def test_benchmark(self):
+        for count in (1000, 10000, 100000):
+            documents = random_interests(count)
+            start = time.perf_counter()
+            _, matrix = create_tfidf_matrix(documents)
+            elapsed = time.perf_counter() - start
+            sys.stderr.write(f"\nTF-IDF for {count} profiles: {elapsed * 1000:.0f}ms, {matrix.nnz} non-zeros\n")
+            self.assertEqual(matrix.shape, (count, len(INTEREST_WORDS)))
+        self.assertLess(elapsed, 10)
+
+
+class KMeansTests(SimpleTestCase):
+    def blobs(self):
+        rng = np.random.default_rng(1)
+        return np.vstack([rng.normal(center, 0.5, (100, 2)) for center in (0, 10, 20)])
+
+    def test_separates_clusters(self):
+        for batch_size in (None, 64):
+            clusters, centroids = kmeans_clustering(self.blobs().tolist(), 3, batch_size=batch_size)
+            self.assertEqual(sorted(np.round(centroids[:, 0]).tolist()), [0, 10, 20])
+            self.assertEqual(sorted(np.bincount(clusters).tolist()), [100, 100, 100])
+
+    def test_deterministic_for_seed(self):
+        _, matrix = create_tfidf_matrix(random_interests(2000))
+        first, _ = kmeans_clustering(matrix, 5, random_seed=7)
+        second, _ = kmeans_clustering(matrix, 5, random_seed=7)
+        self.assertTrue(np.array_equal(first, second))
+
+    def test_invalid_cluster_count(self):
+        self.assertEqual(kmeans_clustering([], 2), ([], []))
+        self.assertEqual(kmeans_clustering([[1.0, 2.0]], 2), ([], []))
+
+    def test_benchmark(self):
+        _, matrix = create_tfidf_matrix(random_interests(50000))
+        for batch_size in (None, 2048):
+            start = time.perf_counter()
+            clusters, _ = kmeans_clustering(matrix, 5, batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            sys.stderr.write(
+                f"\nk-means for 50000 profiles ({'mini-batch' if batch_size else 'full batch'}): {elapsed * 1000:.0f}ms\n"
+            )
+            self.assertEqual(len(clusters), 50000)
+            self.assertLess(elapsed, 1)
+
+
+class SimilarityIndexTests(SimpleTestCase):
+    def test_ranks_by_shared_interests(self):
+        index = SimilarityIndex()
+        index.load([(1, 'Python,Django'), (2, 'Python'), (3, 'Rust'), (4, 'Python,Django,React'), (5, '')])
+        self.assertEqual(len(index), 4)
+        self.assertEqual([user_id for user_id, _ in index.similar(1)], [4, 2])
+        self.assertEqual(index.similar(3), [])
+        self.assertEqual([user_id for user_id, _ in index.similar_to('rust')], [3])
+
+    def test_update_and_remove(self):
+        index = SimilarityIndex()
+        index.load([(1, 'Python'), (2, 'Python'), (3, 'Rust')])
+        index.update(2, 'Rust,Go')
+        self.assertEqual(index.similar(1), [])
+        self.assertEqual([user_id for user_id, _ in index.similar(3)], [2])
+        index.update(4, 'Python')
+        index.remove(3)
+        self.assertEqual([user_id for user_id, _ in index.similar(1)], [4])
+        self.assertNotIn(3, index)
+        self.assertEqual([user_id for user_id, _ in index.similar(2)], [])
+
+    def test_load_keeps_answering_and_replays_concurrent_updates(self):
+        index = SimilarityIndex()
+        index.load([(1, 'Python'), (2, 'Python')])
+
+        def profiles():
+            yield 1, 'Python'
+            # Read from the database before this change was made
+            index.update(3, 'Python')
+            self.assertEqual([user_id for user_id, _ in index.similar(1)], [2, 3])
+            yield 3, 'Rust'
+
+        index.load(profiles())
+        self.assertNotIn(2, index)
+        self.assertEqual([user_id for user_id, _ in index.similar(1)], [3])
+
+    def test_benchmark(self):
+        generator = random.Random(0)
+        choices = [item for items in INTERESTS_CHOICES.values() for item in items]
+        for count in (10000, 100000):
+            index = SimilarityIndex()
+            index.load((user_id, ','.join(generator.sample(choices, generator.randint(1, 6)))) for user_id in range(count))
+            index.similar(0)
+            timings = []
+            for _ in range(200):
+                start = time.perf_counter()
+                index.similar(generator.randrange(count))
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            sys.stderr.write(
+                f"\nSimilar profiles among {count}: p50 {timings[100] * 1000:.3f}ms, p99 {timings[198] * 1000:.3f}ms\n"
+            )
+        self.assertLess(timings[100], 0.005)
+
+
+class SlowUpstream(StubUpstream):
+    suggestion = "print('done')"
+    delay = 0.05
+
+
+@override_settings(AI_COMPLETION_UPSTREAM='code_editor.tests.SlowUpstream', AI_COMPLETION_TIMEOUT=1)
+class CompletionTests(SimpleTestCase):
+    def setUp(self):
+        self.completer = Completer(cache_size=2, cache_ttl=60)
+
+    def test_identical_concurrent_requests_share_one_upstream_call(self):
+        async def complete_all():
+            return await asyncio.gather(*[self.completer.complete('python', 'for i in range(3):\n') for _ in range(20)])
+
+        suggestions = asyncio.run(complete_all())
+        self.assertEqual(set(suggestions), {"print('done')"})
+        self.assertEqual(self.completer.upstream_calls, 1)
+
+    def test_cache_is_keyed_on_normalized_context(self):
+        asyncio.run(self.completer.complete('python', 'x = 1\r\nprint(x)   \n'))
+        asyncio.run(self.completer.complete('python', 'x = 1\nprint(x)'))
+        self.assertEqual(self.completer.upstream_calls, 1)
+        asyncio.run(self.completer.complete('javascript', 'x = 1\nprint(x)'))
+        self.assertEqual(self.completer.upstream_calls, 2)
+
+    def test_only_the_code_tail_is_sent(self):
+        with override_settings(AI_COMPLETION_CONTEXT_CHARS=6):
+            asyncio.run(self.completer.complete('python', 'a = 0\n' * 100 + 'b = 1'))
+            asyncio.run(self.completer.complete('python', 'c = 2\n' * 100 + 'b = 1'))
+        self.assertEqual(self.completer.upstream_calls, 1)
+        self.assertEqual(normalize_context('a = 0\n' * 100 + 'b = 1  ', 6), '\nb = 1')
+
+    def test_cache_evicts_least_recent_and_expired_entries(self):
+        cache = CompletionCache(size=2, ttl=60)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('A', None, 'C'))
+        with mock.patch('code_editor.completion.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+
+    def test_slow_upstream_times_out(self):
+        with override_settings(AI_COMPLETION_TIMEOUT=0.01):
+            with self.assertRaises(CompletionTimeout):
+                asyncio.run(self.completer.complete('python', 'import time'))
+        # Failures are not cached
+        self.assertEqual(asyncio.run(self.completer.complete('python', 'import time')), "print('done')")
+
+    def test_hugging_face_response_handling(self):
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(json.loads(request.content))
+            if 'broken' in requests_seen[-1]['inputs']:
+                return httpx.Response(503, json={'error': 'Model is loading'})
+            return httpx.Response(200, json=[{'generated_text': ' + 1'}])
+
+        async def complete(code):
+            upstream = HuggingFaceUpstream()
+            upstream._clients[asyncio.get_running_loop()] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            return await upstream.complete(build_prompt('python', code))
+
+        self.assertEqual(asyncio.run(complete('x = 1')), ' + 1')
+        self.assertEqual(requests_seen[0]['inputs'], 'Complete the following python code:\nx = 1')
+        with self.assertRaises(UpstreamError) as raised:
+            asyncio.run(complete('broken'))
+        self.assertEqual(raised.exception.status_code, 503)
+
+    def test_hugging_face_stream_parsing(self):
+        events = [{'token': {'text': ' + 1', 'special': False}}, {'token': {'text': '</s>', 'special': True}}]
+        body = ''.join(f"data:{json.dumps(event)}\n\n" for event in events)
+
+        def handler(request):
+            self.assertTrue(json.loads(request.content)['stream'])
+            return httpx.Response(200, text=body, headers={'Content-Type': 'text/event-stream'})
+
+        async def stream():
+            upstream = HuggingFaceUpstream()
+            upstream._clients[asyncio.get_running_loop()] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            return [token async for token in upstream.stream(build_prompt('python', 'x = 1'))]
+
+        self.assertEqual(asyncio.run(stream()), [' + 1'])
+
+    def test_view_is_async_and_uses_the_completer(self):
+        def post(body):
+            request = AsyncRequestFactory().post('/ai-autocomplete/', body, content_type='application/json')
+            return asyncio.run(HuggingFaceAutocompleteView.as_view()(request))
+
+        with mock.patch('code_editor.views.completer', self.completer):
+            response = post({'code': 'def f():', 'language': 'python'})
+            self.assertEqual(json.loads(response.content), {'suggestion': "print('done')"})
+            self.assertEqual(post({'code': ''}).status_code, 400)
+            with override_settings(AI_COMPLETION_TIMEOUT=0.01):
+                self.assertEqual(post({'code': 'def g():'}).status_code, 504)
+
+
+class TrackedUpstream(StubUpstream):
+    suggestion = "for i in range(10):\n    print(i)"
+    delay = 0.02
+    closed = 0
+
+    async def stream(self, prompt):
+        try:
+            async for token in super().stream(prompt):
+                yield token
+        finally:
+            TrackedUpstream.closed += 1
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+    AI_COMPLETION_UPSTREAM='code_editor.tests.TrackedUpstream',
+    AI_COMPLETION_TIMEOUT=1,
+)
+class CompletionStreamTests(TransactionTestCase):
+    def setUp(self):
+        TrackedUpstream.closed = 0
+        self.completer = Completer(cache_size=8, cache_ttl=60)
+        patcher = mock.patch('code_editor.consumers.completer', self.completer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(room_application, '/ws/code/ai/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        while not await communicator.receive_nothing(0.02):
+            await communicator.receive_output()
+        return communicator
+
+    async def receive_until_done(self, communicator, request_id):
+        messages = []
+        while True:
+            message = await communicator.receive_json_from(2)
+            messages.append(message)
+            if message['type'] in ('ai_done', 'ai_error') and message['request_id'] == request_id:
+                return messages
+
+    def test_tokens_are_streamed(self):
+        async def complete():
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'ai_complete', 'request_id': 1, 'prefix': 'def f():'})
+            messages = await self.receive_until_done(communicator, 1)
+            await communicator.disconnect()
+            return messages
+
+        messages = asyncio.run(complete())
+        tokens = [message['token'] for message in messages if message['type'] == 'ai_token']
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual(''.join(tokens), TrackedUpstream.suggestion)
+        self.assertEqual(messages[-1], {'type': 'ai_done', 'request_id': 1})
+
+    def test_new_request_cancels_the_stale_one(self):
+        async def complete():
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'ai_complete', 'request_id': 1, 'prefix': 'x = '})
+            await communicator.receive_json_from(1)
+            await communicator.send_json_to({'type': 'ai_complete', 'request_id': 2, 'prefix': 'x = 1'})
+            messages = await self.receive_until_done(communicator, 2)
+            await communicator.disconnect()
+            return messages
+
+        messages = asyncio.run(complete())
+        finished = [message['request_id'] for message in messages if message['type'] == 'ai_done']
+        self.assertEqual(finished, [2])
+        self.assertEqual(TrackedUpstream.closed, 2)
+        # Only the finished suggestion is cached
+        self.assertEqual(len(self.completer.cache._entries), 1)
+
+    def test_cancel_stops_the_upstream_stream(self):
+        async def complete():
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'ai_complete', 'request_id': 1, 'prefix': 'x = '})
+            await communicator.receive_json_from(1)
+            await communicator.send_json_to({'type': 'ai_cancel'})
+            await asyncio.sleep(0.05)
+            closed = TrackedUpstream.closed
+            nothing = await communicator.receive_nothing(0.1)
+            await communicator.disconnect()
+            return closed, nothing
+
+        closed, nothing = asyncio.run(complete())
+        self.assertEqual(closed, 1)
+        self.assertTrue(nothing)
+
+    def test_stalled_stream_times_out(self):
+        async def complete():
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'ai_complete', 'request_id': 1, 'prefix': 'x = '})
+            messages = await self.receive_until_done(communicator, 1)
+            await communicator.disconnect()
+            return messages
+
+        with override_settings(AI_COMPLETION_TIMEOUT=0.01):
+            messages = asyncio.run(complete())
+        self.assertEqual(messages[-1]['type'], 'ai_error')
+        self.assertEqual(TrackedUpstream.closed, 1)
+
+
+@override_settings(PRESENCE_REDIS_URL=None, PRESENCE_TTL=30)
+class PresenceRegistryTests(SimpleTestCase):
+    def test_members_and_counts(self):
+        async def scenario():
+            registry = PresenceRegistry()
+            await registry.join('code_a', 'm1', 'alice')
+            await registry.join('code_a', 'm2', 'bob')
+            await registry.join('code_b', 'm3', 'carol')
+            before = (await registry.count('code_a'), await registry.members('code_a'), await registry.rooms())
+            await registry.leave('code_a', 'm1')
+            await registry.leave('code_b', 'm3')
+            after = (await registry.count('code_a'), await registry.rooms())
+            return before, after
+
+        (count, members, rooms), after = asyncio.run(scenario())
+        self.assertEqual(count, 2)
+        self.assertEqual([member['username'] for member in members], ['alice', 'bob'])
+        self.assertEqual(rooms, {'code_a': 2, 'code_b': 1})
+        self.assertEqual(after, (1, {'code_a': 1}))
+
+    def test_members_expire_without_heartbeat(self):
+        async def scenario():
+            registry = PresenceRegistry()
+            await registry.join('code_a', 'm1', 'alice')
+            later = time.time() + 20
+            with mock.patch('code_editor.presence.time.time', return_value=later):
+                await registry.heartbeat()
+            with mock.patch('code_editor.presence.time.time', return_value=later + 20):
+                refreshed = await registry.count('code_a')
+            with mock.patch('code_editor.presence.time.time', return_value=later + 40):
+                expired = await registry.count('code_a')
+            return refreshed, expired
+
+        self.assertEqual(asyncio.run(scenario()), (1, 0))
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class PresenceConsumerTests(TransactionTestCase):
+    async def connect(self, username):
+        user = await database_sync_to_async(User.objects.create)(username=username)
+        communicator = WebsocketCommunicator(room_application, '/ws/code/presence/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_type(self, communicator, message_type):
+        while True:
+            message = await communicator.receive_json_from(1)
+            if message['type'] == message_type:
+                return message
+
+    def test_snapshot_on_join_and_leave_events(self):
+        async def scenario():
+            alice = await self.connect('alice')
+            first = await self.receive_type(alice, 'presence')
+            bob = await self.connect('bob')
+            second = await self.receive_type(bob, 'presence')
+            await self.receive_type(alice, 'system_message')
+            joined = await self.receive_type(alice, 'system_message')
+            await bob.disconnect()
+            left = await self.receive_type(alice, 'system_message')
+            count = await presence_registry.count('code_presence')
+            await alice.disconnect()
+            return first, second, joined, left, count, await presence_registry.count('code_presence')
+
+        first, second, joined, left, count, final = asyncio.run(scenario())
+        self.assertEqual([member['username'] for member in first['members']], ['alice'])
+        self.assertEqual([member['username'] for member in second['members']], ['alice', 'bob'])
+        self.assertEqual(joined['presence']['event'], 'join')
+        self.assertEqual(joined['presence']['member_id'], second['members'][1]['member_id'])
+        self.assertEqual(left['presence'], {**joined['presence'], 'event': 'leave'})
+        self.assertEqual((count, final), (1, 0))
+
+    def test_presence_view(self):
+        viewer = User.objects.create(username='viewer')
+        CodeRoom.objects.create(name='presence', creator=viewer)
+
+        async def get(room_name):
+            request = AsyncRequestFactory().get(f'/room/{room_name}/presence/')
+
+            async def auser():
+                return viewer
+            request.auser = auser
+            return await room_presence(request, room_name)
+
+        async def scenario():
+            alice = await self.connect('alice')
+            await self.receive_type(alice, 'presence')
+            response = await get('presence')
+            await alice.disconnect()
+            return response
+
+        response = asyncio.run(scenario())
+        self.assertEqual(json.loads(response.content), {'room': 'presence', 'count': 1, 'members': ['alice']})
+        with self.assertRaises(Http404):
+            asyncio.run(get('missing'))
+
+
+@override_settings(CHAT_HISTORY_SIZE=3, CHAT_PAGE_SIZE=2, CHAT_FLUSH_INTERVAL=60, CHAT_FLUSH_BATCH_SIZE=100)
+class ChatHistoryTests(TransactionTestCase):
+    def record(self, history, count, room='chat'):
+        async def record_all():
+            return [await history.record(room, 'alice', f'message {i}') for i in range(count)]
+        return asyncio.run(record_all())
+
+    def test_messages_are_written_in_batches(self):
+        history = ChatHistory()
+        self.record(history, 5)
+        self.assertEqual(ChatMessage.objects.count(), 0)
+        asyncio.run(history.flush())
+        self.assertEqual(ChatMessage.objects.count(), 5)
+
+        with override_settings(CHAT_FLUSH_BATCH_SIZE=3):
+            async def record_batch():
+                for i in range(3):
+                    await history.record('chat', 'bob', f'batch {i}')
+                await asyncio.sleep(0.05)
+            asyncio.run(record_batch())
+        self.assertEqual(ChatMessage.objects.count(), 8)
+
+    def test_recent_messages_come_from_memory(self):
+        history = ChatHistory()
+        self.record(history, 5)
+        with mock.patch.object(history, '_read') as read:
+            recent = asyncio.run(history.recent('chat'))
+        read.assert_not_called()
+        self.assertEqual([message['message'] for message in recent], ['message 2', 'message 3', 'message 4'])
+
+        # A fresh process loads the same buffer from the database
+        asyncio.run(history.flush())
+        recent = asyncio.run(ChatHistory().recent('chat'))
+        self.assertEqual([message['message'] for message in recent], ['message 2', 'message 3', 'message 4'])
+
+    def test_backfill_pages_through_older_messages(self):
+        history = ChatHistory()
+        self.record(history, 7)
+        self.record(history, 2, room='other')
+        recent = asyncio.run(history.recent('chat'))
+
+        pages = []
+        before = recent[0]['created_at']
+        while True:
+            messages, has_more = asyncio.run(history.history('chat', before))
+            pages.append(([message['message'] for message in messages], has_more))
+            if not has_more:
+                break
+            before = messages[0]['created_at']
+        self.assertEqual(pages, [
+            (['message 2', 'message 3'], True),
+            (['message 0', 'message 1'], False),
+        ])
+        with self.assertRaises(ValueError):
+            asyncio.run(history.history('chat', 'yesterday'))
+
+    def test_backfill_waits_for_a_flush_in_progress(self):
+        history = ChatHistory()
+        write = history._write
+        writes = []
+
+        async def slow_write(rows):
+            writes.append(len(rows))
+            await asyncio.sleep(0.2)
+            await write(rows)
+
+        async def scenario():
+            for i in range(5):
+                await history.record('chat', 'alice', f'message {i}')
+            with mock.patch.object(history, '_write', slow_write):
+                # A background flush has taken every queued message but not written them yet
+                history._flush_soon()
+                await asyncio.sleep(0)
+                return await history.history('chat', history._last_created_at.isoformat(), limit=10)
+
+        messages, has_more = asyncio.run(scenario())
+        self.assertEqual(writes, [5])
+        self.assertEqual([message['message'] for message in messages], [f'message {i}' for i in range(4)])
+        self.assertFalse(has_more)
+
+    def test_failed_writes_keep_a_bounded_queue(self):
+        history = ChatHistory()
+        self.record(history, 5)
+        with override_settings(CHAT_MAX_PENDING=3), \
+                mock.patch.object(history, '_write', side_effect=RuntimeError('database is down')):
+            with self.assertLogs('code_editor.chat', 'ERROR') as logs:
+                asyncio.run(history.flush())
+        self.assertEqual([row.message for row in history._pending], ['message 2', 'message 3', 'message 4'])
+        self.assertIn('dropped 2 unwritten messages', logs.output[-1])
+
+        asyncio.run(history.flush())
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('created_at').values_list('message', flat=True)),
+            ['message 2', 'message 3', 'message 4']
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+    CHAT_HISTORY_SIZE=2,
+    CHAT_PAGE_SIZE=10,
+)
+class ChatConsumerTests(TransactionTestCase):
+    def test_history_on_join_and_backfill(self):
+        history = ChatHistory()
+
+        async def receive_type(communicator, message_type):
+            while True:
+                message = await communicator.receive_json_from(1)
+                if message['type'] == message_type:
+                    return message
+
+        async def scenario():
+            sender = WebsocketCommunicator(room_application, '/ws/code/chatroom/')
+            sender.scope['user'] = AnonymousUser()
+            await sender.connect()
+            for i in range(3):
+                await sender.send_json_to({'type': 'chat_message', 'message': f'<b>{i}</b>'})
+                await receive_type(sender, 'chat_message')
+
+            joiner = WebsocketCommunicator(room_application, '/ws/code/chatroom/')
+            joiner.scope['user'] = AnonymousUser()
+            await joiner.connect()
+            joined = await receive_type(joiner, 'chat_history')
+            await joiner.send_json_to({'type': 'chat_backfill', 'before': joined['messages'][0]['created_at']})
+            older = await receive_type(joiner, 'chat_history')
+            await sender.disconnect()
+            await joiner.disconnect()
+            return joined, older
+
+        with mock.patch('code_editor.consumers.chat_history', history):
+            joined, older = asyncio.run(scenario())
+        self.assertEqual([message['message'] for message in joined['messages']], ['<b>1</b>', '<b>2</b>'])
+        self.assertTrue(joined['has_more'])
+        self.assertEqual([message['message'] for message in older['messages']], ['<b>0</b>'])
+        self.assertFalse(older['has_more'])
+
+
+class CountingLayer(InMemoryChannelLayer):
+    """Stands in for Redis shared by several nodes, counting what goes through it."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def send(self, channel, message):
+        self.sent.append(channel)
+        await super().send(channel, message)
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    def nodes(self, count, **kwargs):
+        remote = CountingLayer()
+        return remote, [HybridChannelLayer(remote=remote, **kwargs) for _ in range(count)]
+
+    async def settle(self):
+        # Let membership announcements reach the other nodes
+        await asyncio.sleep(0.05)
+
+    async def receive_all(self, layer, channels):
+        return [await asyncio.wait_for(layer.receive(channel), 1) for channel in channels]
+
+    async def assert_nothing_for(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+    def test_local_members_never_reach_the_remote_layer(self):
+        async def scenario():
+            remote, (node,) = self.nodes(1)
+            channels = [await node.new_channel() for _ in range(3)]
+            for channel in channels:
+                await node.group_add('room', channel)
+            await self.settle()
+            sent = len(remote.sent)
+            await node.group_send('room', {'type': 'chat', 'text': 'hi'})
+            return remote.sent[sent:], await self.receive_all(node, channels)
+
+        sent, received = asyncio.run(scenario())
+        self.assertEqual(received, [{'type': 'chat', 'text': 'hi'}] * 3)
+        self.assertEqual(sent, [])
+
+    def test_mixed_membership_gets_each_message_once(self):
+        async def scenario():
+            remote, (a, b, c) = self.nodes(3)
+            a_channels = [await a.new_channel(), await a.new_channel()]
+            b_channel = await b.new_channel()
+            for channel in a_channels:
+                await a.group_add('room', channel)
+            await b.group_add('room', b_channel)
+            # c starts after the others joined, and learns their groups when it says hello
+            await c.new_channel()
+            await self.settle()
+
+            # From a node with members, and from one without
+            sent = len(remote.sent)
+            await a.group_send('room', {'type': 'chat', 'text': 'from a'})
+            sent_from_a = remote.sent[sent:]
+            from_a = await self.receive_all(a, a_channels) + await self.receive_all(b, [b_channel])
+            sent = len(remote.sent)
+            await c.group_send('room', {'type': 'chat', 'text': 'from c'})
+            sent_from_c = remote.sent[sent:]
+            from_c = await self.receive_all(a, a_channels) + await self.receive_all(b, [b_channel])
+
+            for channel in a_channels:
+                await self.assert_nothing_for(a, channel)
+            await self.assert_nothing_for(b, b_channel)
+            return from_a, sent_from_a, from_c, sent_from_c
+
+        from_a, sent_from_a, from_c, sent_from_c = asyncio.run(scenario())
+        self.assertEqual([message['text'] for message in from_a], ['from a'] * 3)
+        self.assertEqual([message['text'] for message in from_c], ['from c'] * 3)
+        # One message per other node with members, not per member
+        self.assertEqual(len(sent_from_a), 1)
+        self.assertEqual(len(sent_from_c), 2)
+
+    def test_send_to_a_channel_of_another_node(self):
+        async def scenario():
+            _, (a, b) = self.nodes(2)
+            channel = await b.new_channel()
+            await a.send(channel, {'type': 'direct'})
+            return await asyncio.wait_for(b.receive(channel), 1)
+
+        self.assertEqual(asyncio.run(scenario()), {'type': 'direct'})
+
+    def test_node_leaves_the_group_with_its_last_member(self):
+        async def scenario():
+            remote, (a, b) = self.nodes(2)
+            a_channel = await a.new_channel()
+            b_channels = [await b.new_channel(), await b.new_channel()]
+            await a.group_add('room', a_channel)
+            for channel in b_channels:
+                await b.group_add('room', channel)
+            await b.group_discard('room', b_channels[0])
+            await self.settle()
+            still_joined = b.node_channel in a._members.get('room', {})
+            await b.group_discard('room', b_channels[1])
+            await self.settle()
+            left = b.node_channel not in a._members.get('room', {})
+
+            sent = len(remote.sent)
+            await a.group_send('room', {'type': 'chat'})
+            await a.receive(a_channel)
+            return still_joined, left, remote.sent[sent:]
+
+        still_joined, left, sent = asyncio.run(scenario())
+        self.assertTrue(still_joined)
+        self.assertTrue(left)
+        self.assertEqual(sent, [])
+
+    def test_silent_nodes_are_forgotten(self):
+        async def scenario():
+            _, (a, b) = self.nodes(2, heartbeat=0.02)
+            await a.new_channel()
+            await b.group_add('room', await b.new_channel())
+            await self.settle()
+            known = b.node_channel in a._members.get('room', {})
+            # b's process dies without leaving
+            b._receiver.cancel()
+            b._heartbeat.cancel()
+            await asyncio.sleep(0.15)
+            return known, a._members.get('room', {}), b.node_channel in a._heard
+
+        known, members, heard = asyncio.run(scenario())
+        self.assertTrue(known)
+        self.assertEqual(members, {})
+        self.assertFalse(heard)
+
+    def test_full_local_channel_does_not_block_the_group(self):
+        async def scenario():
+            remote = CountingLayer()
+            a = HybridChannelLayer(remote=remote, capacity=1)
+            b = HybridChannelLayer(remote=remote, capacity=1)
+            slow, fast = await a.new_channel(), await b.new_channel()
+            await a.group_add('room', slow)
+            await b.group_add('room', fast)
+            await self.settle()
+            await a.group_send('room', {'type': 'chat', 'text': 'first'})
+            first = await b.receive(fast)
+            await a.group_send('room', {'type': 'chat', 'text': 'second'})
+            second = await b.receive(fast)
+            return first, second, await a.receive(slow)
+
+        first, second, slow = asyncio.run(scenario())
+        self.assertEqual((first['text'], second['text']), ('first', 'second'))
+        self.assertEqual(slow['text'], 'first')
+
+
+class NodeBConsumer(CodeEditorConsumer):
+    # A consumer of a second server process, on its own layer
+    channel_layer_alias = 'node_b'
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class HybridLayerConsumerTests(TransactionTestCase):
+    def test_chat_reaches_members_on_another_node(self):
+        remote = CountingLayer()
+        channel_layers.set('default', HybridChannelLayer(remote=remote))
+        channel_layers.set('node_b', HybridChannelLayer(remote=remote))
+        node_b_application = URLRouter([
+            re_path(r'ws/code/(?P<room_name>\w+)/$', NodeBConsumer.as_asgi()),
+        ])
+
+        async def receive_chat(communicator):
+            while True:
+                message = await communicator.receive_json_from(1)
+                if message['type'] == 'chat_message':
+                    return message
+
+        async def scenario():
+            communicators = []
+            for application in (room_application, room_application, node_b_application):
+                communicator = WebsocketCommunicator(application, '/ws/code/hybrid/')
+                communicator.scope['user'] = AnonymousUser()
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+            await communicators[0].send_json_to({'type': 'chat_message', 'message': 'hello'})
+            received = [await receive_chat(communicator) for communicator in communicators]
+            for communicator in communicators:
+                await communicator.disconnect()
+            return received
+
+        with mock.patch('code_editor.consumers.chat_history', ChatHistory()):
+            received = asyncio.run(scenario())
+        self.assertEqual([message['message'] for message in received], ['hello'] * 3)
+        # Only node B's copy of the chat message went through the shared layer
+        self.assertIn(channel_layers['node_b'].node_channel, remote.sent)
+
+
+class HashRingTests(SimpleTestCase):
+    rooms = [f'room{index}' for index in range(3000)]
+
+    def test_rooms_spread_over_nodes(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for room in self.rooms:
+            node = ring.node_for(room)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        for count in counts.values():
+            self.assertGreater(count, len(self.rooms) / 3 * 0.7)
+
+    def test_only_rooms_of_the_changed_node_move(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = {room: ring.node_for(room) for room in self.rooms}
+        ring.add('d')
+        joined = {room: ring.node_for(room) for room in self.rooms}
+        moved = [room for room in self.rooms if joined[room] != before[room]]
+        self.assertTrue(all(joined[room] == 'd' for room in moved))
+        self.assertLess(len(moved), len(self.rooms) / 4 * 1.3)
+
+        ring.remove('d')
+        self.assertEqual({room: ring.node_for(room) for room in self.rooms}, before)
+        self.assertIsNone(HashRing().node_for('room'))
+
+
+placed_application = URLRouter([
+    re_path(r'ws/code/(?P<room_name>\w+)/$', RoomAffinityMiddleware(CodeEditorConsumer.as_asgi())),
+])
+NODES = {'a': 'ws://a.example.com', 'b': 'ws://b.example.com'}
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+    ROOM_NODE_ID='a',
+    ROOM_NODE_URL=NODES['a'],
+    ROOM_NODES=NODES,
+    ROOM_NODES_REDIS_URL=None,
+)
+class RoomPlacementTests(TransactionTestCase):
+    def setUp(self):
+        self.placement = RoomPlacement()
+        for target in ('code_editor.placement.room_placement', 'code_editor.consumers.room_placement'):
+            patcher = mock.patch(target, self.placement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def room_on(self, node, nodes=NODES):
+        ring = HashRing(nodes)
+        return next(f'room{index}' for index in itertools.count() if ring.node_for(f'room{index}') == node)
+
+    async def connect(self, room):
+        communicator = WebsocketCommunicator(placed_application, f'/ws/code/{room}/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_connection_to_another_nodes_room_is_redirected(self):
+        local, remote = self.room_on('a'), self.room_on('b')
+
+        async def scenario():
+            redirected = await self.connect(remote)
+            redirect = await redirected.receive_json_from(1)
+            closed = await redirected.receive_output(1)
+            served = await self.connect(local)
+            snapshot = await served.receive_json_from(1)
+            await served.disconnect()
+            return redirect, closed, snapshot
+
+        redirect, closed, snapshot = asyncio.run(scenario())
+        self.assertEqual(redirect, {'type': 'redirect', 'url': f'ws://b.example.com/ws/code/{remote}/'})
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': REDIRECT_CLOSE_CODE})
+        self.assertEqual(snapshot['type'], 'code_snapshot')
+
+    def test_members_move_when_a_node_joins(self):
+        room = self.room_on('b')
+
+        async def scenario():
+            communicator = await self.connect(room)
+            await communicator.receive_json_from(1)
+            moved = await self.placement.update(NODES)
+            while True:
+                message = await communicator.receive_json_from(1)
+                if message['type'] == 'redirect':
+                    break
+            closed = await communicator.receive_output(1)
+            return moved, message, closed
+
+        # Alone until b joins
+        with override_settings(ROOM_NODES={}):
+            moved, redirect, closed = asyncio.run(scenario())
+        self.assertEqual(moved, [room])
+        self.assertEqual(redirect['url'], f'ws://b.example.com/ws/code/{room}/')
+        self.assertEqual(closed['code'], REDIRECT_CLOSE_CODE)
+        self.assertEqual(self.placement.owner(room), ('b', NODES['b']))
+
+    def test_single_node_serves_every_room(self):
+        with override_settings(ROOM_NODES={}):
+            self.assertIsNone(RoomPlacement().owner('room'))
+        with override_settings(ROOM_NODE_URL=None):
+            self.assertIsNone(RoomPlacement().owner('room'))
+
+    def test_node_ids_are_unique_per_process(self):
+        def node_id(**env):
+            environ = {name: value for name, value in os.environ.items() if not name.startswith('ROOM_NODE')}
+            return subprocess.run(
+                [sys.executable, '-c', 'from collaborative_code_editor import settings; print(settings.ROOM_NODE_ID)'],
+                cwd=settings.BASE_DIR, env=dict(environ, **env), capture_output=True, text=True,
+            )
+
+        first, second = node_id(), node_id()
+        self.assertNotEqual(first.stdout, second.stdout)
+        self.assertEqual(node_id(ROOM_NODE_ID='a').stdout, 'a\n')
+        # A fixed node list needs to know which entry this process is
+        unnamed = node_id(ROOM_NODES='a=ws://a.example.com,b=ws://b.example.com')
+        self.assertNotEqual(unnamed.returncode, 0)
+        self.assertIn('ROOM_NODE_ID must be set', unnamed.stderr)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class MetricsTests(TransactionTestCase):
+    def test_render_prometheus_text(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'Things counted.', ['kind'], registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'Time taken.', ['kind'], buckets=(0.1, 1), registry=registry)
+        counter.inc(kind='a "quoted"')
+        counter.inc(2, kind='a "quoted"')
+        for value in (0.05, 0.5, 3):
+            histogram.observe(value, kind='b')
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP test_total Things counted.',
+            '# TYPE test_total counter',
+            'test_total{kind="a \\"quoted\\""} 3',
+            '# HELP test_seconds Time taken.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{kind="b",le="0.1"} 1',
+            'test_seconds_bucket{kind="b",le="1"} 2',
+            'test_seconds_bucket{kind="b",le="+Inf"} 3',
+            'test_seconds_sum{kind="b"} 3.55',
+            'test_seconds_count{kind="b"} 3',
+        ]) + '\n')
+
+    def test_slow_handlers_are_logged(self):
+        with override_settings(SLOW_HANDLER_THRESHOLD=0.1):
+            with self.assertLogs('code_editor.metrics', 'WARNING') as logs:
+                metrics.observe_handler('room1', 'code_delta', 0.25)
+                metrics.observe_handler('room1', 'chat_message', 0.01)
+        self.assertEqual(logs.output, ['WARNING:code_editor.metrics:Slow handler: code_delta in room room1 took 250ms'])
+
+    def test_consumer_records_messages_and_fanout(self):
+        messages = metrics.ws_messages.value(type='chat_message')
+        handled = metrics.ws_handler_seconds.count(type='chat_message')
+        fanouts = metrics.room_fanout.count(type='chat_message')
+
+        async def scenario():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(room_application, '/ws/code/metricsroom/')
+                communicator.scope['user'] = AnonymousUser()
+                await communicator.connect()
+                communicators.append(communicator)
+            await communicators[0].send_json_to({'type': 'chat_message', 'message': 'hi'})
+            while (await communicators[1].receive_json_from(1))['type'] != 'chat_message':
+                pass
+            for communicator in communicators:
+                await communicator.disconnect()
+
+        with mock.patch.object(metrics.room_fanout, 'observe', wraps=metrics.room_fanout.observe) as observe:
+            asyncio.run(scenario())
+        self.assertEqual(metrics.ws_messages.value(type='chat_message'), messages + 1)
+        self.assertEqual(metrics.ws_handler_seconds.count(type='chat_message'), handled + 1)
+        self.assertEqual(metrics.room_fanout.count(type='chat_message'), fanouts + 1)
+        # Both members are present when the message is sent
+        self.assertIn(mock.call(2, type='chat_message'), observe.call_args_list)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_requires_staff_or_token(self):
+        def get(**headers):
+            request = RequestFactory().get('/metrics/', **headers)
+            request.user = AnonymousUser()
+            return metrics_view(request)
+
+        self.assertEqual(get().status_code, 403)
+        self.assertEqual(get(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = get(HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE codecolab_ws_handler_seconds histogram', response.content.decode())
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}},
+    DOCUMENT_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+    EXECUTION_WARM_WORKERS=0,
+)
+class LoadTestTests(TransactionTestCase):
+    # Small by default; see code_editor/loadtest.py for scaling it up
+    def test_rooms_under_load(self):
+        report = asyncio.run(run_load(
+            rooms=int(os.getenv('LOADTEST_ROOMS', '4')),
+            users=int(os.getenv('LOADTEST_USERS', '8')),
+            messages=int(os.getenv('LOADTEST_MESSAGES', '15')),
+        ))
+        sys.stderr.write(f"\n{format_report(report)}\n")
+
+        # Chat reaches every member of the room, the sender included
+        self.assertEqual(report['latency_ms']['chat_message']['count'] % report['users'], 0)
+        # Deltas reach every other member
+        self.assertEqual(report['latency_ms']['code_delta']['count'] % (report['users'] - 1), 0)
+        self.assertGreater(report['latency_ms']['cursor_update']['count'], 0)
+        self.assertGreater(report['received_per_second'], 0)
+        self.assertGreater(report['memory_per_connection_kb'], 0)
@@ -11,6 +11,9 @@ urlpatterns = [
     path('join/', views.JoinRoomView.as_view(), name='join_room'),
     path('create/', views.CreateRoomView.as_view(), name='create_room'),
     path('room/<str:room_name>/', views.CodeRoomView.as_view(), name='code_room'),
+    path('room/<str:room_name>/presence/', views.room_presence, name='room_presence'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('metrics/outbound/', views.outbound_queue_metrics, name='outbound_queue_metrics'),
     path('update-interests/', views.update_interests, name='update_interests'),
     path('ai-autocomplete/', views.HuggingFaceAutocompleteView.as_view(), name='ai_autocomplete'),
     path('migrate-now/', migrate_now),
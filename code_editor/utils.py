@@ -1,154 +1,166 @@
-import math
-import random
+import numpy as np
+from scipy import sparse
+
+# Profile count above which clustering switches to mini-batch k-means
+MINI_BATCH_THRESHOLD = 20000
+MINI_BATCH_SIZE = 2048
+
 
 def create_tfidf_matrix(documents):
     """
     Create a TF-IDF matrix from a list of documents.
-    
+
+    Words are lower-cased and split on whitespace. A term's weight is its
+    frequency in the document times ``log((n + 1) / (df + 1)) + 1``, and every
+    non-empty row is scaled to unit length.
+
     Args:
         documents: List of strings, each representing a document
-        
+
     Returns:
-        vocabulary: Dictionary mapping words to indices
-        tfidf_matrix: List of TF-IDF vectors, one per document
+        vocabulary: Dictionary mapping words to column indices, in order of first appearance
+        tfidf_matrix: scipy.sparse CSR matrix with one row per document
     """
-    # Create vocabulary
+    # One pass collects term counts per document and document frequencies
     vocabulary = {}
-    word_index = 0
-    for doc in documents:
-        for word in doc.lower().split():
-            if word not in vocabulary:
-                vocabulary[word] = word_index
-                word_index += 1
-    
-    # Calculate TF-IDF matrix
-    tfidf_matrix = []
+    indptr = [0]
+    indices = []
+    counts = []
+    lengths = []
     for doc in documents:
-        # Calculate term frequency
-        tf = {}
-        doc_words = doc.lower().split()
-        doc_len = len(doc_words)
-        for word in doc_words:
-            tf[word] = tf.get(word, 0) + 1
-        
-        # Calculate TF-IDF vector
-        tfidf_vector = [0] * len(vocabulary)
-        for word, freq in tf.items():
-            if word in vocabulary:
-                # TF part
-                tf_value = freq / max(doc_len, 1)  # Avoid division by zero
-                
-                # IDF part
-                doc_with_term = sum(1 for d in documents if word in d.lower().split())
-                idf_value = math.log((len(documents) + 1) / (doc_with_term + 1)) + 1
-                
-                # TF-IDF
-                tfidf_vector[vocabulary[word]] = tf_value * idf_value
-        
-        # Normalize vector
-        magnitude = math.sqrt(sum(x**2 for x in tfidf_vector))
-        if magnitude > 0:
-            tfidf_vector = [x/magnitude for x in tfidf_vector]
-        
-        tfidf_matrix.append(tfidf_vector)
-    
+        words = doc.lower().split()
+        term_counts = {}
+        for word in words:
+            column = vocabulary.setdefault(word, len(vocabulary))
+            term_counts[column] = term_counts.get(column, 0) + 1
+        indices.extend(term_counts.keys())
+        counts.extend(term_counts.values())
+        indptr.append(len(indices))
+        lengths.append(len(words))
+
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    document_frequency = np.bincount(indices, minlength=len(vocabulary))
+    idf = np.log((len(documents) + 1) / (document_frequency + 1)) + 1
+
+    # Term frequency times IDF
+    rows = np.repeat(np.arange(len(documents)), np.diff(indptr))
+    lengths = np.asarray(lengths, dtype=np.float64)
+    data = np.asarray(counts, dtype=np.float64) / lengths[rows] * idf[indices]
+
+    # Normalize rows
+    norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=len(documents)))
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    data *= scale[rows]
+
+    tfidf_matrix = sparse.csr_matrix(
+        (data, indices, indptr), shape=(len(documents), len(vocabulary))
+    )
     return vocabulary, tfidf_matrix
 
 
-def kmeans_clustering(data, num_clusters, max_iterations=100, random_seed=42):
+def _dense_row(data, index):
+    row = data[index]
+    return row.toarray().ravel() if sparse.issparse(row) else np.array(row, dtype=np.float64)
+
+
+def _squared_distances(data, row_norms, centroids):
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, for every point against every centroid
+    distances = row_norms[:, None] - 2 * np.asarray(data @ centroids.T) + (centroids ** 2).sum(axis=1)[None, :]
+    return np.maximum(distances, 0)
+
+
+def _kmeans_plus_plus(data, row_norms, num_clusters, rng):
+    """Pick initial centroids, each new one drawn with probability proportional to D(x)^2."""
+    centroids = np.empty((num_clusters, data.shape[1]))
+    centroids[0] = _dense_row(data, rng.integers(data.shape[0]))
+    closest = _squared_distances(data, row_norms, centroids[:1]).ravel()
+    for j in range(1, num_clusters):
+        total = closest.sum()
+        if total > 0:
+            index = rng.choice(data.shape[0], p=closest / total)
+        else:
+            # Every point coincides with a centroid already
+            index = rng.integers(data.shape[0])
+        centroids[j] = _dense_row(data, index)
+        closest = np.minimum(closest, _squared_distances(data, row_norms, centroids[j:j + 1]).ravel())
+    return centroids
+
+
+def _cluster_sums(data, clusters, num_clusters):
+    """Per-cluster sum of the points and number of points."""
+    membership = sparse.csr_matrix(
+        (np.ones(len(clusters)), (clusters, np.arange(len(clusters)))),
+        shape=(num_clusters, len(clusters)),
+    )
+    sums = membership @ data
+    sums = sums.toarray() if sparse.issparse(sums) else np.asarray(sums)
+    return sums, np.bincount(clusters, minlength=num_clusters)
+
+
+def kmeans_clustering(data, num_clusters, max_iterations=100, random_seed=42, tolerance=1e-4, batch_size=None):
     """
     Perform K-means clustering on the given data.
-    
+
+    Centroids are seeded with k-means++. Without ``batch_size`` every
+    iteration assigns all points (Lloyd's algorithm); with it, each iteration
+    updates the centroids from a random mini-batch of that many points and
+    all points are assigned once at the end.
+
     Args:
-        data: List of vectors to cluster
+        data: Vectors to cluster - a list of lists, a NumPy array or a scipy.sparse matrix
         num_clusters: Number of clusters to form
         max_iterations: Maximum number of iterations to perform
         random_seed: Random seed for reproducibility
-        
+        tolerance: Stop once the centroids move less than this (sum of squared shifts)
+        batch_size: Points per iteration for mini-batch k-means, None for full batches
+
     Returns:
-        clusters: List of cluster assignments for each data point
-        centroids: List of cluster centroids
+        clusters: NumPy array of cluster assignments for each data point
+        centroids: NumPy array of cluster centroids
     """
-    if not data or num_clusters <= 0 or num_clusters > len(data):
+    data = data.tocsr() if sparse.issparse(data) else np.asarray(data, dtype=np.float64)
+    if data.ndim != 2 or not data.shape[0] or num_clusters <= 0 or num_clusters > data.shape[0]:
         return [], []
-    
-    # Initialize centroids randomly
-    random.seed(random_seed)
-    centroid_indices = random.sample(range(len(data)), num_clusters)
-    centroids = [data[idx].copy() for idx in centroid_indices]
-    
-    # K-means clustering
-    clusters = [0] * len(data)
-    
+
+    rng = np.random.default_rng(random_seed)
+    row_norms = np.asarray(data.multiply(data).sum(axis=1)).ravel() if sparse.issparse(data) else (data ** 2).sum(axis=1)
+    centroids = _kmeans_plus_plus(data, row_norms, num_clusters, rng)
+
+    if batch_size is not None and batch_size < data.shape[0]:
+        counts = np.zeros(num_clusters)
+        for _ in range(max_iterations):
+            batch = rng.choice(data.shape[0], batch_size, replace=False)
+            batch_data = data[batch]
+            assigned = _squared_distances(batch_data, row_norms[batch], centroids).argmin(axis=1)
+            sums, batch_counts = _cluster_sums(batch_data, assigned, num_clusters)
+
+            # Equivalent to moving each centroid towards every point with rate 1 / count
+            updated = counts + batch_counts
+            moved = batch_counts > 0
+            previous = centroids.copy()
+            centroids[moved] = (centroids[moved] * counts[moved, None] + sums[moved]) / updated[moved, None]
+            counts = updated
+            if ((centroids - previous) ** 2).sum() <= tolerance:
+                break
+        clusters = _squared_distances(data, row_norms, centroids).argmin(axis=1)
+        return clusters, centroids
+
+    clusters = None
     for _ in range(max_iterations):
         # Assign points to clusters
-        prev_clusters = clusters.copy()
-        for i, point in enumerate(data):
-            min_dist = float('inf')
-            cluster_idx = 0
-            
-            for j, centroid in enumerate(centroids):
-                # Calculate Euclidean distance
-                dist = math.sqrt(sum((p-c)**2 for p, c in zip(point, centroid)))
-                if dist < min_dist:
-                    min_dist = dist
-                    cluster_idx = j
-            
-            clusters[i] = cluster_idx
-        
-        # Check for convergence
-        if prev_clusters == clusters:
+        previous_clusters = clusters
+        clusters = _squared_distances(data, row_norms, centroids).argmin(axis=1)
+        if previous_clusters is not None and np.array_equal(previous_clusters, clusters):
             break
-        
-        # Update centroids
-        for j in range(num_clusters):
-            cluster_points = [data[i] for i in range(len(data)) if clusters[i] == j]
-            if cluster_points:
-                # Calculate mean of points in cluster
-                vector_length = len(data[0])
-                centroid = [0] * vector_length
-                for point in cluster_points:
-                    for k in range(vector_length):
-                        centroid[k] += point[k]
-                
-                centroids[j] = [x/len(cluster_points) for x in centroid]
-    
-    return clusters, centroids
 
+        # Update centroids; a cluster that lost all its points keeps its centroid
+        sums, counts = _cluster_sums(data, clusters, num_clusters)
+        previous = centroids.copy()
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if ((centroids - previous) ** 2).sum() <= tolerance:
+            clusters = _squared_distances(data, row_norms, centroids).argmin(axis=1)
+            break
 
-def find_similar_profiles(user_profile, profiles, max_clusters=5):
-    """
-    Find profiles similar to the user profile based on interests using TF-IDF and K-means.
-    
-    Args:
-        user_profile: User profile object with interests attribute
-        profiles: List of other profile objects with interests attribute
-        max_clusters: Maximum number of clusters to form
-        
-    Returns:
-        similar_profiles: List of profiles similar to the user
-    """
-    if not profiles:
-        return []
-    
-    # Extract interests
-    all_interests = [user_profile.interests] + [profile.interests for profile in profiles]
-    
-    # Create TF-IDF matrix
-    _, tfidf_matrix = create_tfidf_matrix(all_interests)
-    
-    # Determine number of clusters
-    num_clusters = min(len(profiles), max_clusters)
-    
-    # Perform K-means clustering
-    clusters, _ = kmeans_clustering(tfidf_matrix, num_clusters)
-    
-    # Get user's cluster
-    user_cluster = clusters[0]
-    
-    # Find similar profiles (in the same cluster as the user)
-    similar_profiles = [
-        profiles[i] for i in range(len(profiles)) if clusters[i + 1] == user_cluster
-    ]
-    
-    return similar_profiles
\ No newline at end of file
+    return clusters, centroids
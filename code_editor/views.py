@@ -1,30 +1,31 @@
-import os
 import json
 import random
 import string
-import requests
 
-from dotenv import load_dotenv
-from django.http import JsonResponse
-from django.shortcuts import render, redirect, get_object_or_404
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.views import View
 from django.views.generic import TemplateView, RedirectView
 from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login
 from django.contrib import messages
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
+from . import metrics as process_metrics
+from .completion import CompletionTimeout, UpstreamError, completer
 from .models import CodeRoom, Profile
-from .utils import *
-
-# Load environment variables
-load_dotenv()
-HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
+from .outbound import outbound_metrics
+from .presence import presence_registry
+from .recommendations import change_interests, get_recommended_rooms
 
 # ----------------- Home & Auth Views -----------------
 
@@ -35,15 +36,8 @@ class HomeView(LoginRequiredMixin, TemplateView):
         context = super().get_context_data(**kwargs)
         user_profile = self.request.user.profile
 
-        profiles = Profile.objects.exclude(interests="").exclude(user=self.request.user)
-        
-        recommended_rooms = []
-        if profiles:
-            similar_profiles = find_similar_profiles(user_profile, list(profiles), max_clusters=5)
-            
-            recommended_rooms = CodeRoom.objects.filter(creator__profile__in=similar_profiles).distinct()[:5]
-
-        context['recommended_rooms'] = recommended_rooms
+        # Precomputed in bulk, see code_editor/recommendations.py
+        context['recommended_rooms'] = get_recommended_rooms(user_profile)
         return context
 
 class RegisterView(View):
@@ -151,13 +145,41 @@ INTERESTS_CHOICES = {
     ]
 }
 
+@login_required
+async def room_presence(request, room_name):
+    await aget_object_or_404(CodeRoom, name=room_name)
+    # Same group name as CodeEditorConsumer
+    group = f'code_{room_name}'
+    members = await presence_registry.members(group)
+    return JsonResponse({
+        "room": room_name,
+        "count": len(members),
+        "members": [member["username"] for member in members]
+    })
+
+@staff_member_required
+def outbound_queue_metrics(request):
+    # Outbound queues of the WebSocket connections served by this process
+    return JsonResponse(outbound_metrics.snapshot())
+
+def metrics(request):
+    # Prometheus scrape endpoint: staff sessions, or "Authorization: Bearer <METRICS_TOKEN>"
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    header = request.headers.get('Authorization', '')
+    authorized = bool(token) and hmac.compare_digest(header, f"Bearer {token}")
+    if not authorized and not (request.user.is_active and request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(
+        process_metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
 @login_required
 def update_interests(request):
     profile = request.user.profile
     if request.method == "POST":
         interests = request.POST.get("interests", "")
-        profile.interests = interests
-        profile.save()
+        if interests != profile.interests:
+            change_interests(profile, interests)
         return redirect("home")
     return render(request, "interests.html", {"interests_choices": INTERESTS_CHOICES})
 
@@ -165,7 +187,8 @@ def update_interests(request):
 
 @method_decorator(csrf_exempt, name='dispatch')
 class HuggingFaceAutocompleteView(View):
-    def post(self, request, *args, **kwargs):
+    # Async so that waiting on the model does not hold a server thread
+    async def post(self, request, *args, **kwargs):
         try:
             # Ensure request body exists
             if not request.body:
@@ -184,47 +207,18 @@ class HuggingFaceAutocompleteView(View):
             if not code:
                 return JsonResponse({"error": "Code field is required"}, status=400)
 
-            # Construct the prompt using language
-            prompt = f"Complete the following {language} code:\n{code}"
-
-            headers = {
-                "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
-                "Content-Type": "application/json"
-            }
-
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_new_tokens": 64,
-                    "return_full_text": False
-                }
-            }
-
-            response = requests.post(
-                "https://api-inference.huggingface.co/models/Salesforce/codegen-350M-mono",
-                headers=headers,
-                json=payload
-            )
-
             try:
-                result = response.json()
-            except ValueError:
-                return JsonResponse({"error": "Invalid response from Hugging Face API"}, status=500)
-
-            # Handle response errors
-            if response.status_code != 200:
+                suggestion = await completer.complete(language, code)
+            except CompletionTimeout as e:
+                return JsonResponse({"error": str(e)}, status=504)
+            except UpstreamError as e:
                 return JsonResponse({
-                    "error": "Hugging Face API returned an error",
-                    "status_code": response.status_code,
-                    "details": result
+                    "error": str(e),
+                    "status_code": e.status_code,
+                    "details": e.details
                 }, status=500)
 
-            # Extract generated text
-            if isinstance(result, list) and result:
-                generated_text = result[0].get("generated_text", "")
-                return JsonResponse({"suggestion": generated_text}, status=200)
-            else:
-                return JsonResponse({"error": "Unexpected response format", "details": result}, status=500)
+            return JsonResponse({"suggestion": suggestion}, status=200)
 
         except Exception as e:
             return JsonResponse({"error": "Internal server error", "details": str(e)}, status=500)
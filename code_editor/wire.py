@@ -0,0 +1,72 @@
+"""
+Wire formats for the room WebSocket.
+
+Clients pick a format through the WebSocket subprotocol: ``codecolab.msgpack``
+sends binary MessagePack frames, ``codecolab.json`` (or no subprotocol at all,
+for older clients) sends JSON text frames.
+
+Broadcasts are encoded by the sender, once per format, and the frames travel
+in the channel layer event; recipients send the frame of their format as it
+is instead of serialising the same message once per member.
+"""
+import json
+
+import msgpack
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Subprotocol -> format, in order of preference
+SUBPROTOCOLS = {
+    'codecolab.msgpack': MSGPACK,
+    'codecolab.json': JSON,
+}
+
+
+class WireError(ValueError):
+    """Raised for frames that cannot be decoded."""
+
+
+def negotiate(requested):
+    """
+    Pick the wire format for a connection.
+
+    Args:
+        requested: Subprotocols offered by the client, from scope['subprotocols']
+
+    Returns:
+        (subprotocol, format) - subprotocol is None when the client offered none we know
+    """
+    for subprotocol, wire_format in SUBPROTOCOLS.items():
+        if subprotocol in requested:
+            return subprotocol, wire_format
+    return None, JSON
+
+
+def encode(message, wire_format):
+    if wire_format == MSGPACK:
+        return msgpack.packb(message)
+    return json.dumps(message)
+
+
+def decode(text_data=None, bytes_data=None):
+    try:
+        if bytes_data is not None:
+            message = msgpack.unpackb(bytes_data)
+        else:
+            message = json.loads(text_data)
+    except (TypeError, ValueError, msgpack.UnpackException) as e:
+        raise WireError(f"Malformed frame: {str(e)}")
+    if not isinstance(message, dict):
+        raise WireError("Frames must hold an object")
+    return message
+
+
+def encode_all(message):
+    """
+    Encode a broadcast once for every recipient.
+
+    Returns:
+        Dictionary of wire format to frame
+    """
+    return {wire_format: encode(message, wire_format) for wire_format in SUBPROTOCOLS.values()}
@@ -0,0 +1,341 @@
+"""
+Out-of-process execution workers.
+
+With ``EXECUTION_QUEUE_URL`` set, the room consumer no longer runs programs
+next to the WebSockets it serves. It pushes a job onto a queue, and worker
+processes started with ``python manage.py run_execution_workers`` pull jobs
+and run them with their own ExecutionEngine. CPU-heavy programs then never
+compete with daphne for the event loop or the cores, and run capacity grows
+with the workers started, on this machine or any other sharing the queue
+and channel layer.
+
+The queue is a Redis list at ``EXECUTION_QUEUE_KEY`` for a ``redis://`` URL.
+Jobs are pushed on one end and popped from the other, so they start in the
+order they were submitted. ``memory://`` keeps jobs in an in-process queue
+instead, run by a worker started in the same event loop on the first job,
+for tests and single-process development.
+
+A worker answers on the channel layer to the job's ``reply_channel``, the
+requesting consumer's channel name, with ``execution.reply`` messages. Each
+one carries the job id, the frame to pass on to the client, and the
+worker's channel, where the consumer sends ``execution.cancel`` when its
+client leaves. Output is batched for up to ``EXECUTION_OUTPUT_INTERVAL``
+seconds per message.
+
+A worker tells the consumer it has taken a job with ``execution.accepted``.
+When the client leaves, the consumer removes its jobs still in the queue
+and cancels those already taken.
+
+Jobs are popped once. A job taken by a worker that dies is lost, and its
+requester never sees it exit. Jobs no worker picked up within
+``EXECUTION_JOB_TIMEOUT`` seconds are answered with an error instead of
+being run.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .execution import ExecutionEngine, ExecutionRejected
+
+logger = logging.getLogger(__name__)
+
+MEMORY_URL = 'memory://'
+
+
+class RedisJobQueue:
+    def __init__(self, url, key=None):
+        self.url = url
+        self._key = key
+        self._redis = None
+
+    @property
+    def key(self):
+        return self._key or getattr(settings, 'EXECUTION_QUEUE_KEY', 'codecolab:execution:jobs')
+
+    def _get_redis(self):
+        if self._redis is None:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(self.url)
+        return self._redis
+
+    async def push(self, job):
+        await self._get_redis().lpush(self.key, json.dumps(job))
+
+    async def pop(self, timeout=1):
+        """The oldest job, or None if none arrived within ``timeout`` seconds."""
+        item = await self._get_redis().brpop([self.key], timeout=timeout)
+        return None if item is None else json.loads(item[1])
+
+    async def remove(self, job):
+        """Take a job off the queue if no worker has popped it yet."""
+        # The same dictionary serialises to the same string that was pushed
+        await self._get_redis().lrem(self.key, 1, json.dumps(job))
+
+    async def depth(self):
+        return await self._get_redis().llen(self.key)
+
+
+class LocalJobQueue:
+    """In-process stand-in for the Redis list."""
+
+    def __init__(self, start_worker=False):
+        """
+        Args:
+            start_worker: Run jobs with an ExecutionWorker in the event loop that pushes them
+        """
+        self.start_worker = start_worker
+        self._loop = None
+        self._jobs = deque()
+        self._pushed = None
+        self._worker = None
+
+    def _bind(self):
+        # Events and tasks belong to one event loop; start over if the loop changed
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._jobs = deque()
+            self._pushed = asyncio.Condition()
+            self._worker = None
+        return self._pushed
+
+    async def push(self, job):
+        pushed = self._bind()
+        if self.start_worker and self._worker is None:
+            self._worker = asyncio.ensure_future(ExecutionWorker(self).run())
+        async with pushed:
+            # Copied through JSON like a job going through Redis
+            self._jobs.appendleft(json.loads(json.dumps(job)))
+            pushed.notify()
+
+    async def pop(self, timeout=1):
+        pushed = self._bind()
+        async with pushed:
+            try:
+                await asyncio.wait_for(pushed.wait_for(lambda: self._jobs), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return self._jobs.pop()
+
+    async def remove(self, job):
+        self._bind()
+        for queued in self._jobs:
+            if queued['id'] == job['id']:
+                self._jobs.remove(queued)
+                return
+
+    async def depth(self):
+        self._bind()
+        return len(self._jobs)
+
+
+_job_queues = {}  # URL -> queue
+
+
+def get_job_queue(url=None):
+    """The queue at ``url``, ``EXECUTION_QUEUE_URL`` by default, or None when programs run in process."""
+    url = url or getattr(settings, 'EXECUTION_QUEUE_URL', None)
+    if not url:
+        return None
+    queue = _job_queues.get(url)
+    if queue is None:
+        queue = _job_queues[url] = LocalJobQueue(start_worker=True) if url == MEMORY_URL else RedisJobQueue(url)
+    return queue
+
+
+def new_job(reply_channel, key, code, language, share=False):
+    """
+    Args:
+        reply_channel: Channel name the worker answers on
+        key: Queue the run belongs to on the worker, e.g. (room_name, user id)
+        code: Source code to execute
+        language: One of the languages ExecutionEngine runs
+        share: Passed on to ExecutionEngine.run
+    """
+    return {
+        'id': uuid.uuid4().hex,
+        'reply_channel': reply_channel,
+        'key': list(key),
+        'code': code,
+        'language': language,
+        'share': share,
+        'expires_at': time.time() + getattr(settings, 'EXECUTION_JOB_TIMEOUT', 60),
+    }
+
+
+class _Replies:
+    """Frames about one job for the consumer that submitted it, output batched per interval."""
+
+    def __init__(self, channel_layer, job, worker_channel, interval):
+        self.channel_layer = channel_layer
+        self.job = job
+        self.worker_channel = worker_channel
+        self.interval = interval
+        self._pending = []  # [stream, text] not sent yet
+        self._flusher = None
+        self._lock = asyncio.Lock()  # keeps frames in order while a flush is sending
+
+    async def accept(self):
+        # Sent as soon as the job is taken, so a consumer whose client leaves knows where to cancel it
+        try:
+            await self.channel_layer.send(self.job['reply_channel'], {
+                'type': 'execution.accepted',
+                'job_id': self.job['id'],
+                'worker': self.worker_channel,
+            })
+        except ChannelFull:
+            logger.error(f"Execution reply to {self.job['reply_channel']} dropped, channel full")
+
+    async def send(self, frame):
+        try:
+            await self.channel_layer.send(self.job['reply_channel'], {
+                'type': 'execution.reply',
+                'job_id': self.job['id'],
+                'worker': self.worker_channel,
+                'frame': frame,
+            })
+        except ChannelFull:
+            logger.error(f"Execution reply to {self.job['reply_channel']} dropped, channel full")
+
+    async def start(self):
+        await self.send({'type': 'execution_status', 'status': 'running'})
+
+    async def output(self, stream, text):
+        if self._pending and self._pending[-1][0] == stream:
+            self._pending[-1][1] += text
+        else:
+            self._pending.append([stream, text])
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        async with self._lock:
+            pending, self._pending = self._pending, []
+            for stream, text in pending:
+                await self.send({'type': 'execution_output', 'stream': stream, 'data': text})
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+
+class ExecutionWorker:
+    def __init__(self, queue, engine=None, channel_layer=None, concurrency=None):
+        """
+        Args:
+            queue: RedisJobQueue or LocalJobQueue to pull jobs from
+            engine: ExecutionEngine running the programs, a new one by default
+            channel_layer: Layer the replies go through, the default layer by default
+            concurrency: Jobs run at once, the engine's concurrency by default
+        """
+        self.queue = queue
+        self.engine = engine or ExecutionEngine()
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.concurrency = concurrency or self.engine.concurrency
+        self.channel_name = None
+        self._jobs = {}  # job id -> task running it
+
+    async def run(self):
+        """Pull and run jobs until cancelled."""
+        self.channel_name = await self.channel_layer.new_channel('execution.worker')
+        self.engine.warm()
+        # A job is only taken off the queue once there is a slot for it, so idle workers get the rest
+        slots = asyncio.Semaphore(self.concurrency)
+        listener = asyncio.ensure_future(self._listen())
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    job = await self.queue.pop()
+                except Exception as e:
+                    slots.release()
+                    logger.error(f"Execution queue error: {str(e)}")
+                    await asyncio.sleep(1)
+                    continue
+                if job is None:
+                    slots.release()
+                    continue
+
+                def done(task, job_id=job['id']):
+                    self._jobs.pop(job_id, None)
+                    slots.release()
+
+                task = self._jobs[job['id']] = asyncio.ensure_future(self.handle(job))
+                task.add_done_callback(done)
+        finally:
+            listener.cancel()
+            for task in list(self._jobs.values()):
+                task.cancel()
+
+    async def _listen(self):
+        # Cancellations from consumers whose client left
+        while True:
+            try:
+                message = await self.channel_layer.receive(self.channel_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Execution worker receive error: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            if message.get('type') == 'execution.cancel':
+                task = self._jobs.get(message['job_id'])
+                if task is not None:
+                    task.cancel()
+
+    async def handle(self, job):
+        replies = _Replies(
+            self.channel_layer, job, self.channel_name, getattr(settings, 'EXECUTION_OUTPUT_INTERVAL', 0.05)
+        )
+        if time.time() > job['expires_at']:
+            await replies.send({'type': 'execution_error', 'error': "No execution worker was free in time, try again"})
+            return
+        await replies.accept()
+        try:
+            result = await self.engine.run(
+                tuple(job['key']), job['code'], job['language'],
+                on_start=replies.start, on_output=replies.output,
+                share=job.get('share', False)
+            )
+            await replies.flush()
+            await replies.send({
+                'type': 'execution_exit',
+                'exit_code': result['exit_code'],
+                'status': result['status'],
+                'usage': result['usage'],
+                'cached': result['cached']
+            })
+        except ExecutionRejected as e:
+            await replies.send({'type': 'execution_error', 'error': str(e)})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Execution job error: {str(e)}")
+            await replies.send({'type': 'execution_error', 'error': str(e)})
+        finally:
+            replies.close()
+
+
+def run_worker(concurrency=None):
+    """Run a worker on ``EXECUTION_QUEUE_URL`` in this process until interrupted."""
+    worker = ExecutionWorker(get_job_queue(), concurrency=concurrency)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
@@ -14,4 +14,11 @@ application = ProtocolTypeRouter({
             code_editor.routing.websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
+
+# Periodic recommendation recompute, only when RECOMMENDATION_REFRESH_INTERVAL is set,
+# and the first load of the similarity index, off the request path
+from code_editor.recommendations import recommendation_scheduler, reload_profile_index_soon  # noqa: E402
+
+recommendation_scheduler.start()
+reload_profile_index_soon()
@@ -1,5 +1,7 @@
 import os
+import socket
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -69,15 +71,151 @@ TEMPLATES = [
 WSGI_APPLICATION = 'collaborative_code_editor.wsgi.application'
 ASGI_APPLICATION = 'collaborative_code_editor.asgi.application'
 
+# Messages between connections of the same process stay in memory; Redis
+# only carries them to other processes, one message per process
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "code_editor.layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+            "remote": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {
+                    "hosts": [os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+                    # A process receives everything for its connections on one channel
+                    "channel_capacity": {"hybrid.*": 10000},
+                },
+            },
         },
     },
 }
 
+# Rooms are placed on server nodes by consistent hashing of the room name.
+# Each node has an id and a public WebSocket base URL (e.g. wss://node1.example.com);
+# nodes find each other through Redis with a heartbeat, or are listed in
+# ROOM_NODES as "id=url,id=url". Without ROOM_NODE_URL rooms are not placed.
+# The default id is unique per process, since several processes may run on
+# one host; with ROOM_NODES the id must be set to this node's entry.
+ROOM_NODE_ID = os.getenv('ROOM_NODE_ID', f'{socket.gethostname()}-{os.getpid()}')
+ROOM_NODE_URL = os.getenv('ROOM_NODE_URL') or None
+ROOM_NODES = dict(node.split('=', 1) for node in os.getenv('ROOM_NODES', '').split(',') if node)
+if ROOM_NODES and not os.getenv('ROOM_NODE_ID'):
+    raise ImproperlyConfigured('ROOM_NODE_ID must be set to one of the ROOM_NODES ids')
+ROOM_NODES_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+ROOM_NODE_HEARTBEAT_INTERVAL = float(os.getenv('ROOM_NODE_HEARTBEAT_INTERVAL', '5'))
+ROOM_NODE_TTL = float(os.getenv('ROOM_NODE_TTL', '15'))
+
+# Room documents are mirrored to Redis every DOCUMENT_SYNC_INTERVAL seconds
+# and written to the database every DOCUMENT_FLUSH_INTERVAL seconds
+DOCUMENT_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+DOCUMENT_SYNC_INTERVAL = float(os.getenv('DOCUMENT_SYNC_INTERVAL', '1'))
+DOCUMENT_FLUSH_INTERVAL = float(os.getenv('DOCUMENT_FLUSH_INTERVAL', '10'))
+
+# Room members are kept in Redis and expire PRESENCE_TTL seconds after the
+# last heartbeat of their server process
+PRESENCE_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', '15'))
+PRESENCE_TTL = float(os.getenv('PRESENCE_TTL', '45'))
+
+# Chat: messages kept in memory per room for new members, rooms buffered,
+# page size of older history, and how often (or after how many messages)
+# queued messages are written to the database, and how many are kept while
+# writes fail
+CHAT_HISTORY_SIZE = int(os.getenv('CHAT_HISTORY_SIZE', '50'))
+CHAT_BUFFERED_ROOMS = int(os.getenv('CHAT_BUFFERED_ROOMS', '1000'))
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', '50'))
+CHAT_FLUSH_INTERVAL = float(os.getenv('CHAT_FLUSH_INTERVAL', '2'))
+CHAT_FLUSH_BATCH_SIZE = int(os.getenv('CHAT_FLUSH_BATCH_SIZE', '200'))
+CHAT_MAX_PENDING = int(os.getenv('CHAT_MAX_PENDING', '10000'))
+
+# Frames queued per WebSocket connection before the client is resynced or dropped
+OUTBOUND_QUEUE_LIMIT = int(os.getenv('OUTBOUND_QUEUE_LIMIT', '256'))
+
+# Metrics: handlers slower than this many seconds are logged (0 disables),
+# and a bearer token allowing scrapes of /metrics/ without a staff session
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', '0'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Cursor positions are batched per room and broadcast at most this many times a second
+CURSOR_TICK_RATE = float(os.getenv('CURSOR_TICK_RATE', '25'))
+
+# Code execution: concurrent programs per process, queued runs per user
+# in a room, the wall-clock limit per run in seconds and the output cap in bytes
+EXECUTION_CONCURRENCY = int(os.getenv('EXECUTION_CONCURRENCY', os.cpu_count() or 1))
+EXECUTION_QUEUE_LIMIT = int(os.getenv('EXECUTION_QUEUE_LIMIT', '3'))
+EXECUTION_TIMEOUT = float(os.getenv('EXECUTION_TIMEOUT', '10'))
+EXECUTION_OUTPUT_LIMIT = int(os.getenv('EXECUTION_OUTPUT_LIMIT', str(64 * 1024)))
+
+# Resource limits per run (0 disables one): CPU seconds, data segment bytes,
+# processes for the user running daphne (RLIMIT_NPROC counts every process and
+# thread of the user, daphne's included, so raise it when Java programs, whose
+# JVM starts dozens of threads, fail to start) and the largest file a program
+# may write
+EXECUTION_CPU_LIMIT = float(os.getenv('EXECUTION_CPU_LIMIT', str(EXECUTION_TIMEOUT)))
+EXECUTION_MEMORY_LIMIT = int(os.getenv('EXECUTION_MEMORY_LIMIT', str(256 * 1024 * 1024)))
+EXECUTION_MAX_PROCESSES = int(os.getenv('EXECUTION_MAX_PROCESSES', '128'))
+EXECUTION_FILE_SIZE_LIMIT = int(os.getenv('EXECUTION_FILE_SIZE_LIMIT', str(1024 * 1024)))
+
+# Pre-started Python/Node interpreters per language (0 disables), and how many
+# runs a Python fork server serves before it is replaced
+EXECUTION_WARM_WORKERS = int(os.getenv('EXECUTION_WARM_WORKERS', '2'))
+EXECUTION_WORKER_MAX_RUNS = int(os.getenv('EXECUTION_WORKER_MAX_RUNS', '50'))
+
+# Compiled C++/Java builds, keyed by source hash and trimmed LRU past the size cap
+EXECUTION_ARTIFACT_DIR = os.getenv('EXECUTION_ARTIFACT_DIR', os.path.join(BASE_DIR, '.artifacts'))
+EXECUTION_ARTIFACT_CACHE_SIZE = int(os.getenv('EXECUTION_ARTIFACT_CACHE_SIZE', str(256 * 1024 * 1024)))
+
+# Compiler runs: wall-clock and CPU seconds, data segment bytes, processes of
+# the user (0 disables, as compilers run no user code) and the largest file a
+# compiler may write
+EXECUTION_COMPILE_TIMEOUT = float(os.getenv('EXECUTION_COMPILE_TIMEOUT', '30'))
+EXECUTION_COMPILE_MEMORY_LIMIT = int(os.getenv('EXECUTION_COMPILE_MEMORY_LIMIT', str(1024 * 1024 * 1024)))
+EXECUTION_COMPILE_MAX_PROCESSES = int(os.getenv('EXECUTION_COMPILE_MAX_PROCESSES', '0'))
+EXECUTION_COMPILE_FILE_SIZE_LIMIT = int(os.getenv('EXECUTION_COMPILE_FILE_SIZE_LIMIT', str(64 * 1024 * 1024)))
+
+# Execution worker tier (python manage.py run_execution_workers): Redis URL of
+# the job queue (empty runs programs in the daphne process, memory:// keeps the
+# queue and a worker in the daphne process, for development), its list key, seconds a job may wait for a worker, and
+# the seconds of output a worker batches into one reply
+EXECUTION_QUEUE_URL = os.getenv('EXECUTION_QUEUE_URL', '')
+EXECUTION_QUEUE_KEY = os.getenv('EXECUTION_QUEUE_KEY', 'codecolab:execution:jobs')
+EXECUTION_JOB_TIMEOUT = float(os.getenv('EXECUTION_JOB_TIMEOUT', '60'))
+EXECUTION_OUTPUT_INTERVAL = float(os.getenv('EXECUTION_OUTPUT_INTERVAL', '0.05'))
+
+# Runs shared with the room join an identical run in progress and reuse cached
+# results of programs that look deterministic; 1 does this for every run, which
+# can replay stale output of programs printing memory addresses; results are
+# kept LRU by source hash for a number of seconds
+EXECUTION_SHARE_RUNS = os.getenv('EXECUTION_SHARE_RUNS', '0') == '1'
+EXECUTION_RESULT_CACHE_SIZE = int(os.getenv('EXECUTION_RESULT_CACHE_SIZE', '256'))
+EXECUTION_RESULT_CACHE_TTL = float(os.getenv('EXECUTION_RESULT_CACHE_TTL', '600'))
+
+# AI autocomplete: upstream class (code_editor.completion.StubUpstream answers
+# locally), model URL, seconds before a request is abandoned, pooled
+# connections, characters of context sent, and the LRU cache size and TTL
+HUGGINGFACE_API_KEY = os.getenv('HUGGINGFACE_API_KEY')
+AI_COMPLETION_UPSTREAM = os.getenv('AI_COMPLETION_UPSTREAM', 'code_editor.completion.HuggingFaceUpstream')
+AI_COMPLETION_URL = os.getenv(
+    'AI_COMPLETION_URL', 'https://api-inference.huggingface.co/models/Salesforce/codegen-350M-mono'
+)
+AI_COMPLETION_TIMEOUT = float(os.getenv('AI_COMPLETION_TIMEOUT', '10'))
+AI_COMPLETION_MAX_CONNECTIONS = int(os.getenv('AI_COMPLETION_MAX_CONNECTIONS', '20'))
+AI_COMPLETION_CONTEXT_CHARS = int(os.getenv('AI_COMPLETION_CONTEXT_CHARS', '2000'))
+AI_COMPLETION_CACHE_SIZE = int(os.getenv('AI_COMPLETION_CACHE_SIZE', '1024'))
+AI_COMPLETION_CACHE_TTL = float(os.getenv('AI_COMPLETION_CACHE_TTL', str(5 * 60)))
+
+# Shared cache; also keeps server processes from recomputing recommendations at the same time
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379'),
+    }
+}
+# Seconds between in-process recomputes of all recommended rooms; 0 leaves it to
+# `manage.py recompute_recommendations` (e.g. from cron)
+RECOMMENDATION_REFRESH_INTERVAL = int(os.getenv('RECOMMENDATION_REFRESH_INTERVAL', '0'))
+# Seconds before the in-process profile similarity index is reloaded from the database
+SIMILARITY_INDEX_MAX_AGE = int(os.getenv('SIMILARITY_INDEX_MAX_AGE', str(10 * 60)))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
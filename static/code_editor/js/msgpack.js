@@ -0,0 +1,176 @@
+// MessagePack codec for the room WebSocket (codecolab.msgpack subprotocol).
+// Covers what the server's msgpack.packb produces and the client sends:
+// nil, booleans, integers, floats, strings, binary, arrays and maps.
+(function () {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+        const view = new DataView(new ArrayBuffer(8));
+
+        function pushView(length) {
+            for (let i = 0; i < length; i++) bytes.push(view.getUint8(i));
+        }
+
+        function pushLength(length, fix, fixLimit, type8, type16, type32) {
+            if (fix !== null && length < fixLimit) {
+                bytes.push(fix | length);
+            } else if (type8 !== null && length < 0x100) {
+                bytes.push(type8, length);
+            } else if (length < 0x10000) {
+                bytes.push(type16, length >> 8, length & 0xff);
+            } else {
+                bytes.push(type32);
+                view.setUint32(0, length);
+                pushView(4);
+            }
+        }
+
+        function pushInteger(number) {
+            if (number >= 0 && number < 0x80) {
+                bytes.push(number);
+            } else if (number < 0 && number >= -0x20) {
+                bytes.push(number & 0xff);
+            } else if (number >= 0 && number < 0x100) {
+                bytes.push(0xcc, number);
+            } else if (number >= 0 && number < 0x10000) {
+                bytes.push(0xcd, number >> 8, number & 0xff);
+            } else if (number >= 0 && number < 0x100000000) {
+                bytes.push(0xce);
+                view.setUint32(0, number);
+                pushView(4);
+            } else if (number >= 0) {
+                bytes.push(0xcf);
+                view.setBigUint64(0, BigInt(number));
+                pushView(8);
+            } else if (number >= -0x80) {
+                bytes.push(0xd0, number & 0xff);
+            } else if (number >= -0x8000) {
+                bytes.push(0xd1, (number >> 8) & 0xff, number & 0xff);
+            } else if (number >= -0x80000000) {
+                bytes.push(0xd2);
+                view.setInt32(0, number);
+                pushView(4);
+            } else {
+                bytes.push(0xd3);
+                view.setBigInt64(0, BigInt(number));
+                pushView(8);
+            }
+        }
+
+        function pushValue(item) {
+            if (item === null || item === undefined) {
+                bytes.push(0xc0);
+            } else if (item === false || item === true) {
+                bytes.push(item ? 0xc3 : 0xc2);
+            } else if (typeof item === 'number') {
+                if (Number.isSafeInteger(item)) {
+                    pushInteger(item);
+                } else {
+                    bytes.push(0xcb);
+                    view.setFloat64(0, item);
+                    pushView(8);
+                }
+            } else if (typeof item === 'string') {
+                const utf8 = textEncoder.encode(item);
+                pushLength(utf8.length, 0xa0, 0x20, 0xd9, 0xda, 0xdb);
+                for (const byte of utf8) bytes.push(byte);
+            } else if (item instanceof Uint8Array) {
+                pushLength(item.length, null, 0, 0xc4, 0xc5, 0xc6);
+                for (const byte of item) bytes.push(byte);
+            } else if (Array.isArray(item)) {
+                pushLength(item.length, 0x90, 0x10, null, 0xdc, 0xdd);
+                item.forEach(pushValue);
+            } else {
+                const keys = Object.keys(item).filter(key => item[key] !== undefined);
+                pushLength(keys.length, 0x80, 0x10, null, 0xde, 0xdf);
+                keys.forEach(key => {
+                    pushValue(key);
+                    pushValue(item[key]);
+                });
+            }
+        }
+
+        pushValue(value);
+        return new Uint8Array(bytes);
+    }
+
+    function decode(bytes) {
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function take(length) {
+            if (offset + length > bytes.length) throw new Error('Truncated MessagePack frame');
+            const start = offset;
+            offset += length;
+            return start;
+        }
+
+        function string(length) {
+            const start = take(length);
+            return textDecoder.decode(bytes.subarray(start, start + length));
+        }
+
+        function binary(length) {
+            const start = take(length);
+            return bytes.slice(start, start + length);
+        }
+
+        function array(length) {
+            const items = new Array(length);
+            for (let i = 0; i < length; i++) items[i] = readValue();
+            return items;
+        }
+
+        function map(length) {
+            const object = {};
+            for (let i = 0; i < length; i++) {
+                const key = readValue();
+                object[key] = readValue();
+            }
+            return object;
+        }
+
+        function readValue() {
+            const type = bytes[take(1)];
+            if (type < 0x80) return type;
+            if (type < 0x90) return map(type & 0x0f);
+            if (type < 0xa0) return array(type & 0x0f);
+            if (type < 0xc0) return string(type & 0x1f);
+            if (type >= 0xe0) return type - 0x100;
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return binary(view.getUint8(take(1)));
+                case 0xc5: return binary(view.getUint16(take(2)));
+                case 0xc6: return binary(view.getUint32(take(4)));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return view.getUint8(take(1));
+                case 0xcd: return view.getUint16(take(2));
+                case 0xce: return view.getUint32(take(4));
+                case 0xcf: return Number(view.getBigUint64(take(8)));
+                case 0xd0: return view.getInt8(take(1));
+                case 0xd1: return view.getInt16(take(2));
+                case 0xd2: return view.getInt32(take(4));
+                case 0xd3: return Number(view.getBigInt64(take(8)));
+                case 0xd9: return string(view.getUint8(take(1)));
+                case 0xda: return string(view.getUint16(take(2)));
+                case 0xdb: return string(view.getUint32(take(4)));
+                case 0xdc: return array(view.getUint16(take(2)));
+                case 0xdd: return array(view.getUint32(take(4)));
+                case 0xde: return map(view.getUint16(take(2)));
+                case 0xdf: return map(view.getUint32(take(4)));
+                default: throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+            }
+        }
+
+        const value = readValue();
+        if (offset !== bytes.length) throw new Error('Trailing bytes in MessagePack frame');
+        return value;
+    }
+
+    window.MessagePack = { encode, decode };
+})();
@@ -1,17 +1,42 @@
 // WebSocket setup
 const roomName = document.getElementById('room-name').textContent.trim();  // hidden element in room.html
 const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-const socket = new WebSocket(`${wsProtocol}//${window.location.host}/ws/code/${roomName}/`);
+// Binary MessagePack frames when the library loaded, JSON text frames otherwise
+const wireProtocols = window.MessagePack ? ['codecolab.msgpack', 'codecolab.json'] : ['codecolab.json'];
+let socket = openSocket(`${wsProtocol}//${window.location.host}/ws/code/${roomName}/`);
+
+function openSocket(url) {
+    const ws = new WebSocket(url, wireProtocols);
+    ws.binaryType = 'arraybuffer';
+    ws.onmessage = handleSocketMessage;
+    ws.onclose = handleSocketClose;
+    return ws;
+}
+
+function sendMessage(message) {
+    if (socket.protocol === 'codecolab.msgpack') {
+        socket.send(MessagePack.encode(message));
+    } else {
+        socket.send(JSON.stringify(message));
+    }
+}
+
+function decodeFrame(frame) {
+    return typeof frame === 'string' ? JSON.parse(frame) : MessagePack.decode(new Uint8Array(frame));
+}
 
 // DOM Elements
 const codeEditor = document.getElementById('code-editor');
 const runButton = document.getElementById('run-code');
+const shareRunCheckbox = document.getElementById('share-run');
 const outputDiv = document.getElementById('output');
 const languageSelect = document.getElementById('language');
 const chatInput = document.getElementById('chat-input');
 const chatMessages = document.getElementById('chat-messages');
 const sendMessageButton = document.getElementById('send-message');
-const aiButton = document.getElementById('ai-complete');  // AI Autocomplete Button
+const aiButton = document.getElementById('ai-autocomplete');  // AI Autocomplete Button
+const aiSuggestion = document.getElementById('ai-suggestion');
+const presenceBadge = document.getElementById('presence-count');
 
 // Time formatting
 function formatTimestamp(date) {
@@ -22,35 +47,235 @@ function formatTimestamp(date) {
     });
 }
 
+// Room members by connection, from the snapshot on join and later join/leave events
+let roomMembers = new Map();
+
+function renderPresence() {
+    if (!presenceBadge) return;
+    presenceBadge.textContent = `${roomMembers.size} online`;
+    presenceBadge.title = [...new Set(roomMembers.values())].join(', ');
+}
+
+function applyPresenceEvent(presence) {
+    if (presence.event === 'join') {
+        roomMembers.set(presence.member_id, presence.username);
+    } else {
+        roomMembers.delete(presence.member_id);
+    }
+    renderPresence();
+}
+
 // Chat message display
-function addChatMessage(username, message, timestamp) {
+function chatMessageElement(username, message, timestamp) {
+    // Messages are replayed from history, so they are never parsed as HTML
     const messageDiv = document.createElement('div');
     messageDiv.className = 'chat-message';
     messageDiv.innerHTML = `
         <div class="message-header">
-            <span class="username">${username}</span>
-            <span class="timestamp">${timestamp}</span>
+            <span class="username"></span>
+            <span class="timestamp"></span>
         </div>
-        <div class="message-content">${message}</div>
+        <div class="message-content"></div>
     `;
-    chatMessages.appendChild(messageDiv);
+    messageDiv.querySelector('.username').textContent = username;
+    messageDiv.querySelector('.timestamp').textContent = timestamp;
+    messageDiv.querySelector('.message-content').textContent = message;
+    return messageDiv;
+}
+
+function addChatMessage(username, message, timestamp) {
+    chatMessages.appendChild(chatMessageElement(username, message, timestamp));
     chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
+// Chat history: the latest messages arrive on join, older pages on request
+let oldestChatMessage = null;  // created_at of the oldest message shown, the backfill cursor
+const loadOlderButton = document.createElement('button');
+loadOlderButton.className = 'btn btn-link btn-sm p-0 mb-2';
+loadOlderButton.textContent = 'Load older messages';
+loadOlderButton.addEventListener('click', function () {
+    sendMessage({ type: 'chat_backfill', before: oldestChatMessage });
+});
+
+function addChatHistory(messages, hasMore) {
+    const initial = oldestChatMessage === null;
+    loadOlderButton.remove();
+    const first = chatMessages.firstChild;
+    messages.forEach(message => {
+        chatMessages.insertBefore(chatMessageElement(message.username, message.message, message.timestamp), first);
+    });
+    if (messages.length) oldestChatMessage = messages[0].created_at;
+    if (hasMore && oldestChatMessage !== null) chatMessages.prepend(loadOlderButton);
+    if (initial) chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+// Operational transform (same operation format as code_editor/ot.py)
+// An operation is a list of components: n > 0 retains, n < 0 deletes, a string inserts.
+const OT = {
+    push(op, c) {
+        if (c === 0 || c === '') return;
+        const last = op[op.length - 1];
+        if (op.length && typeof c === typeof last && (typeof c === 'string' || (c > 0) === (last > 0))) {
+            op[op.length - 1] = last + c;
+        } else if (typeof c === 'string' && typeof last === 'number' && last < 0) {
+            if (typeof op[op.length - 2] === 'string') op[op.length - 2] += c;
+            else op.splice(op.length - 1, 0, c);
+        } else {
+            op.push(c);
+        }
+    },
+
+    apply(text, op) {
+        let index = 0;
+        const parts = [];
+        for (const c of op) {
+            if (typeof c === 'string') parts.push(c);
+            else if (c > 0) { parts.push(text.slice(index, index + c)); index += c; }
+            else index -= c;
+        }
+        return parts.join('');
+    },
+
+    // Returns [a', b'] such that apply(apply(s, a), b') === apply(apply(s, b), a').
+    // Inserts from `a` win ties, matching the server.
+    transform(a, b) {
+        const aPrime = [], bPrime = [];
+        let i = 0, j = 0;
+        let op1 = a[i++], op2 = b[j++];
+        while (op1 !== undefined || op2 !== undefined) {
+            if (typeof op1 === 'string') {
+                OT.push(aPrime, op1); OT.push(bPrime, op1.length); op1 = a[i++]; continue;
+            }
+            if (typeof op2 === 'string') {
+                OT.push(aPrime, op2.length); OT.push(bPrime, op2); op2 = b[j++]; continue;
+            }
+            if (op1 === undefined || op2 === undefined) {
+                throw new Error('Operations have mismatched lengths');
+            }
+            let step;
+            if (op1 > 0 && op2 > 0) {
+                step = Math.min(op1, op2); OT.push(aPrime, step); OT.push(bPrime, step);
+            } else if (op1 < 0 && op2 < 0) {
+                step = Math.min(-op1, -op2);
+            } else if (op1 < 0) {
+                step = Math.min(-op1, op2); OT.push(aPrime, -step);
+            } else {
+                step = Math.min(op1, -op2); OT.push(bPrime, -step);
+            }
+            op1 = op1 > 0 ? op1 - step : op1 + step;
+            op2 = op2 > 0 ? op2 - step : op2 + step;
+            if (op1 === 0) op1 = a[i++];
+            if (op2 === 0) op2 = b[j++];
+        }
+        return [aPrime, bPrime];
+    },
+
+    diff(oldText, newText) {
+        let prefix = 0;
+        const limit = Math.min(oldText.length, newText.length);
+        while (prefix < limit && oldText[prefix] === newText[prefix]) prefix++;
+        let suffix = 0;
+        while (suffix < limit - prefix &&
+               oldText[oldText.length - 1 - suffix] === newText[newText.length - 1 - suffix]) suffix++;
+        const op = [];
+        OT.push(op, prefix);
+        OT.push(op, newText.slice(prefix, newText.length - suffix));
+        OT.push(op, -(oldText.length - prefix - suffix));
+        OT.push(op, suffix);
+        return op;
+    },
+
+    isNoop(op) {
+        return op.every(c => typeof c === 'number' && c > 0);
+    },
+
+    // New index of `position` after `op` is applied
+    transformIndex(position, op) {
+        let index = 0, result = position;
+        for (const c of op) {
+            if (index > position) break;
+            if (typeof c === 'string') result += c.length;
+            else if (c > 0) index += c;
+            else { result -= Math.min(-c, position - index); index -= c; }
+        }
+        return result;
+    }
+};
+
+// Document sync: only one operation is in flight at a time. Edits made while
+// waiting for the ack are diffed against the server state once it arrives.
+const doc = {
+    revision: 0,       // last revision received from the server
+    serverText: '',    // document at `revision`
+    outstanding: null, // operation sent but not yet acknowledged
+    pending: new Map() // out-of-order server events keyed by revision
+};
+
 // Debounced code update
 let typingTimer;
 const doneTypingInterval = 100;
 
+function confirmedText() {
+    return doc.outstanding ? OT.apply(doc.serverText, doc.outstanding) : doc.serverText;
+}
+
 function sendCodeUpdate() {
-    if (socket.readyState === WebSocket.OPEN) {
-        socket.send(JSON.stringify({
-            type: 'code_update',
-            code: codeEditor.value
-        }));
+    if (socket.readyState !== WebSocket.OPEN || doc.outstanding) return;
+    const operation = OT.diff(doc.serverText, codeEditor.value);
+    if (OT.isNoop(operation)) return;
+    doc.outstanding = operation;
+    sendMessage({
+        type: 'code_delta',
+        revision: doc.revision,
+        operation: operation
+    });
+}
+
+function applyRemoteOperation(operation) {
+    // Rebase the remote edit over our in-flight and unsent local edits
+    let remote = operation;
+    const local = OT.diff(confirmedText(), codeEditor.value);
+    if (doc.outstanding) {
+        [doc.outstanding, remote] = OT.transform(doc.outstanding, remote);
     }
+    doc.serverText = OT.apply(doc.serverText, operation);
+    const [, editorOp] = OT.transform(local, remote);
+
+    const start = OT.transformIndex(codeEditor.selectionStart, editorOp);
+    const end = OT.transformIndex(codeEditor.selectionEnd, editorOp);
+    codeEditor.value = OT.apply(codeEditor.value, editorOp);
+    codeEditor.setSelectionRange(start, end);
+}
+
+function handleServerEvent(data) {
+    if (data.revision <= doc.revision) return;  // superseded by a snapshot
+    doc.pending.set(data.revision, data);
+    while (doc.pending.has(doc.revision + 1)) {
+        const event = doc.pending.get(doc.revision + 1);
+        doc.pending.delete(doc.revision + 1);
+        doc.revision = event.revision;
+        if (event.type === 'code_ack') {
+            doc.serverText = OT.apply(doc.serverText, doc.outstanding);
+            doc.outstanding = null;
+            sendCodeUpdate();
+        } else {
+            applyRemoteOperation(event.operation);
+        }
+    }
+}
+
+function loadSnapshot(data) {
+    const cursorPosition = codeEditor.selectionStart;
+    doc.revision = data.revision;
+    doc.serverText = data.code;
+    doc.outstanding = null;
+    doc.pending.clear();
+    codeEditor.value = data.code;
+    codeEditor.setSelectionRange(cursorPosition, cursorPosition);
 }
 
 codeEditor.addEventListener('input', function () {
+    cancelCompletion();
     clearTimeout(typingTimer);
     typingTimer = setTimeout(sendCodeUpdate, doneTypingInterval);
 });
@@ -58,11 +283,12 @@ codeEditor.addEventListener('input', function () {
 // Run Code
 runButton.addEventListener('click', function () {
     if (socket.readyState === WebSocket.OPEN) {
-        socket.send(JSON.stringify({
+        sendMessage({
             type: 'execute_code',
             code: codeEditor.value,
-            language: languageSelect.value
-        }));
+            language: languageSelect.value,
+            share: shareRunCheckbox.checked  // Show the run to the whole room
+        });
     }
 });
 
@@ -70,10 +296,10 @@ runButton.addEventListener('click', function () {
 function sendChatMessage() {
     const message = chatInput.value.trim();
     if (message && socket.readyState === WebSocket.OPEN) {
-        socket.send(JSON.stringify({
+        sendMessage({
             type: 'chat_message',
             message: message
-        }));
+        });
         chatInput.value = '';
     }
 }
@@ -192,86 +418,199 @@ function stringToColor(str) {
     return `hsl(${hash % 360}, 70%, 50%)`;
 }
 
+// The server batches cursors per room tick; sending more often than that,
+// or when the caret has not moved, only adds traffic
+const CURSOR_SEND_INTERVAL = 40;
+let cursorTimer = null;
+let lastCursorIndex = null;
+
+function scheduleCursorUpdate() {
+    if (cursorTimer === null) {
+        cursorTimer = setTimeout(() => {
+            cursorTimer = null;
+            sendCursorUpdate();
+        }, CURSOR_SEND_INTERVAL);
+    }
+}
+
 function sendCursorUpdate() {
-    if (socket.readyState === WebSocket.OPEN) {
+    if (socket.readyState === WebSocket.OPEN && codeEditor.selectionStart !== lastCursorIndex) {
         const position = codeEditor.selectionStart;
+        lastCursorIndex = position;
         const coords = getCaretCoordinates(codeEditor, position);
-        socket.send(JSON.stringify({
+        sendMessage({
             type: 'cursor_update',
             position: {
                 index: position,
                 coords: coords
             }
-        }));
+        });
     }
 }
 
-codeEditor.addEventListener('click', sendCursorUpdate);
-codeEditor.addEventListener('keyup', sendCursorUpdate);
-codeEditor.addEventListener('mousemove', sendCursorUpdate);
+codeEditor.addEventListener('click', scheduleCursorUpdate);
+codeEditor.addEventListener('keyup', scheduleCursorUpdate);
+codeEditor.addEventListener('mousemove', scheduleCursorUpdate);
+
+// Execution output
+function appendOutput(text, color) {
+    // Text nodes keep program output from being parsed as HTML
+    const span = document.createElement('span');
+    span.style.whiteSpace = 'pre-wrap';
+    if (color) span.style.color = color;
+    span.textContent = text;
+    outputDiv.appendChild(span);
+    outputDiv.scrollTop = outputDiv.scrollHeight;
+}
+
+function describeExit(data) {
+    switch (data.status) {
+        case 'timeout': return '\nExecution timed out';
+        case 'cpu_limit': return '\nCPU time limit exceeded' + describeUsage(data.usage);
+        case 'truncated': return '\nOutput limit reached, program stopped';
+        case 'failed': return '\nProgram could not be started';
+        case 'compile_error': return '\nCompilation failed';
+        default:
+            return `\nProcess exited with code ${data.exit_code}` + describeUsage(data.usage)
+                + (data.cached ? ' [cached]' : '');
+    }
+}
+
+function describeUsage(usage) {
+    if (!usage) return '';
+    const parts = [];
+    if (usage.wall_ms != null) parts.push(`${usage.wall_ms} ms`);
+    if (usage.cpu_ms != null) parts.push(`CPU ${usage.cpu_ms} ms`);
+    if (usage.peak_rss_kb != null) parts.push(`${(usage.peak_rss_kb / 1024).toFixed(1)} MB`);
+    return parts.length ? ` (${parts.join(', ')})` : '';
+}
 
 // WebSocket handler
-socket.onmessage = function (e) {
-    const data = JSON.parse(e.data);
+function handleSocketMessage(e) {
+    const data = decodeFrame(e.data);
     console.log('Received WebSocket message:', data);
 
     switch (data.type) {
-        case 'code_update':
-            if (codeEditor.value !== data.code) {
-                const cursorPosition = codeEditor.selectionStart;
-                codeEditor.value = data.code;
-                codeEditor.setSelectionRange(cursorPosition, cursorPosition);
-            }
+        case 'redirect':
+            // The room is served by another node; the new connection resends history and presence
+            chatMessages.replaceChildren();
+            oldestChatMessage = null;
+            socket = openSocket(data.url);
+            break;
+        case 'code_snapshot':
+            loadSnapshot(data);
             break;
-        case 'execution_result':
-            outputDiv.innerHTML = data.output.replace(/\n/g, '<br>');
+        case 'code_delta':
+        case 'code_ack':
+            handleServerEvent(data);
+            break;
+        case 'execution_status':
+            if (data.status === 'running') {
+                outputDiv.textContent = data.run_by ? `Run by ${data.run_by}\n` : '';
+            } else {
+                outputDiv.textContent = data.run_by ? `Queued by ${data.run_by}...` : 'Queued...';
+            }
             outputDiv.style.color = 'white';
             break;
+        case 'execution_output':
+            appendOutput(data.data, data.stream === 'stderr' ? '#ff6b6b' : null);
+            break;
+        case 'execution_exit':
+            appendOutput(describeExit(data), '#888');
+            break;
         case 'execution_error':
             outputDiv.textContent = 'Error: ' + data.error;
             outputDiv.style.color = 'red';
             break;
         case 'chat_message':
+            if (oldestChatMessage === null) oldestChatMessage = data.created_at;
             addChatMessage(data.username, data.message, data.timestamp || formatTimestamp(new Date()));
             break;
-        case 'cursor_update':
-            updateRemoteCursor(data.username, data.position);
+        case 'chat_history':
+            addChatHistory(data.messages, data.has_more);
+            break;
+        case 'cursor_batch':
+            data.cursors.forEach(cursor => updateRemoteCursor(cursor.username, cursor.position));
+            break;
+        case 'presence':
+            roomMembers = new Map(data.members.map(member => [member.member_id, member.username]));
+            renderPresence();
+            break;
+        case 'system_message':
+            if (data.presence) applyPresenceEvent(data.presence);
+            break;
+        case 'ai_token':
+        case 'ai_done':
+        case 'ai_error':
+            handleCompletionEvent(data);
             break;
     }
-};
+}
 
-socket.onclose = function () {
+function handleSocketClose(e) {
+    if (e.target !== socket) return;  // A socket we were redirected away from
     console.error('WebSocket connection closed unexpectedly');
     outputDiv.textContent = 'Connection lost. Please refresh the page.';
     outputDiv.style.color = 'red';
-};
+}
 
-// Hugging Face Code Autocomplete
-if (aiButton) {
-    aiButton.addEventListener('click', async () => {
-        const code = codeEditor.value;
-        const response = await fetch('/ai-autocomplete/', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'X-CSRFToken': getCSRFToken()
-            },
-            body: JSON.stringify({ code: code })
-        });
+// AI autocomplete, streamed over the room socket
+const AI_CONTEXT_CHARS = 2000;  // Code before the cursor sent as context
+let aiRequestId = 0;
+let aiPending = null;  // Id of the request still streaming
+let aiText = '';
+
+function showSuggestion(text) {
+    const preElement = document.createElement('pre');
+    preElement.textContent = text;
+    preElement.style.margin = '0';
+    preElement.style.whiteSpace = 'pre';
+    preElement.style.fontFamily = 'Consolas, Monaco, "Courier New", monospace';
+    preElement.style.lineHeight = '1.5';
+    preElement.style.overflow = 'auto';
+    preElement.style.color = '#a6e22e';
+    preElement.style.backgroundColor = 'transparent';
+    aiSuggestion.replaceChildren(preElement);
+}
 
-        if (response.ok) {
-            const data = await response.json();
-            const suggestion = data.suggestion || '';
+function requestCompletion() {
+    if (socket.readyState !== WebSocket.OPEN) return;
+    const cursor = codeEditor.selectionStart;
+    aiPending = ++aiRequestId;
+    aiText = '';
+    aiSuggestion.textContent = 'Thinking...';
+    sendMessage({
+        type: 'ai_complete',
+        request_id: aiPending,
+        language: languageSelect.value,
+        prefix: codeEditor.value.slice(Math.max(0, cursor - AI_CONTEXT_CHARS), cursor)
+    });
+}
 
-            const start = codeEditor.selectionStart;
-            const end = codeEditor.selectionEnd;
+function cancelCompletion() {
+    // Typing makes the pending suggestion stale; stop the server generating it
+    if (aiPending === null) return;
+    aiPending = null;
+    if (socket.readyState === WebSocket.OPEN) sendMessage({ type: 'ai_cancel' });
+    aiSuggestion.textContent = 'Suggestion cancelled. Click "AI Autocomplete" to try again';
+}
 
-            codeEditor.value = codeEditor.value.slice(0, start) + suggestion + codeEditor.value.slice(end);
+function handleCompletionEvent(data) {
+    if (data.request_id !== aiPending) return;  // Superseded request
+    switch (data.type) {
+        case 'ai_token':
+            aiText += data.token;
+            showSuggestion(aiText);
+            break;
+        case 'ai_done':
+            aiPending = null;
+            if (!aiText.trim()) aiSuggestion.textContent = 'No suggestion found.';
+            break;
+        case 'ai_error':
+            aiPending = null;
+            aiSuggestion.textContent = 'AI Autocomplete failed: ' + data.error;
+            break;
+    }
+}
 
-            codeEditor.selectionStart = codeEditor.selectionEnd = start + suggestion.length;
-            codeEditor.focus();
-        } else {
-            alert('AI Suggestion failed.');
-        }
-    });
-}
\ No newline at end of file
+if (aiButton) aiButton.addEventListener('click', requestCompletion);